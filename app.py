@@ -1,12 +1,35 @@
+import asyncio
+import atexit
+import json
 import logging
+import math
+import mimetypes
 import os
 import re
-import smtplib
+import threading
+import time
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from email.message import EmailMessage
-
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from functools import partial, wraps
+from typing import TYPE_CHECKING
+
+from flask import (
+    Blueprint,
+    Flask,
+    Response,
+    abort,
+    current_app,
+    flash,
+    g,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    send_file,
+    stream_with_context,
+    url_for,
+)
 from flask_login import (
     LoginManager,
     UserMixin,
@@ -16,30 +39,186 @@ from flask_login import (
     logout_user,
 )
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func
 from sqlalchemy.exc import SQLAlchemyError
-from werkzeug.security import check_password_hash, generate_password_hash
-from openai import OpenAI
-from generator_utils import generate_interior, get_style_prompt
+from sqlalchemy.orm import make_transient_to_detached
+from werkzeug.middleware.proxy_fix import ProxyFix
+from assets import init_assets
+from async_runtime import EventLoopThread
+from auth_security import HasherBusyError, PasswordHasher, TokenBucketLimiter
+from blueprint_preprocess import InvalidBlueprintError, preprocess_blueprint
+from file_writer import AsyncFileWriter
+from mail_outbox import (
+    OUTBOX_FAILED,
+    OUTBOX_PENDING,
+    OUTBOX_SENDING,
+    OUTBOX_SENT,
+    SMTPSender,
+    is_connection_error,
+    is_permanent_error,
+    retry_delay,
+)
+from chat_budget import AnswerCache, ChatBudget, build_system_prompt
+from db_utils import TTLCache, database_uri, engine_options
+from generator_utils import (
+    STYLE_LABELS,
+    build_prompt,
+    generate_interior,
+    generate_interior_async,
+    get_stability_key_pool,
+    get_style_assets,
+)
+from jobs import JOB_DONE, JOB_FAILED, JOB_QUEUED, Job, JobQueue, QueueFullError, QuotaExceededError, TierPolicy
+from metrics import REGISTRY, end_trace, log_if_slow, observe_stage, span, start_trace
+from page_cache import PageCache, cached_page
+from result_cache import get_result_cache
+from storage import ExclusiveRun, PeriodicTask, ShardedStorage
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI, OpenAI
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'changeme-secret-key')
-app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(BASE_DIR, 'app.db')}"
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['UPLOAD_FOLDER'] = os.path.join(BASE_DIR, 'uploads')
-app.config['RESULT_FOLDER'] = os.path.join(BASE_DIR, 'results')
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
-db = SQLAlchemy(app)
-login_manager = LoginManager(app)
-login_manager.login_view = 'login'
+def load_config() -> dict:
+    """Настройки приложения из переменных окружения."""
+    return {
+        'SECRET_KEY': os.getenv('SECRET_KEY', 'changeme-secret-key'),
+        # DATABASE_URL=postgresql://... переключает приложение с SQLite на PostgreSQL
+        'SQLALCHEMY_DATABASE_URI': database_uri(BASE_DIR),
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'UPLOAD_FOLDER': os.getenv('UPLOAD_FOLDER') or os.path.join(BASE_DIR, 'uploads'),
+        'RESULT_FOLDER': os.getenv('RESULT_FOLDER') or os.path.join(BASE_DIR, 'results'),
+        # Общий кэш результатов; по умолчанию — RESULT_FOLDER/cache (см. create_app)
+        'RESULT_CACHE_DIR': os.getenv('RESULT_CACHE_DIR'),
+        'MAX_CONTENT_LENGTH': 16 * 1024 * 1024,  # 16MB max file size
+        'BLUEPRINT_MAX_SIDE': int(os.getenv('BLUEPRINT_MAX_SIDE', '1536')),
+        'BLUEPRINT_BINARIZE': os.getenv('BLUEPRINT_BINARIZE', 'true').lower() == 'true',
+        'STORAGE_RETENTION_DAYS': int(os.getenv('STORAGE_RETENTION_DAYS', '30')),
+        'STORAGE_USER_QUOTA_BYTES': int(os.getenv('STORAGE_USER_QUOTA_BYTES', str(500 * 1024 * 1024))),
+        'STORAGE_QUOTA_BYTES': int(os.getenv('STORAGE_QUOTA_BYTES', str(20 * 1024 * 1024 * 1024))),
+        'STORAGE_ORPHAN_GRACE_HOURS': int(os.getenv('STORAGE_ORPHAN_GRACE_HOURS', '24')),
+        'STORAGE_GC_INTERVAL': int(os.getenv('STORAGE_GC_INTERVAL', '3600')),
+        # Сколько часов хранить в БД состояние задач генерации (для опроса /jobs/<id>)
+        'JOB_RETENTION_HOURS': float(os.getenv('JOB_RETENTION_HOURS', '24')),
+        # Порог журнала медленных запросов, мс (0 — не писать)
+        'SLOW_REQUEST_MS': int(os.getenv('SLOW_REQUEST_MS', '0')),
+        # Сколько обратных прокси (nginx и т.п.) стоит перед приложением: их X-Forwarded-For/-Proto
+        # считаются достоверными. 0 — заголовкам не доверять (без прокси их подделывает клиент)
+        'TRUSTED_PROXIES': int(os.getenv('TRUSTED_PROXIES', '0')),
+        'OUTBOX_INTERVAL': int(os.getenv('OUTBOX_INTERVAL', '10')),
+        'OUTBOX_BATCH_SIZE': int(os.getenv('OUTBOX_BATCH_SIZE', '50')),
+        'OUTBOX_MAX_ATTEMPTS': int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8')),
+        # Кэш страниц для анонимных посетителей: memory / redis / none, TTL в секундах
+        'PAGE_CACHE_BACKEND': os.getenv('PAGE_CACHE_BACKEND', 'memory'),
+        'PAGE_CACHE_TTL': float(os.getenv('PAGE_CACHE_TTL', '60')),
+        'PAGE_CACHE_SIZE': int(os.getenv('PAGE_CACHE_SIZE', '256')),
+        'PAGE_CACHE_REDIS_URL': os.getenv('PAGE_CACHE_REDIS_URL', 'redis://localhost:6379/0'),
+        'PAGE_CACHE_LOCALES': tuple(os.getenv('PAGE_CACHE_LOCALES', 'ru').split(',')),
+    }
+
+
+# Расширения и маршруты не привязаны к приложению: его собирает create_app()
+db = SQLAlchemy()
+login_manager = LoginManager()
+login_manager.login_view = 'main.login'
+bp = Blueprint('main', __name__, cli_group=None)
 
 logger = logging.getLogger(__name__)
 PASSWORD_PATTERN = re.compile(r'^[A-Za-z0-9]{8,}$')
 OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
 openai_api_key = os.getenv('OPENAI_API_KEY')
-openai_client = OpenAI(api_key=openai_api_key) if openai_api_key else None
+_openai_client: 'OpenAI | None' = None
+_openai_client_lock = threading.Lock()
+
+
+def get_openai_client() -> 'OpenAI':
+    """Клиент OpenAI создаётся при первом обращении к чату: пакет openai долго импортируется."""
+    global _openai_client
+    if _openai_client is None:
+        with _openai_client_lock:
+            if _openai_client is None:
+                from openai import OpenAI
+
+                # OPENAI_BASE_URL — совместимый с OpenAI сервер (прокси, заглушка бенчмарка)
+                _openai_client = OpenAI(api_key=openai_api_key, base_url=os.getenv('OPENAI_BASE_URL') or None)
+    return _openai_client
+
+# Хэширование паролей — в отдельном пуле процессов, чтобы вход не отнимал CPU у остального сайта
+password_hasher = PasswordHasher(
+    os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1'),
+    workers=int(os.getenv('PASSWORD_HASH_WORKERS', '2')),
+    max_pending=int(os.getenv('PASSWORD_HASH_MAX_PENDING', '16')),
+)
+atexit.register(password_hasher.shutdown)
+
+# Ограничение попыток входа/регистрации: с одного IP и на один email
+ip_auth_limiter = TokenBucketLimiter(
+    rate=float(os.getenv('AUTH_IP_RATE_PER_MINUTE', '20')) / 60,
+    capacity=int(os.getenv('AUTH_IP_BURST', '10')),
+)
+email_auth_limiter = TokenBucketLimiter(
+    rate=float(os.getenv('AUTH_EMAIL_RATE_PER_MINUTE', '5')) / 60,
+    capacity=int(os.getenv('AUTH_EMAIL_BURST', '5')),
+)
+
+# Письма контактной формы уходят через одно постоянное SMTP-соединение фонового потока
+mail_sender = SMTPSender.from_env()
+
+# Загрузки и результаты пишутся на диск в фоне, вне пути запроса
+file_writer = AsyncFileWriter(int(os.getenv('FILE_WRITER_MAX_PENDING_BYTES', str(256 * 1024 * 1024))))
+atexit.register(file_writer.flush)
+
+# Тарифы в очереди генераций: вес в справедливой очереди, одновременные генерации,
+# квота постановок одного клиента в минуту и предел ожидания (0 — без ограничения).
+# Бесплатные запросы (без подписки) не вытесняют платных клиентов с мощности Stability.
+DEFAULT_GENERATION_TIERS = {
+    'free': {'weight': 1, 'concurrency': 8, 'rate_per_minute': 6, 'burst': 3, 'max_queued': 16, 'max_wait': 300},
+    'basic': {'weight': 2, 'concurrency': 16, 'rate_per_minute': 20, 'burst': 5, 'max_queued': 32, 'max_wait': 600},
+    'plus': {'weight': 3, 'rate_per_minute': 30, 'burst': 10, 'max_wait': 900},
+    'pro': {'weight': 4, 'rate_per_minute': 60, 'burst': 10},
+    'render': {'weight': 4, 'rate_per_minute': 60, 'burst': 10},
+    'max': {'weight': 6, 'rate_per_minute': 60, 'burst': 20},
+}
+FREE_TIER = 'free'
+
+
+def load_generation_tiers() -> dict[str, TierPolicy]:
+    """Тарифы очереди; GENERATION_TIERS (JSON) переопределяет отдельные параметры:
+    {"free": {"concurrency": 4, "rate_per_minute": 2}}."""
+    params = {slug: dict(values) for slug, values in DEFAULT_GENERATION_TIERS.items()}
+    for slug, overrides in json.loads(os.getenv('GENERATION_TIERS') or '{}').items():
+        params.setdefault(slug, {}).update(overrides)
+    return {slug: TierPolicy(**values) for slug, values in params.items()}
+
+
+# Очередь генераций: запрос только ставит задачу, модель вызывается в фоне
+# GENERATION_ASYNC: генерации ждут модель в event loop и не держат потоки воркеров
+GENERATION_ASYNC = os.getenv('GENERATION_ASYNC', 'true').lower() == 'true'
+async_runtime = EventLoopThread('generation-loop')
+
+
+def generation_capacity() -> int:
+    """Сколько генераций идёт одновременно на деле: упор в ключи Stability, а не в слоты event loop."""
+    pool = get_stability_key_pool()
+    return len(pool) * pool.max_in_flight
+
+
+generation_queue = JobQueue(
+    workers=int(os.getenv('GENERATION_WORKERS', '4')),
+    maxsize=int(os.getenv('GENERATION_QUEUE_SIZE', '32')),
+    # Порог журнала медленных генераций, мс (0 — не писать)
+    slow_threshold=int(os.getenv('SLOW_GENERATION_MS', '0')) / 1000,
+    async_runner=async_runtime,
+    async_concurrency=int(os.getenv('GENERATION_ASYNC_CONCURRENCY', '256')),
+    tiers=load_generation_tiers(),
+    default_tier=FREE_TIER,
+    capacity=generation_capacity,
+)
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram('pizz_http_request_seconds', 'Время обработки HTTP-запроса, с', ('endpoint', 'method'))
+HTTP_REQUESTS = REGISTRY.counter('pizz_http_requests_total', 'HTTP-запросы по коду ответа', ('endpoint', 'method', 'status'))
+CHAT_REPLIES = REGISTRY.counter('pizz_chat_replies_total', 'Ответы чата по источнику', ('source',))
 
 PLANS = {
     'basic': {'name': 'Basic Set', 'price': '25$', 'description': '2D / 3D'},
@@ -62,6 +241,17 @@ PLANS = {
 }
 
 
+# Бюджет истории чата и кэш ответов на типовые вопросы
+chat_budget = ChatBudget(
+    build_system_prompt(PLANS, STYLE_LABELS),
+    token_budget=int(os.getenv('CHAT_HISTORY_TOKEN_BUDGET', '2000')),
+    cache=AnswerCache(
+        maxsize=int(os.getenv('CHAT_CACHE_SIZE', '256')),
+        ttl=float(os.getenv('CHAT_CACHE_TTL', '3600')),
+    ),
+)
+
+
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
 
@@ -73,17 +263,17 @@ class User(UserMixin, db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
     def set_password(self, raw_password: str) -> None:
-        self.password_hash = generate_password_hash(raw_password)
+        self.password_hash = password_hasher.hash(raw_password)
 
     def check_password(self, raw_password: str) -> bool:
-        return check_password_hash(self.password_hash, raw_password)
+        return password_hasher.verify(self.password_hash, raw_password)
 
 
 class Subscription(db.Model):
     __tablename__ = 'subscriptions'
 
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
     plan_slug = db.Column(db.String(32), nullable=False)
     plan_name = db.Column(db.String(64), nullable=False)
     card_holder = db.Column(db.String(128), nullable=False)
@@ -96,9 +286,102 @@ class Subscription(db.Model):
     user = db.relationship('User', backref=db.backref('subscriptions', lazy=True))
 
 
+class StoredFile(db.Model):
+    __tablename__ = 'stored_files'
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(16), nullable=False)  # upload / result
+    filename = db.Column(db.String(128), unique=True, nullable=False, index=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True, index=True)
+    size = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    last_access_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+
+# Колонки пользователя на несколько секунд кэшируются, чтобы не ходить в БД на каждый запрос
+user_cache = TTLCache(ttl=float(os.getenv('USER_CACHE_TTL', '30')))
+# Тариф пользователя для очереди генераций — тоже ненадолго, новая подписка сбрасывает запись
+plan_cache = TTLCache(ttl=float(os.getenv('USER_CACHE_TTL', '30')))
+
+
+class OutboxMessage(db.Model):
+    __tablename__ = 'outbox_messages'
+
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(255), nullable=False)
+    reply_to = db.Column(db.String(255), nullable=True)
+    subject = db.Column(db.String(255), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(16), nullable=False, default=OUTBOX_PENDING, index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.String(500), nullable=True)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+
+class GenerationJob(db.Model):
+    """Состояние задачи генерации. Очередь у каждого воркера своя, в памяти,
+    а статус и результат по /jobs/<id> должен отдать любой из них."""
+    __tablename__ = 'generation_jobs'
+
+    id = db.Column(db.String(32), primary_key=True)
+    batch_id = db.Column(db.String(32), nullable=True, index=True)
+    tier = db.Column(db.String(32), nullable=False)
+    status = db.Column(db.String(16), nullable=False, index=True)
+    error = db.Column(db.Text, nullable=True)
+    meta = db.Column(db.Text, nullable=False, default='{}')
+    # Время — секунды Unix, как у jobs.Job
+    created_at = db.Column(db.Float, nullable=False, index=True)
+    started_at = db.Column(db.Float, nullable=True)
+    finished_at = db.Column(db.Float, nullable=True)
+
+    def to_dict(self) -> dict:
+        data = {
+            'id': self.id,
+            'batch_id': self.batch_id,
+            'tier': self.tier,
+            'status': self.status,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+        data.update(json.loads(self.meta))
+        return data
+
+
 @login_manager.user_loader
 def load_user(user_id: str):
-    return db.session.get(User, int(user_id))
+    user_id = int(user_id)
+    columns = user_cache.get(user_id)
+    if columns is not None:
+        user = User(**columns)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+    user = db.session.get(User, user_id)
+    if user is not None:
+        user_cache.set(user_id, {column.key: getattr(user, column.key) for column in User.__table__.columns})
+    return user
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_cached_user(mapper, connection, target):
+    user_cache.invalidate(target.id)
+
+
+@event.listens_for(Subscription, 'after_insert')
+@event.listens_for(Subscription, 'after_update')
+@event.listens_for(Subscription, 'after_delete')
+def invalidate_cached_plan(mapper, connection, target):
+    plan_cache.invalidate(target.user_id)
+
+
+@bp.app_context_processor
+def inject_style_labels():
+    return {'style_labels': STYLE_LABELS}
 
 
 def validate_password(password: str) -> bool:
@@ -108,21 +391,46 @@ def validate_password(password: str) -> bool:
     return bool(PASSWORD_PATTERN.fullmatch(password))
 
 
+def auth_retry_after(email: str) -> float:
+    """Сколько секунд клиенту ждать перед следующей попыткой входа/регистрации (0 — можно)."""
+    wait = ip_auth_limiter.consume(f'{request.endpoint}:{request.remote_addr}')
+    if email:
+        wait = max(wait, email_auth_limiter.consume(f'{request.endpoint}:{email}'))
+    return wait
+
+
+def render_auth_throttled(template: str, wait: float):
+    flash('Слишком много попыток. Попробуйте через минуту.', 'error')
+    return render_template(template), 429, {'Retry-After': str(math.ceil(wait))}
+
+
+def generation_tier(user) -> str:
+    """Тариф очереди генераций: по последней подписке пользователя, иначе бесплатный."""
+    if not user.is_authenticated:
+        return FREE_TIER
+    slug = plan_cache.get(user.id)
+    if slug is None:
+        slug = (
+            db.session.query(Subscription.plan_slug)
+            .filter(Subscription.user_id == user.id)
+            .order_by(Subscription.created_at.desc(), Subscription.id.desc())
+            .limit(1)
+            .scalar()
+        ) or FREE_TIER
+        plan_cache.set(user.id, slug)
+    return slug
+
+
 def get_plan_by_slug(slug: str):
     if not slug:
         return None
     return PLANS.get(slug.lower())
 
 
-def send_contact_email(first_name: str, last_name: str, email: str, message: str) -> None:
-    smtp_server = os.getenv('SMTP_SERVER')
-    smtp_port = int(os.getenv('SMTP_PORT', '587'))
-    smtp_username = os.getenv('SMTP_USERNAME')
-    smtp_password = os.getenv('SMTP_PASSWORD')
-    recipient = os.getenv('CONTACT_EMAIL_TO') or smtp_username
-    use_tls = os.getenv('SMTP_USE_TLS', 'true').lower() == 'true'
-
-    if not all([smtp_server, smtp_port, smtp_username, smtp_password, recipient]):
+def enqueue_contact_email(first_name: str, last_name: str, email: str, message: str) -> OutboxMessage:
+    """Кладёт письмо в очередь отправки; само письмо уйдёт из фонового потока."""
+    recipient = os.getenv('CONTACT_EMAIL_TO') or os.getenv('SMTP_USERNAME')
+    if mail_sender is None or not recipient:
         raise RuntimeError(
             'SMTP настройки не заданы. Установите SMTP_SERVER, SMTP_PORT, '
             'SMTP_USERNAME, SMTP_PASSWORD и CONTACT_EMAIL_TO.'
@@ -136,35 +444,453 @@ def send_contact_email(first_name: str, last_name: str, email: str, message: str
         f"Сообщение:\n{message}"
     )
 
-    msg = EmailMessage()
-    msg['Subject'] = 'Контактная форма Pizz'
-    msg['From'] = smtp_username
-    msg['To'] = recipient
-    msg['Reply-To'] = email
-    msg.set_content(email_body)
+    outbox_message = OutboxMessage(
+        recipient=recipient,
+        reply_to=email,
+        subject='Контактная форма Pizz',
+        body=email_body,
+    )
+    db.session.add(outbox_message)
+    db.session.commit()
+    current_app.extensions['pizz_tasks']['outbox'].wake()
+    return outbox_message
 
-    with smtplib.SMTP(smtp_server, smtp_port, timeout=30) as server:
-        if use_tls:
-            server.starttls()
-        server.login(smtp_username, smtp_password)
-        server.send_message(msg)
 
+def build_outbox_email(row: OutboxMessage) -> EmailMessage:
+    msg = EmailMessage()
+    msg['Subject'] = row.subject
+    msg['From'] = mail_sender.username
+    msg['To'] = row.recipient
+    if row.reply_to:
+        msg['Reply-To'] = row.reply_to
+    msg.set_content(row.body)
+    return msg
+
+
+# Письмо в статусе «отправляется» дольше этого времени считается брошенным упавшим воркером
+OUTBOX_CLAIM_TIMEOUT = timedelta(minutes=10)
+
+
+def drain_outbox() -> dict:
+    """Отправляет накопившиеся письма пачками по одному SMTP-соединению."""
+    stats = {'sent': 0, 'retry': 0, 'failed': 0}
+    if mail_sender is None:
+        return stats
+    now = datetime.utcnow()
+    OutboxMessage.query.filter(
+        OutboxMessage.status == OUTBOX_SENDING,
+        OutboxMessage.claimed_at < now - OUTBOX_CLAIM_TIMEOUT,
+    ).update({OutboxMessage.status: OUTBOX_PENDING}, synchronize_session=False)
+    db.session.commit()
+
+    batch_size = current_app.config['OUTBOX_BATCH_SIZE']
+    while True:
+        rows = (
+            OutboxMessage.query
+            .filter(OutboxMessage.status == OUTBOX_PENDING, OutboxMessage.next_attempt_at <= now)
+            .order_by(OutboxMessage.next_attempt_at)
+            .limit(batch_size)
+            .all()
+        )
+        for row in rows:
+            # Забираем письмо атомарно: его мог уже взять поток другого воркера
+            claimed = OutboxMessage.query.filter_by(id=row.id, status=OUTBOX_PENDING).update(
+                {OutboxMessage.status: OUTBOX_SENDING, OutboxMessage.claimed_at: now},
+                synchronize_session=False,
+            )
+            db.session.commit()
+            if not claimed:
+                continue
+            try:
+                mail_sender.send(build_outbox_email(row))
+            except Exception as exc:
+                row.attempts += 1
+                row.last_error = str(exc)[:500]
+                if is_permanent_error(exc) or row.attempts >= current_app.config['OUTBOX_MAX_ATTEMPTS']:
+                    logger.error('Письмо %s не отправлено после %d попыток: %s', row.id, row.attempts, exc)
+                    row.status = OUTBOX_FAILED
+                    stats['failed'] += 1
+                else:
+                    logger.warning('Письмо %s не отправлено, повторим позже: %s', row.id, exc)
+                    row.status = OUTBOX_PENDING
+                    row.next_attempt_at = datetime.utcnow() + timedelta(seconds=retry_delay(row.attempts))
+                    stats['retry'] += 1
+                db.session.commit()
+                if is_connection_error(exc):
+                    # Сервер недоступен — остальные письма подождут следующего прохода
+                    return stats
+                continue
+            row.status = OUTBOX_SENT
+            row.sent_at = datetime.utcnow()
+            row.last_error = None
+            db.session.commit()
+            stats['sent'] += 1
+        if len(rows) < batch_size:
+            break
+    mail_sender.close_if_idle()
+    return stats
 
-def init_app():
-    """Инициализация приложения (миграции, подготовка БД и т.д.)."""
+
+def _run_outbox(app: Flask) -> None:
     with app.app_context():
-        db.create_all()
+        drain_outbox()
+
+
+CHAT_ERROR_MESSAGE = 'Не удалось получить ответ ассистента. Попробуйте позже.'
+
+
+class ChatRequestError(ValueError):
+    """Запрос к чату нельзя обработать; status — HTTP-код ответа."""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+def ndjson_line(data: dict) -> str:
+    return json.dumps(data, ensure_ascii=False) + '\n'
+
+
+def prepare_chat(payload: dict) -> tuple[list[dict], str | None, str | None]:
+    """Общая часть /chat для WSGI и ASGI: (сообщения для модели, вопрос, ответ из кэша)."""
+    messages = payload.get('messages')
+    if not messages:
+        raise ChatRequestError('Сообщение не должно быть пустым.')
 
+    # Закреплённый системный промпт + история, обрезанная до бюджета токенов
+    chat_messages, question = chat_budget.prepare([msg for msg in messages if isinstance(msg, dict)])
+    if len(chat_messages) < 2:
+        raise ChatRequestError('Сообщение не должно быть пустым.')
 
-@app.route('/')
+    # Типовые вопросы отвечаются из кэша без обращения к OpenAI
+    cached_reply = chat_budget.cached_answer(question)
+    if cached_reply is not None:
+        CHAT_REPLIES.inc(source='cache')
+    elif not openai_api_key:
+        raise ChatRequestError('OpenAI API не настроен.', 500)
+    return chat_messages, question, cached_reply
+
+
+_async_openai_clients: dict[int, 'AsyncOpenAI'] = {}
+
+
+def get_async_openai_client() -> 'AsyncOpenAI':
+    """AsyncOpenAI для текущего event loop (его пул соединений привязан к loop)."""
+    loop_id = id(asyncio.get_running_loop())
+    client = _async_openai_clients.get(loop_id)
+    if client is None:
+        from openai import AsyncOpenAI
+
+        client = AsyncOpenAI(api_key=openai_api_key, base_url=os.getenv('OPENAI_BASE_URL') or None)
+        _async_openai_clients[loop_id] = client
+    return client
+
+
+async def chat_reply_async(chat_messages: list[dict], question: str | None = None) -> str:
+    try:
+        with span('chat.openai'):
+            response = await get_async_openai_client().chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=chat_messages,
+            )
+    except Exception:
+        CHAT_REPLIES.inc(source='error')
+        raise
+    ai_reply = response.choices[0].message.content
+    chat_budget.remember(question, ai_reply, chat_messages)
+    CHAT_REPLIES.inc(source='openai')
+    return ai_reply
+
+
+async def stream_chat_reply_async(chat_messages: list[dict], question: str | None = None):
+    """Асинхронный вариант stream_chat_reply для ASGI-сервера."""
+    parts = []
+    try:
+        with span('chat.openai_stream'):
+            started = time.perf_counter()
+            stream = await get_async_openai_client().chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=chat_messages,
+                stream=True,
+            )
+            try:
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if not parts:
+                            observe_stage('chat.openai_first_token', time.perf_counter() - started)
+                        parts.append(delta)
+                        yield ndjson_line({'delta': delta})
+            finally:
+                # Клиент ушёл посреди ответа — закрываем соединение, модель перестаёт генерировать
+                await stream.close()
+        chat_budget.remember(question, ''.join(parts), chat_messages)
+        CHAT_REPLIES.inc(source='openai')
+        yield ndjson_line({'done': True})
+    except Exception as exc:
+        CHAT_REPLIES.inc(source='error')
+        logger.exception('Ошибка OpenAI: %s', exc)
+        yield ndjson_line({'error': CHAT_ERROR_MESSAGE})
+
+
+def stream_chat_reply(chat_messages: list[dict], question: str | None = None):
+    """Отдаёт ответ ассистента по частям: одна JSON-строка на фрагмент (NDJSON)."""
+    parts = []
+    try:
+        with span('chat.openai_stream'):
+            started = time.perf_counter()
+            stream = get_openai_client().chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=chat_messages,
+                stream=True,
+            )
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if not parts:
+                        observe_stage('chat.openai_first_token', time.perf_counter() - started)
+                    parts.append(delta)
+                    yield ndjson_line({'delta': delta})
+        chat_budget.remember(question, ''.join(parts), chat_messages)
+        CHAT_REPLIES.inc(source='openai')
+        yield ndjson_line({'done': True})
+    except Exception as exc:
+        CHAT_REPLIES.inc(source='error')
+        logger.exception('Ошибка OpenAI: %s', exc)
+        yield ndjson_line({'error': CHAT_ERROR_MESSAGE})
+
+
+def get_storage(kind: str) -> ShardedStorage:
+    """Хранилище загрузок ('upload') или результатов ('result') текущего приложения."""
+    return current_app.extensions['pizz_storage'][kind]
+
+
+# Как часто обновлять last_access_at одного файла — не чаще раза в час
+TOUCH_INTERVAL = timedelta(hours=1)
+
+
+def record_stored_file(kind: str, filename: str, size: int, owner_id: int | None) -> None:
+    try:
+        db.session.add(StoredFile(kind=kind, filename=filename, size=size, owner_id=owner_id))
+        db.session.commit()
+    except SQLAlchemyError as exc:
+        db.session.rollback()
+        logger.exception('Не удалось сохранить метаданные файла %s: %s', filename, exc)
+
+
+def touch_stored_file(filename: str) -> None:
+    now = datetime.utcnow()
+    try:
+        StoredFile.query.filter(
+            StoredFile.filename == filename,
+            StoredFile.last_access_at < now - TOUCH_INTERVAL,
+        ).update({StoredFile.last_access_at: now}, synchronize_session=False)
+        db.session.commit()
+    except SQLAlchemyError as exc:
+        db.session.rollback()
+        logger.warning('Не удалось обновить время доступа к %s: %s', filename, exc)
+
+
+def storage_usage(owner_id: int | None = None) -> dict:
+    """Занятое место по типам файлов: для пользователя или по всему сервису."""
+    query = db.session.query(StoredFile.kind, func.count(StoredFile.id), func.coalesce(func.sum(StoredFile.size), 0))
+    if owner_id is not None:
+        query = query.filter(StoredFile.owner_id == owner_id)
+    usage = {'files': 0, 'bytes': 0, 'by_kind': {}}
+    for kind, count, size in query.group_by(StoredFile.kind):
+        usage['by_kind'][kind] = {'files': count, 'bytes': int(size)}
+        usage['files'] += count
+        usage['bytes'] += int(size)
+    return usage
+
+
+def _evict_stored_files(rows) -> tuple[int, int]:
+    removed = freed = 0
+    for row in rows:
+        freed += get_storage(row.kind).delete(row.filename)
+        db.session.delete(row)
+        removed += 1
+    db.session.commit()
+    return removed, freed
+
+
+def _evict_over_quota(quota: int, owner_id: int | None = None) -> tuple[int, int]:
+    """Удаляет давно не открывавшиеся файлы, пока занятое место не уложится в quota."""
+    usage = storage_usage(owner_id)['bytes']
+    if usage <= quota:
+        return 0, 0
+    query = StoredFile.query
+    if owner_id is not None:
+        query = query.filter(StoredFile.owner_id == owner_id)
+    victims = []
+    for row in query.order_by(StoredFile.last_access_at).yield_per(500):
+        if usage <= quota:
+            break
+        victims.append(row)
+        usage -= row.size
+    return _evict_stored_files(victims)
+
+
+def collect_storage_garbage() -> dict:
+    """Удаляет устаревшие, сверхквотные и осиротевшие файлы загрузок и результатов,
+    а также старые записи о задачах генерации."""
+    now = datetime.utcnow()
+    stats = {}
+
+    jobs_cutoff = time.time() - current_app.config['JOB_RETENTION_HOURS'] * 3600
+    stats['jobs'] = GenerationJob.query.filter(GenerationJob.created_at < jobs_cutoff).delete(synchronize_session=False)
+    db.session.commit()
+
+    cutoff = now - timedelta(days=current_app.config['STORAGE_RETENTION_DAYS'])
+    stats['expired'] = _evict_stored_files(StoredFile.query.filter(StoredFile.last_access_at < cutoff).all())
+
+    removed = freed = 0
+    user_quota = current_app.config['STORAGE_USER_QUOTA_BYTES']
+    heavy_owners = (
+        db.session.query(StoredFile.owner_id)
+        .filter(StoredFile.owner_id.isnot(None))
+        .group_by(StoredFile.owner_id)
+        .having(func.sum(StoredFile.size) > user_quota)
+    )
+    for (owner_id,) in heavy_owners.all():
+        user_removed, user_freed = _evict_over_quota(user_quota, owner_id)
+        removed += user_removed
+        freed += user_freed
+    stats['user_quota'] = (removed, freed)
+    stats['total_quota'] = _evict_over_quota(current_app.config['STORAGE_QUOTA_BYTES'])
+
+    # Файлы без записи в БД (например, загрузки упавших запросов) старше грейс-периода.
+    # Файлы старше самой ранней записи сохранены до учёта в БД: их не трогаем,
+    # пока init-db не заведёт для них записи, а без записей не трогаем ничего
+    removed = freed = 0
+    first_recorded = db.session.query(func.min(StoredFile.created_at)).scalar()
+    if first_recorded is not None:
+        since = first_recorded.replace(tzinfo=timezone.utc).timestamp()
+        grace_cutoff = now - timedelta(hours=current_app.config['STORAGE_ORPHAN_GRACE_HOURS'])
+        window = (since, grace_cutoff.replace(tzinfo=timezone.utc).timestamp())
+        for storage in current_app.extensions['pizz_storage'].values():
+            batch = []
+            for item in storage.iter_files():
+                batch.append(item)
+                if len(batch) >= 500:
+                    removed, freed = _remove_orphans(storage, batch, window, removed, freed)
+                    batch = []
+            removed, freed = _remove_orphans(storage, batch, window, removed, freed)
+    stats['orphans'] = (removed, freed)
+
+    logger.info('Очистка хранилища (файлов, байт): %s', stats)
+    return stats
+
+
+def _known_filenames(batch: list) -> set[str]:
+    names = [name for name, _, _, _ in batch]
+    return {row.filename for row in StoredFile.query.filter(StoredFile.filename.in_(names)).with_entities(StoredFile.filename)}
+
+
+def _remove_orphans(storage: ShardedStorage, batch: list, window: tuple[float, float], removed: int, freed: int) -> tuple[int, int]:
+    if not batch:
+        return removed, freed
+    known = _known_filenames(batch)
+    for name, path, size, mtime in batch:
+        # Удаляются только файлы, изменённые между началом учёта и концом грейс-периода
+        if name in known or not window[0] <= mtime <= window[1]:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        removed += 1
+        freed += size
+    return removed, freed
+
+
+def backfill_stored_files() -> int:
+    """Заводит записи для файлов, сохранённых до учёта в БД, — иначе очистка сочтёт их сиротами."""
+    now = datetime.utcnow()
+    added = 0
+    for kind, storage in current_app.extensions['pizz_storage'].items():
+        seen: set[str] = set()
+        batch = []
+        for item in storage.iter_files():
+            batch.append(item)
+            if len(batch) >= 500:
+                added += _backfill_batch(kind, batch, seen, now)
+                batch = []
+        added += _backfill_batch(kind, batch, seen, now)
+    return added
+
+
+def _backfill_batch(kind: str, batch: list, seen: set[str], now: datetime) -> int:
+    if not batch:
+        return 0
+    known = _known_filenames(batch)
+    added = 0
+    for name, _, size, mtime in batch:
+        if name in known or name in seen:
+            continue
+        seen.add(name)
+        # Срок хранения отсчитывается от переноса в учёт, а не от даты файла
+        db.session.add(StoredFile(
+            kind=kind, filename=name, size=size, created_at=datetime.utcfromtimestamp(mtime), last_access_at=now,
+        ))
+        added += 1
+    db.session.commit()
+    return added
+
+
+# Файл-блокировка очистки: её выполняет один воркер за интервал
+STORAGE_GC_LOCK = '.storage-gc.lock'
+
+
+def _storage_gc_lock(app: Flask, interval: float) -> ExclusiveRun:
+    return ExclusiveRun(os.path.join(app.config['RESULT_FOLDER'], STORAGE_GC_LOCK), interval)
+
+
+def _run_storage_gc(app: Flask) -> None:
+    def collect():
+        with app.app_context():
+            collect_storage_garbage()
+
+    _storage_gc_lock(app, app.config['STORAGE_GC_INTERVAL'])(collect)
+
+
+def init_db() -> None:
+    """Создаёт таблицы и недостающие индексы (команда flask init-db, не при импорте)."""
+    db.create_all()
+    # create_all не добавляет индексы в уже существующие таблицы
+    for index in Subscription.__table__.indexes:
+        index.create(bind=db.engine, checkfirst=True)
+    added = backfill_stored_files()
+    if added:
+        logger.info('Заведены записи для %s файлов, сохранённых до учёта в БД', added)
+
+
+_style_warmup_started = False
+
+
+def warm_up_style_assets() -> None:
+    """Пережимает референсы стилей в фоне, чтобы первая генерация не ждала, а старт не тормозил."""
+    global _style_warmup_started
+    if _style_warmup_started:
+        return
+    _style_warmup_started = True
+    threading.Thread(target=get_style_assets, args=(BASE_DIR,), name='style-assets', daemon=True).start()
+
+
+@bp.route('/')
+@cached_page
 def index():
     return render_template('index.html')
 
 
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
     if request.method == 'POST':
         first_name = request.form.get('first_name', '').strip()
@@ -173,6 +899,10 @@ def register():
         password = request.form.get('password')
         confirm_password = request.form.get('confirm_password')
 
+        wait = auth_retry_after(email)
+        if wait:
+            return render_auth_throttled('register.html', wait)
+
         if not all([first_name, email, password, confirm_password]):
             flash('Заполните обязательные поля.', 'error')
             return render_template('register.html')
@@ -194,7 +924,11 @@ def register():
             return render_template('register.html')
 
         new_user = User(first_name=first_name, last_name=last_name, email=email)
-        new_user.set_password(password)
+        try:
+            new_user.set_password(password)
+        except HasherBusyError:
+            flash('Сервис перегружен, попробуйте через минуту.', 'error')
+            return render_template('register.html'), 503
 
         try:
             db.session.add(new_user)
@@ -206,26 +940,44 @@ def register():
             return render_template('register.html')
 
         flash('Регистрация успешна! Теперь вы можете войти.', 'success')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     return render_template('register.html')
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
     if request.method == 'POST':
         email = request.form.get('email', '').strip().lower()
         password = request.form.get('password')
 
+        wait = auth_retry_after(email)
+        if wait:
+            return render_auth_throttled('login.html', wait)
+
         user = User.query.filter_by(email=email).first()
-        if user and user.check_password(password):
+        try:
+            authenticated = bool(user) and user.check_password(password)
+            if authenticated and password_hasher.needs_rehash(user.password_hash):
+                # Параметры хэширования поменялись — перехэшируем, пока пароль известен
+                user.set_password(password)
+                try:
+                    db.session.commit()
+                except SQLAlchemyError as exc:
+                    db.session.rollback()
+                    logger.warning('Не удалось обновить хэш пароля пользователя %s: %s', user.id, exc)
+        except HasherBusyError:
+            flash('Сервис перегружен, попробуйте через минуту.', 'error')
+            return render_template('login.html'), 503
+
+        if authenticated:
             login_user(user)
             flash('Вход выполнен успешно!', 'success')
             next_page = request.args.get('next')
-            return redirect(next_page or url_for('index'))
+            return redirect(next_page or url_for('main.index'))
 
         flash('Неверный email или пароль.', 'error')
         return render_template('login.html')
@@ -233,15 +985,15 @@ def login():
     return render_template('login.html')
 
 
-@app.route('/logout')
+@bp.route('/logout')
 @login_required
 def logout():
     logout_user()
     flash('Вы вышли из аккаунта.', 'success')
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
 
-@app.route('/contact', methods=['GET', 'POST'])
+@bp.route('/contact', methods=['GET', 'POST'])
 @login_required
 def contact():
     if request.method == 'POST':
@@ -252,31 +1004,32 @@ def contact():
             return render_template('contact.html')
 
         try:
-            send_contact_email(
+            enqueue_contact_email(
                 current_user.first_name,
                 current_user.last_name,
                 current_user.email,
                 message,
             )
-        except Exception as exc:
-            logger.exception('Не удалось отправить письмо: %s', exc)
+        except (RuntimeError, SQLAlchemyError) as exc:
+            db.session.rollback()
+            logger.exception('Не удалось поставить письмо в очередь: %s', exc)
             flash('Не удалось отправить сообщение. Проверьте настройки почты и попробуйте снова.', 'error')
             return render_template('contact.html')
 
         flash('Ваше сообщение отправлено! Мы свяжемся с вами в ближайшее время.', 'success')
-        return redirect(url_for('contact'))
+        return redirect(url_for('main.contact'))
 
     return render_template('contact.html')
 
 
-@app.route('/subscribe', methods=['GET', 'POST'])
+@bp.route('/subscribe', methods=['GET', 'POST'])
 @login_required
 def subscribe():
     plan_slug = request.args.get('plan') or request.form.get('plan')
     plan = get_plan_by_slug(plan_slug)
     if not plan:
         flash('Выберите тариф перед оформлением подписки.', 'error')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     plan_slug = plan_slug.lower()
 
     if request.method == 'POST':
@@ -333,55 +1086,197 @@ def subscribe():
             return render_template('subscribe.html', plan=plan, plan_slug=plan_slug, form_data=request.form)
 
         flash('Проверяем данные, подождите, мы напишем вам.', 'success')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
     return render_template('subscribe.html', plan=plan, plan_slug=plan_slug, form_data=None)
 
 
-@app.route('/chat', methods=['POST'])
+@bp.route('/chat', methods=['POST'])
 def chat():
     payload = request.get_json(silent=True) or {}
-    messages = payload.get('messages')
-
-    if not messages:
-        return jsonify({'error': 'Сообщение не должно быть пустым.'}), 400
-
-    if not openai_client:
-        return jsonify({'error': 'OpenAI API не настроен.'}), 500
-
     try:
-        # Формируем список сообщений для OpenAI API
-        chat_messages = [
-            {'role': msg.get('role', 'user'), 'content': msg.get('content', '')} 
-            for msg in messages
-        ]
-        
-        response = openai_client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=chat_messages,
+        chat_messages, question, cached_reply = prepare_chat(payload)
+    except ChatRequestError as exc:
+        return jsonify({'error': str(exc)}), exc.status
+
+    if cached_reply is not None:
+        if payload.get('stream'):
+            lines = [ndjson_line({'delta': cached_reply}), ndjson_line({'done': True})]
+            return Response(lines, mimetype='application/x-ndjson', headers={'Cache-Control': 'no-cache'})
+        return jsonify({'reply': cached_reply})
+
+    if payload.get('stream'):
+        return Response(
+            stream_with_context(stream_chat_reply(chat_messages, question)),
+            mimetype='application/x-ndjson',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
         )
+
+    try:
+        with span('chat.openai'):
+            response = get_openai_client().chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=chat_messages,
+            )
         ai_reply = response.choices[0].message.content
+        chat_budget.remember(question, ai_reply, chat_messages)
+        CHAT_REPLIES.inc(source='openai')
         return jsonify({'reply': ai_reply})
     except Exception as exc:
+        CHAT_REPLIES.inc(source='error')
         logger.exception('Ошибка OpenAI: %s', exc)
-        return jsonify({'error': 'Не удалось получить ответ ассистента. Попробуйте позже.'}), 500
+        return jsonify({'error': CHAT_ERROR_MESSAGE}), 500
+
+
+def _metrics_authorized() -> bool:
+    token = os.getenv('METRICS_TOKEN')
+    return not token or request.headers.get('Authorization') == f'Bearer {token}'
+
+
+def internal_stats(view):
+    """Служебная статистика: только с токеном METRICS_TOKEN, без токена маршрут закрыт."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not os.getenv('METRICS_TOKEN'):
+            abort(404)
+        if not _metrics_authorized():
+            abort(401)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@bp.route('/chat/stats')
+@internal_stats
+def chat_stats():
+    return jsonify(chat_budget.stats())
 
 
-@app.route('/forgot-password', methods=['GET', 'POST'])
+@bp.route('/forgot-password', methods=['GET', 'POST'])
+@cached_page
 def forgot_password():
     if request.method == 'POST':
         email = request.form.get('email')
         # Здесь должна быть логика отправки email для восстановления пароля
         flash('Инструкции по восстановлению пароля отправлены на ваш email.', 'success')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     return render_template('forgot_password.html')
 
 
-@app.route('/generate', methods=['GET', 'POST'])
+def _record_result(app: Flask, result: str, owner_id: int | None) -> None:
+    data = file_writer.read(result)
+    size = len(data) if data is not None else os.path.getsize(result)
+    with app.app_context():
+        record_stored_file('result', os.path.basename(result), size, owner_id)
+
+
+def run_generation(app: Flask, owner_id: int | None, *args, **kwargs) -> str | None:
+    """Задача очереди: генерация и учёт результата в хранилище."""
+    result = generate_interior(*args, **kwargs)
+    if result:
+        _record_result(app, result, owner_id)
+    return result
+
+
+async def run_generation_async(app: Flask, owner_id: int | None, *args, **kwargs) -> str | None:
+    """То же, что run_generation, но в event loop: поток не ждёт ответа модели."""
+    result = await generate_interior_async(*args, **kwargs)
+    if result:
+        await asyncio.to_thread(_record_result, app, result, owner_id)
+    return result
+
+
+def save_job_state(app: Flask, job: Job) -> None:
+    """on_change задач генерации: состояние уходит в БД, откуда его прочитает любой воркер."""
+    if job.status == JOB_DONE:
+        # Другие воркеры отдают результат только с диска — «готово» после фоновой записи
+        file_writer.flush()
+    with app.app_context():
+        db.session.merge(GenerationJob(
+            id=job.id,
+            batch_id=job.batch_id,
+            tier=job.tier,
+            status=job.status,
+            error=job.error,
+            meta=json.dumps(job.meta, ensure_ascii=False),
+            created_at=job.created_at,
+            started_at=job.started_at,
+            finished_at=job.finished_at,
+        ))
+        db.session.commit()
+
+
+def job_state(job_id: str) -> dict | None:
+    """Задача из очереди этого процесса, иначе из БД — её мог принять другой воркер."""
+    job = generation_queue.get(job_id)
+    if job is not None:
+        data = job.to_dict()
+        data['position'] = generation_queue.position(job)
+        return data
+    row = db.session.get(GenerationJob, job_id)
+    if row is None:
+        return None
+    data = row.to_dict()
+    data['position'] = 0
+    if row.status == JOB_QUEUED:
+        data['position'] = db.session.query(func.count(GenerationJob.id)).filter(
+            GenerationJob.status == JOB_QUEUED,
+            GenerationJob.tier == row.tier,
+            GenerationJob.created_at < row.created_at,
+        ).scalar()
+    return data
+
+
+def batch_state(batch_id: str) -> list[dict] | None:
+    jobs = generation_queue.get_batch(batch_id)
+    if jobs is not None:
+        return [job.to_dict() for job in jobs]
+    rows = GenerationJob.query.filter_by(batch_id=batch_id).order_by(GenerationJob.created_at).all()
+    return [row.to_dict() for row in rows] or None
+
+
+def build_generation_call(
+    style: str,
+    user_prompt: str,
+    image_bytes: bytes,
+    upload_path: str,
+    unique_id: str,
+    owner_id: int | None = None,
+    suffix: str = '',
+):
+    """Собирает (func, args, kwargs, meta) задачи генерации для одного стиля."""
+    # Получаем промпт для стиля
+    prompt = build_prompt(style, user_prompt)
+    
+    result_filename = f"result_{unique_id}{suffix}.webp"
+    result_path = get_storage('result').path(result_filename, create=True)
+    # Кэш один на все шарды: папка результата у каждой генерации своя
+    kwargs = {'image_bytes': image_bytes, 'writer': file_writer, 'cache_dir': current_app.config['RESULT_CACHE_DIR']}
+    meta = {
+        'style': style,
+        'style_label': STYLE_LABELS.get(style, style),
+        'result_url': f"/results/{result_filename}",
+        'source_url': f"/uploads/{os.path.basename(upload_path)}",
+    }
+    func = run_generation_async if GENERATION_ASYNC else run_generation
+    app = current_app._get_current_object()
+    return func, (app, owner_id, prompt, upload_path, result_path, style, BASE_DIR), kwargs, meta
+
+
+def render_generation_rejected(exc: QueueFullError):
+    """429 при исчерпанной квоте тарифа, 503 при перегрузке очереди — оба с Retry-After."""
+    if isinstance(exc, QuotaExceededError):
+        error, status = 'Слишком много генераций подряд. Попробуйте через минуту.', 429
+    else:
+        error, status = 'Сервис перегружен, попробуйте через минуту.', 503
+    return render_template('generate.html', error=error), status, {'Retry-After': str(max(1, math.ceil(exc.retry_after)))}
+
+
+@bp.route('/generate', methods=['GET', 'POST'])
+@cached_page
 def generate():
     # Создаем папки для загрузок и результатов, если их нет
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-    os.makedirs(app.config['RESULT_FOLDER'], exist_ok=True)
+    os.makedirs(current_app.config['UPLOAD_FOLDER'], exist_ok=True)
+    os.makedirs(current_app.config['RESULT_FOLDER'], exist_ok=True)
     
     if request.method == 'POST':
         # Проверяем наличие файла
@@ -394,57 +1289,249 @@ def generate():
         
         style = request.form.get('style', 'scandinavian')
         user_prompt = request.form.get('prompt', '').strip()
+        # Несколько отмеченных стилей — пакетная генерация одного чертежа
+        styles = [s for s in dict.fromkeys(request.form.getlist('styles')) if s in STYLE_LABELS]
         
-        # Получаем промпт для стиля
-        style_prompt = get_style_prompt(style)
-        if user_prompt:
-            prompt = f"{style_prompt}\nAdditional requirements: {user_prompt}".strip()
-        else:
-            prompt = style_prompt
+        # Очередь и квота — по тарифу; квота считается на пользователя, для анонимов — на IP.
+        # Проверяются до разбора чертежа и записи на диск: отказ не должен стоить работы
+        owner_id = current_user.id if current_user.is_authenticated else None
+        tier = generation_tier(current_user)
+        client = f'user:{owner_id}' if owner_id else f'ip:{request.remote_addr}'
+        try:
+            generation_queue.admit(len(styles) if len(styles) > 1 else 1, tier=tier, client=client)
+        except QueueFullError as exc:
+            return render_generation_rejected(exc)
         
-        # Сохраняем загруженный файл
-        unique_id = uuid.uuid4().hex
-        file_ext = os.path.splitext(blueprint_file.filename)[1]
-        upload_filename = f"blueprint_{unique_id}{file_ext}"
-        upload_path = os.path.join(app.config['UPLOAD_FOLDER'], upload_filename)
-        blueprint_file.save(upload_path)
+        # Проверяем и уменьшаем чертёж до отправки в модель
+        try:
+            with span('generate.preprocess'):
+                blueprint = preprocess_blueprint(
+                    blueprint_file.read(),
+                    max_side=current_app.config['BLUEPRINT_MAX_SIDE'],
+                    binarize=current_app.config['BLUEPRINT_BINARIZE'],
+                )
+        except InvalidBlueprintError:
+            return render_template('generate.html', error='Загрузите чертёж в виде изображения (PNG, JPG, WebP).'), 400
         
-        # Генерируем результат
-        result_filename = f"result_{unique_id}.webp"
-        result_path = os.path.join(app.config['RESULT_FOLDER'], result_filename)
+        # Архивная копия пишется в фоне, генератор получает байты из памяти
+        unique_id = uuid.uuid4().hex
+        upload_filename = f"blueprint_{unique_id}.{blueprint.extension}"
+        upload_path = get_storage('upload').path(upload_filename)
+        with span('generate.store_upload'):
+            file_writer.write(upload_path, blueprint.data)
+            record_stored_file('upload', upload_filename, len(blueprint.data), owner_id)
         
+        # Ставим генерацию в очередь и сразу отдаём страницу ожидания
+        on_change = partial(save_job_state, current_app._get_current_object())
         try:
-            generated = generate_interior(prompt, upload_path, result_path, style, BASE_DIR)
-            
-            if generated:
-                context = {
-                    'result_url': f"/results/{result_filename}",
-                    'source_url': f"/uploads/{upload_filename}",
-                }
-                return render_template('result.html', **context)
-            else:
-                return render_template('generate.html', error='Ошибка генерации. Проверьте ключ API.')
-        except Exception as e:
-            logger.exception('Ошибка при генерации интерьера: %s', e)
-            return render_template('generate.html', error=f'Ошибка генерации: {str(e)}')
+            with span('generate.enqueue'):
+                if len(styles) > 1:
+                    batch_id = generation_queue.submit_batch([
+                        build_generation_call(style, user_prompt, blueprint.data, upload_path, unique_id, owner_id, suffix=f"_{style}")
+                        for style in styles
+                    ], tier=tier, on_change=on_change)
+                    return redirect(url_for('main.batch_result', batch_id=batch_id))
+                func, args, kwargs, meta = build_generation_call(
+                    styles[0] if styles else style, user_prompt, blueprint.data, upload_path, unique_id, owner_id,
+                )
+                job = generation_queue.submit(func, *args, meta=meta, tier=tier, on_change=on_change, **kwargs)
+        except QueueFullError as exc:
+            # Очередь успела заполниться после admit(): квота за непринятый запрос возвращается
+            generation_queue.refund(tier, client)
+            return render_generation_rejected(exc)
+        
+        return redirect(url_for('main.job_result', job_id=job.id))
     
     return render_template('generate.html')
 
 
-@app.route('/uploads/<filename>')
+@bp.route('/jobs/stats')
+@internal_stats
+def job_stats():
+    """Очередь, выполняющиеся генерации и ожидание по тарифам; попадания в кэш результатов этого процесса."""
+    cache = get_result_cache(current_app.config['RESULT_CACHE_DIR'])
+    return jsonify({'tiers': generation_queue.stats(), 'result_cache': cache.stats() if cache else None})
+
+
+@bp.route('/jobs/<job_id>')
+def job_status(job_id):
+    data = job_state(job_id)
+    if not data:
+        return jsonify({'error': 'Задача не найдена.'}), 404
+    if data['status'] != JOB_DONE:
+        data.pop('result_url', None)
+    return jsonify(data)
+
+
+@bp.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    data = job_state(job_id)
+    if not data:
+        return render_template('generate.html', error='Задача не найдена или устарела.'), 404
+    return render_template('result.html', job=data)
+
+
+@bp.route('/batches/<batch_id>')
+def batch_status(batch_id):
+    jobs = batch_state(batch_id)
+    if not jobs:
+        return jsonify({'error': 'Пакет не найден.'}), 404
+    for data in jobs:
+        if data['status'] != JOB_DONE:
+            data.pop('result_url', None)
+    return jsonify({
+        'id': batch_id,
+        'finished': all(data['status'] in (JOB_DONE, JOB_FAILED) for data in jobs),
+        'jobs': jobs,
+    })
+
+
+@bp.route('/batches/<batch_id>/result')
+def batch_result(batch_id):
+    jobs = batch_state(batch_id)
+    if not jobs:
+        return render_template('generate.html', error='Пакет не найден или устарел.'), 404
+    return render_template('batch.html', batch_id=batch_id, jobs=jobs)
+
+
+def send_stored_file(storage: ShardedStorage, filename: str):
+    """Отдаёт файл с диска или из памяти, если фоновая запись ещё не закончилась."""
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    data = file_writer.read(storage.path(filename))
+    if data is not None:
+        return Response(data, mimetype=mimetype)
+    path = storage.locate(filename)
+    if path is None:
+        abort(404)
+    touch_stored_file(filename)
+    return send_file(path, mimetype=mimetype)
+
+
+@bp.route('/uploads/<filename>')
 def uploaded_file(filename):
-    from flask import send_from_directory
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_stored_file(get_storage('upload'), filename)
 
 
-@app.route('/results/<filename>')
+@bp.route('/results/<filename>')
 def result_file(filename):
-    from flask import send_from_directory
-    return send_from_directory(app.config['RESULT_FOLDER'], filename)
+    return send_stored_file(get_storage('result'), filename)
 
-init_app()
+
+@bp.route('/storage/usage')
+@internal_stats
+def storage_usage_view():
+    """Занятое место по всему сервису, с ?user_id= — ещё и для одного пользователя."""
+    user_id = request.args.get('user_id', type=int)
+    return jsonify({'user': storage_usage(user_id) if user_id else None, 'total': storage_usage()})
+
+
+@bp.before_app_request
+def start_background_tasks():
+    for task in current_app.extensions['pizz_tasks'].values():
+        task.ensure_started()
+    warm_up_style_assets()
+
+
+@bp.before_app_request
+def start_request_trace():
+    start_trace(f'{request.method} {request.path}')
+
+
+@bp.after_app_request
+def remember_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+
+@bp.teardown_app_request
+def finish_request_trace(exc):
+    trace = end_trace()
+    if trace is None:
+        return
+    endpoint = request.endpoint or 'unknown'
+    elapsed = trace.elapsed
+    HTTP_REQUEST_SECONDS.observe(elapsed, endpoint=endpoint, method=request.method)
+    HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=g.get('response_status', 500))
+    log_if_slow(trace, current_app.config['SLOW_REQUEST_MS'] / 1000, logger, elapsed)
+
+
+@bp.route('/metrics')
+def metrics_view():
+    if not _metrics_authorized():
+        abort(401)
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+@bp.cli.command('storage-gc')
+def storage_gc_command():
+    """Однократная очистка хранилища загрузок и результатов."""
+    stats = {}
+    if not _storage_gc_lock(current_app, 0)(lambda: stats.update(collect_storage_garbage())):
+        print('Очистка уже выполняется в другом процессе.')
+        return
+    print(stats)
+
+
+@bp.cli.command('outbox-drain')
+def outbox_drain_command():
+    """Однократная отправка накопившихся писем контактной формы."""
+    print(drain_outbox())
+
+
+@bp.cli.command('page-cache-clear')
+def page_cache_clear_command():
+    """Сброс кэша страниц (например, после обновления шаблонов или статики)."""
+    cache = current_app.extensions['pizz_page_cache']
+    print(cache.invalidate() if cache is not None else 0)
+
+
+@bp.cli.command('init-db')
+def init_db_command():
+    """Создание таблиц и индексов базы данных."""
+    init_db()
+    print('База данных готова.')
+
+
+def create_app(config: dict | None = None) -> Flask:
+    """Собирает приложение. Клиенты OpenAI/Stability и референсы стилей создаются
+    позже, при первом использовании, а схема БД — командой flask init-db."""
+    app = Flask(__name__)
+    app.config.update(load_config())
+    if config:
+        app.config.update(config)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+    if not app.config.get('RESULT_CACHE_DIR'):
+        app.config['RESULT_CACHE_DIR'] = os.path.join(app.config['RESULT_FOLDER'], 'cache')
+
+    # Адрес клиента за прокси — для ограничителей входа и очереди генераций по IP
+    if app.config['TRUSTED_PROXIES'] > 0:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'], x_proto=app.config['TRUSTED_PROXIES'])
+
+    init_assets(app, os.path.join(BASE_DIR, 'static'))
+    db.init_app(app)
+    login_manager.init_app(app)
+    app.register_blueprint(bp)
+
+    # Загрузки и результаты раскладываются по подпапкам по хэшу имени
+    app.extensions['pizz_storage'] = {
+        'upload': ShardedStorage(app.config['UPLOAD_FOLDER']),
+        'result': ShardedStorage(app.config['RESULT_FOLDER']),
+    }
+    app.extensions['pizz_page_cache'] = PageCache.from_config(app.config)
+    # Фоновые потоки стартуют с первым запросом, уже после fork() воркера
+    app.extensions['pizz_tasks'] = {
+        'storage_gc': PeriodicTask(partial(_run_storage_gc, app), app.config['STORAGE_GC_INTERVAL'], 'storage-gc'),
+        'outbox': PeriodicTask(partial(_run_outbox, app), app.config['OUTBOX_INTERVAL'], 'mail-outbox'),
+    }
+    # При остановке воркера начатая очистка или рассылка доходит до конца, а не обрывается на полпути
+    for task in app.extensions['pizz_tasks'].values():
+        atexit.register(task.stop)
+    return app
 
 
 if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        init_db()
     app.run(debug=True)
 
@@ -0,0 +1,172 @@
+"""ASGI-точка входа::
+
+    uvicorn asgi:application --workers 2
+
+/chat обслуживается прямо в event loop сервера через AsyncOpenAI: ожидание
+ответа модели не занимает поток, и один процесс держит сотни разговоров.
+Остальные маршруты отдаёт Flask-приложение: до ASGI_WSGI_THREADS
+(по умолчанию 32) запросов одновременно, каждый в своём потоке — как
+воркер gunicorn с потоками.
+"""
+import asyncio
+import json
+import os
+
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+
+from app import (
+    CHAT_ERROR_MESSAGE,
+    HTTP_REQUEST_SECONDS,
+    HTTP_REQUESTS,
+    ChatRequestError,
+    chat_reply_async,
+    create_app,
+    logger,
+    ndjson_line,
+    prepare_chat,
+    stream_chat_reply_async,
+)
+from metrics import end_trace, log_if_slow, start_trace
+
+app = create_app()
+
+class PooledWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgi, выполняющий до max_threads запросов параллельно.
+
+    asgiref запускает WSGI-приложение thread_sensitive, то есть в одном общем
+    потоке на процесс: запросы к Flask шли бы строго по одному. Внутри
+    ThreadSensitiveContext у каждого запроса свой поток, как в Django.
+    """
+
+    def __init__(self, wsgi_application, max_threads: int):
+        super().__init__(wsgi_application)
+        self._slots = asyncio.Semaphore(max_threads)
+
+    async def __call__(self, scope, receive, send):
+        async with self._slots, ThreadSensitiveContext():
+            await super().__call__(scope, receive, send)
+
+
+flask_application = PooledWsgiToAsgi(app, int(os.getenv('ASGI_WSGI_THREADS', '32')))
+
+
+class _ClientDisconnected(Exception):
+    pass
+
+
+async def _read_body(receive, limit: int) -> bytes:
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise _ClientDisconnected()
+        body += message.get('body', b'')
+        if len(body) > limit:
+            raise ChatRequestError('Слишком большой запрос.', 413)
+        if not message.get('more_body'):
+            return body
+
+
+async def _wait_disconnect(receive) -> None:
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def _stream_lines(receive, send, lines) -> bool:
+    """Отправляет строки по мере готовности; False, если клиент ушёл раньше конца.
+
+    Тогда генератор закрывается, и ответ модели дальше не запрашивается.
+    """
+    disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+    try:
+        async for line in lines:
+            if disconnected.done():
+                return False
+            await send({'type': 'http.response.body', 'body': line.encode(), 'more_body': True})
+    finally:
+        disconnected.cancel()
+        await lines.aclose()
+    await send({'type': 'http.response.body', 'body': b''})
+    return True
+
+
+async def _start_response(send, status: int, content_type: str, extra_headers: list | None = None) -> None:
+    headers = [(b'content-type', content_type.encode()), (b'cache-control', b'no-cache')]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers + (extra_headers or [])})
+
+
+async def _send_json(send, status: int, data: dict) -> None:
+    await _start_response(send, status, 'application/json')
+    await send({'type': 'http.response.body', 'body': json.dumps(data, ensure_ascii=False).encode()})
+
+
+async def _chat(receive, send) -> int:
+    try:
+        body = await _read_body(receive, app.config['MAX_CONTENT_LENGTH'])
+    except _ClientDisconnected:
+        return 499  # клиент ушёл, не дослав запрос: отвечать некому
+    except ChatRequestError as exc:
+        await _send_json(send, exc.status, {'error': str(exc)})
+        return exc.status
+    try:
+        payload = json.loads(body) if body else {}
+    except ValueError:
+        payload = {}
+    if not isinstance(payload, dict):
+        payload = {}
+    try:
+        chat_messages, question, cached_reply = prepare_chat(payload)
+    except ChatRequestError as exc:
+        await _send_json(send, exc.status, {'error': str(exc)})
+        return exc.status
+
+    if payload.get('stream'):
+        await _start_response(send, 200, 'application/x-ndjson', [(b'x-accel-buffering', b'no')])
+        if cached_reply is not None:
+            lines = [ndjson_line({'delta': cached_reply}), ndjson_line({'done': True})]
+            await send({'type': 'http.response.body', 'body': ''.join(lines).encode()})
+            return 200
+        if not await _stream_lines(receive, send, stream_chat_reply_async(chat_messages, question)):
+            return 499
+        return 200
+
+    if cached_reply is not None:
+        await _send_json(send, 200, {'reply': cached_reply})
+        return 200
+    try:
+        ai_reply = await chat_reply_async(chat_messages, question)
+    except Exception as exc:
+        logger.exception('Ошибка OpenAI: %s', exc)
+        await _send_json(send, 500, {'error': CHAT_ERROR_MESSAGE})
+        return 500
+    await _send_json(send, 200, {'reply': ai_reply})
+    return 200
+
+
+async def _lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] == 'http' and scope['path'] == '/chat' and scope['method'] == 'POST':
+        trace = start_trace('POST /chat')
+        status = 500
+        try:
+            status = await _chat(receive, send)
+        finally:
+            end_trace()
+            HTTP_REQUEST_SECONDS.observe(trace.elapsed, endpoint='main.chat', method='POST')
+            HTTP_REQUESTS.inc(endpoint='main.chat', method='POST', status=status)
+            log_if_slow(trace, app.config['SLOW_REQUEST_MS'] / 1000, logger)
+        return
+    await flask_application(scope, receive, send)
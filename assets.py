@@ -0,0 +1,187 @@
+"""Сборка статики: адаптивные варианты картинок, сжатие и отпечатки имён.
+
+Запуск перед деплоем::
+
+    python assets.py
+
+Результат складывается в static/dist вместе с manifest.json; шаблоны
+берут адреса через asset_url() и picture(). Без сборки используются
+исходные файлы из static/.
+"""
+import gzip
+import hashlib
+import io
+import json
+import logging
+import mimetypes
+import os
+
+from flask import abort, request, send_file
+from markupsafe import Markup, escape
+from PIL import Image, features
+from werkzeug.utils import safe_join
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен: без него собираются только .gz
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+DIST_DIRNAME = 'dist'
+MANIFEST_FILENAME = 'manifest.json'
+RESPONSIVE_WIDTHS = (480, 960, 1600)
+RASTER_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg')
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:10]
+
+
+def _write(out_dir: str, rel_path: str, data: bytes) -> None:
+    path = os.path.join(out_dir, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def _image_formats() -> list[tuple[str, str, str, dict]]:
+    """(формат Pillow, расширение, MIME, параметры) в порядке предпочтения для <source>."""
+    formats = []
+    if features.check('avif'):
+        # Шкала качества AVIF жёстче WebP: 50 даёт сопоставимую картинку при меньшем весе
+        formats.append(('AVIF', 'avif', 'image/avif', {'quality': 50, 'speed': 8}))
+    formats.append(('WEBP', 'webp', 'image/webp', {'quality': 80, 'method': 4}))
+    return formats
+
+
+def _build_variants(out_dir: str, rel_path: str, data: bytes, digest: str) -> dict:
+    base, _ = os.path.splitext(rel_path)
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        width, height = image.size
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+        # Больше самой широкой ступени не отдаём: на экране разница не видна
+        widths = [w for w in RESPONSIVE_WIDTHS if w < width] + [min(width, RESPONSIVE_WIDTHS[-1])]
+        sources = {}
+        for pil_format, extension, mime, options in _image_formats():
+            variants = []
+            for target in widths:
+                resized = image if target == width else image.resize((target, round(height * target / width)), Image.LANCZOS)
+                variant_path = f'{base}.{digest}.{target}w.{extension}'
+                path = os.path.join(out_dir, variant_path)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                resized.save(path, format=pil_format, **options)
+                variants.append([variant_path, target])
+            sources[mime] = variants
+    return {'width': width, 'height': height, 'sources': sources}
+
+
+def build_assets(static_dir: str) -> dict:
+    """Собирает static/dist и manifest.json, возвращает манифест."""
+    out_dir = os.path.join(static_dir, DIST_DIRNAME)
+    manifest = {}
+    original_bytes = 0
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != out_dir]
+        for filename in sorted(files):
+            rel_path = os.path.relpath(os.path.join(root, filename), static_dir).replace(os.sep, '/')
+            with open(os.path.join(root, filename), 'rb') as f:
+                data = f.read()
+            original_bytes += len(data)
+            digest = _digest(data)
+            base, extension = os.path.splitext(rel_path)
+            hashed_path = f'{base}.{digest}{extension}'
+            _write(out_dir, hashed_path, data)
+            entry = {'path': hashed_path}
+            if extension.lower() in COMPRESSIBLE_EXTENSIONS:
+                _write(out_dir, f'{hashed_path}.gz', gzip.compress(data, compresslevel=9, mtime=0))
+                if brotli is not None:
+                    _write(out_dir, f'{hashed_path}.br', brotli.compress(data, quality=11))
+            elif extension.lower() in RASTER_EXTENSIONS:
+                entry.update(_build_variants(out_dir, rel_path, data, digest))
+            manifest[rel_path] = entry
+    with open(os.path.join(out_dir, MANIFEST_FILENAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+    logger.info('Собрано %d файлов статики (%d байт исходников)', len(manifest), original_bytes)
+    return manifest
+
+
+class AssetManifest:
+    """Адреса собранной статики для шаблонов."""
+
+    def __init__(self, static_dir: str, url_prefix: str = '/assets'):
+        self.static_dir = static_dir
+        self.out_dir = os.path.join(static_dir, DIST_DIRNAME)
+        self.url_prefix = url_prefix
+        self._manifest: dict | None = None
+
+    @property
+    def manifest(self) -> dict:
+        if self._manifest is None:
+            try:
+                with open(os.path.join(self.out_dir, MANIFEST_FILENAME), 'r', encoding='utf-8') as f:
+                    self._manifest = json.load(f)
+            except (OSError, ValueError):
+                self._manifest = {}
+        return self._manifest
+
+    def url(self, rel_path: str) -> str:
+        entry = self.manifest.get(rel_path)
+        if entry is None:
+            return f'/static/{rel_path}'
+        return f"{self.url_prefix}/{entry['path']}"
+
+    def picture(self, rel_path: str, alt: str = '', sizes: str = '100vw', lazy: bool = True, **attrs) -> Markup:
+        """<picture> с AVIF/WebP-вариантами и исходником в качестве запасного <img>."""
+        img_attrs = {'src': self.url(rel_path), 'alt': alt, 'decoding': 'async'}
+        if lazy:
+            img_attrs['loading'] = 'lazy'
+        img_attrs.update({name.rstrip('_').replace('_', '-'): value for name, value in attrs.items()})
+        entry = self.manifest.get(rel_path) or {}
+        if entry.get('width'):
+            img_attrs.setdefault('width', entry['width'])
+            img_attrs.setdefault('height', entry['height'])
+        img = '<img ' + ' '.join(f'{name}="{escape(value)}"' for name, value in img_attrs.items()) + '>'
+        if not entry.get('sources'):
+            return Markup(img)
+        sources = []
+        for mime, variants in entry['sources'].items():
+            srcset = ', '.join(f'{self.url_prefix}/{path} {width}w' for path, width in variants)
+            sources.append(f'<source type="{mime}" srcset="{escape(srcset)}" sizes="{escape(sizes)}">')
+        return Markup('<picture>' + ''.join(sources) + img + '</picture>')
+
+    def send(self, filename: str):
+        """Отдаёт собранный файл с immutable-кэшированием и предсжатыми версиями."""
+        path = safe_join(self.out_dir, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        accepted = request.accept_encodings
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if accepted[encoding] and os.path.isfile(path + suffix):
+                response = send_file(path + suffix, mimetype=mimetype, max_age=31536000)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_file(path, mimetype=mimetype, max_age=31536000)
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        response.vary.add('Accept-Encoding')
+        return response
+
+
+def init_assets(app, static_dir: str) -> AssetManifest:
+    """Подключает к приложению маршрут /assets и хелперы asset_url()/picture()."""
+    assets = AssetManifest(static_dir)
+    app.add_url_rule('/assets/<path:filename>', 'assets', assets.send)
+    app.jinja_env.globals['asset_url'] = assets.url
+    app.jinja_env.globals['picture'] = assets.picture
+    return assets
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    build_assets(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
@@ -0,0 +1,41 @@
+import asyncio
+import concurrent.futures
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class EventLoopThread:
+    """Event loop в отдельном фоновом потоке для асинхронных задач.
+
+    Поток стартует лениво при первой задаче, чтобы создаваться уже после
+    fork() в gunicorn. Корутины отправляются из любого потока через submit().
+    """
+
+    def __init__(self, name: str = 'async-runtime'):
+        self.name = name
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    self._thread = threading.Thread(target=self._run, args=(loop,), name=self.name, daemon=True)
+                    self._thread.start()
+                    self._loop = loop
+        return self._loop
+
+    @staticmethod
+    def _run(loop: asyncio.AbstractEventLoop) -> None:
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_forever()
+        except Exception as exc:
+            logger.exception('Event loop остановился с ошибкой: %s', exc)
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
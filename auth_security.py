@@ -0,0 +1,129 @@
+import logging
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+logger = logging.getLogger(__name__)
+
+
+class HasherBusyError(RuntimeError):
+    """Пул хэширования паролей перегружен — запрос нужно отклонить."""
+
+
+def _hash_method(password_hash: str) -> str:
+    return password_hash.split('$', 1)[0]
+
+
+class PasswordHasher:
+    """Хэширование паролей в отдельном ограниченном пуле процессов.
+
+    scrypt/PBKDF2 занимают процессор на десятки миллисекунд; в пуле их
+    стоимость ограничена workers ядрами, а лишние запросы сверх max_pending
+    сразу получают HasherBusyError вместо того, чтобы занимать воркеры сайта.
+    Пул создаётся лениво — уже после fork() в gunicorn — и запускает
+    процессы через forkserver, а не fork.
+    """
+
+    def __init__(self, method: str, workers: int = 2, max_pending: int = 16, timeout: float = 10.0):
+        self.method = method
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._executor: ProcessPoolExecutor | None = None
+        self._lock = threading.Lock()
+        self._current_method: str | None = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    # К первому входу в воркере уже работают фоновые потоки, а fork
+                    # многопоточного процесса может оставить в дочернем захваченные
+                    # блокировки. forkserver порождает процессы пула из чистого
+                    # сервера, который загружает только werkzeug, а не app.py
+                    if 'forkserver' in multiprocessing.get_all_start_methods():
+                        context = multiprocessing.get_context('forkserver')
+                        context.set_forkserver_preload(['werkzeug.security'])
+                    else:
+                        context = multiprocessing.get_context('spawn')
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        return self._executor
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusyError('Пул хэширования паролей перегружен')
+        try:
+            future = self._get_executor().submit(func, *args)
+            try:
+                return future.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                future.cancel()
+                raise HasherBusyError('Хэширование пароля не уложилось в таймаут') from None
+        finally:
+            self._slots.release()
+
+    def hash(self, password: str) -> str:
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash: str, password: str) -> bool:
+        if not password_hash or not password:
+            return False
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        """True, если хэш получен с другими параметрами, чем заданы сейчас."""
+        if self._current_method is None:
+            # Werkzeug дописывает параметры по умолчанию (например, число итераций) — берём их из живого хэша
+            self._current_method = _hash_method(self.hash('rehash-probe'))
+        return _hash_method(password_hash) != self._current_method
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class TokenBucketLimiter:
+    """Ограничитель частоты «ведро токенов» по произвольному ключу (IP, email).
+
+    В ведре до capacity токенов, они восполняются со скоростью rate в секунду.
+    Хранится не больше maxsize ключей — самые давние вытесняются.
+    """
+
+    def __init__(self, rate: float, capacity: int, maxsize: int = 100000):
+        self.rate = rate
+        self.capacity = capacity
+        self.maxsize = maxsize
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key: str) -> float:
+        """Берёт токен; возвращает 0, если можно, иначе сколько секунд подождать."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (float(self.capacity), now))
+            tokens = min(float(self.capacity), tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def refund(self, key: str) -> None:
+        """Возвращает токен, взятый consume(), если запрос так и не был выполнен."""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                self._buckets[key] = (min(float(self.capacity), bucket[0] + 1), bucket[1])
@@ -0,0 +1,429 @@
+"""Нагрузочный бенчмарк приложения с локальными заглушками Stability и OpenAI.
+
+Запуск (поднимает заглушки и само приложение в этом же процессе)::
+
+    python benchmark.py --concurrency 1,8,32 --requests 200
+
+Заглушкам задаются задержка, доля ошибок 500 и 429 (случайных или
+пачками). Для каждого сценария (generate, chat, login, static) выводятся
+p50/p95/p99 задержки и запросы в секунду. С --save результаты пишутся в
+JSON, а с --baseline сравниваются с прошлым прогоном: при ухудшении больше
+--max-regression скрипт завершается с кодом 1.
+
+Чтобы гонять уже запущенный сервер (например, gunicorn), укажите --target,
+а серверу — STABILITY_API_BASE и OPENAI_BASE_URL из вывода --stubs-only.
+"""
+import argparse
+import io
+import json
+import logging
+import math
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from PIL import Image, ImageDraw
+
+SCENARIOS = ('generate', 'chat', 'login', 'static')
+BENCH_EMAIL = 'bench@example.com'
+BENCH_PASSWORD = 'bench12345'
+
+
+class StubBehavior:
+    """Поведение заглушки: задержка, ошибки и пачки 429."""
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        throttle_every: int = 0,
+        throttle_burst: int = 0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.throttle_every = throttle_every
+        self.throttle_burst = throttle_burst
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def next_status(self) -> int:
+        with self._lock:
+            self._count += 1
+            count = self._count
+        # Каждые throttle_every запросов идёт пачка из throttle_burst ответов 429
+        if self.throttle_every and self.throttle_burst and count % self.throttle_every < self.throttle_burst:
+            return 429
+        roll = random.random()
+        if roll < self.throttle_rate:
+            return 429
+        if roll < self.throttle_rate + self.error_rate:
+            return 500
+        return 200
+
+    def sleep(self) -> None:
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _stub_image() -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), (200, 180, 150)).save(buffer, format='WEBP')
+    return buffer.getvalue()
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    behavior: StubBehavior = StubBehavior()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _send(self, status: int, body: bytes, content_type: str, headers: dict | None = None) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error_status(self, status: int) -> None:
+        headers = {'Retry-After': '1'} if status == 429 else None
+        body = json.dumps({'error': {'message': f'stub {status}'}}).encode()
+        self._send(status, body, 'application/json', headers)
+
+
+class StabilityStubHandler(_StubHandler):
+    image = _stub_image()
+
+    def do_POST(self):
+        self._read_body()
+        status = self.behavior.next_status()
+        self.behavior.sleep()
+        if not self.path.startswith('/v2beta/stable-image/control/structure'):
+            self._send_error_status(404)
+        elif status != 200:
+            self._send_error_status(status)
+        else:
+            self._send(200, self.image, 'image/webp')
+
+
+class OpenAIStubHandler(_StubHandler):
+    reply = 'Это ответ заглушки OpenAI для нагрузочного теста.'
+
+    def do_POST(self):
+        try:
+            payload = json.loads(self._read_body() or b'{}')
+        except ValueError:
+            payload = {}
+        status = self.behavior.next_status()
+        self.behavior.sleep()
+        if not self.path.endswith('/chat/completions'):
+            self._send_error_status(404)
+            return
+        if status != 200:
+            self._send_error_status(status)
+            return
+        base = {'id': 'chatcmpl-stub', 'created': int(time.time()), 'model': payload.get('model', 'stub')}
+        if not payload.get('stream'):
+            body = dict(
+                base,
+                object='chat.completion',
+                choices=[{'index': 0, 'message': {'role': 'assistant', 'content': self.reply}, 'finish_reason': 'stop'}],
+                usage={'prompt_tokens': 10, 'completion_tokens': 10, 'total_tokens': 20},
+            )
+            self._send(200, json.dumps(body).encode(), 'application/json')
+            return
+        chunks = []
+        for word in self.reply.split(' '):
+            chunk = dict(
+                base,
+                object='chat.completion.chunk',
+                choices=[{'index': 0, 'delta': {'content': word + ' '}, 'finish_reason': None}],
+            )
+            chunks.append(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n')
+        chunks.append('data: [DONE]\n\n')
+        self._send(200, ''.join(chunks).encode(), 'text/event-stream')
+
+
+def start_stub(handler: type, behavior: StubBehavior) -> ThreadingHTTPServer:
+    handler_class = type(handler.__name__, (handler,), {'behavior': behavior})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name=handler.__name__, daemon=True).start()
+    return server
+
+
+def _server_url(server) -> str:
+    host, port = server.server_address[:2]
+    return f'http://{host}:{port}'
+
+
+def start_app(stability_url: str, openai_url: str, workdir: str) -> tuple[str, object]:
+    """Поднимает приложение в этом процессе, направив его на заглушки."""
+    os.environ.update({
+        'STABILITY_API_BASE': stability_url,
+        'STABILITY_API_KEYS': ','.join(f'bench-key-{i}' for i in range(4)),
+        'OPENAI_BASE_URL': f'{openai_url}/v1',
+        'OPENAI_API_KEY': 'bench',
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+        'RESULT_FOLDER': os.path.join(workdir, 'results'),
+        # Кэши и лимиты скрыли бы реальную стоимость запросов
+        'RESULT_CACHE_MAX_BYTES': '0',
+        'AUTH_IP_RATE_PER_MINUTE': '0',
+        'AUTH_EMAIL_RATE_PER_MINUTE': '0',
+        'GENERATION_TIERS': json.dumps({'free': {'concurrency': 0, 'rate_per_minute': 0, 'max_queued': 0, 'max_wait': 0}}),
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from werkzeug.serving import make_server
+
+    import app as app_module
+
+    application = app_module.create_app()
+    with application.app_context():
+        app_module.init_db()
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, application, threaded=True)
+    threading.Thread(target=server.serve_forever, name='bench-app', daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}', app_module
+
+
+def _blueprint_png() -> bytes:
+    image = Image.new('L', (1024, 768), 255)
+    draw = ImageDraw.Draw(image)
+    for x in range(0, 1024, 128):
+        draw.line([(x, 0), (x, 767)], fill=0, width=4)
+    for y in range(0, 768, 128):
+        draw.line([(0, y), (1023, y)], fill=0, width=4)
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class Scenario:
+    """Один сценарий нагрузки; run() возвращает {метрика: (задержка, статус)}."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.blueprint = _blueprint_png()
+
+    def setup(self) -> None:
+        session = requests.Session()
+        session.post(f'{self.base_url}/register', data={
+            'first_name': 'Bench',
+            'email': BENCH_EMAIL,
+            'password': BENCH_PASSWORD,
+            'confirm_password': BENCH_PASSWORD,
+        }, allow_redirects=False)
+
+    def _timed(self, func, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = func(*args, **kwargs)
+            status = response.status_code
+        except requests.RequestException:
+            response, status = None, 0
+        return response, time.perf_counter() - started, status
+
+    def generate(self, session: requests.Session) -> dict:
+        started = time.perf_counter()
+        response, latency, status = self._timed(
+            session.post,
+            f'{self.base_url}/generate',
+            files={'blueprint': ('plan.png', self.blueprint, 'image/png')},
+            data={'style': 'scandinavian'},
+            allow_redirects=False,
+        )
+        results = {'generate': (latency, status)}
+        match = re.search(r'/jobs/([0-9a-f]+)/result', response.headers.get('Location', '')) if response is not None else None
+        if not match:
+            return results
+        # Полное время генерации: от отправки формы до готового результата
+        while time.perf_counter() - started < 300:
+            job = session.get(f'{self.base_url}/jobs/{match.group(1)}').json()
+            if job.get('status') in ('done', 'failed'):
+                results['generate_e2e'] = (time.perf_counter() - started, 200 if job['status'] == 'done' else 500)
+                break
+            time.sleep(0.05)
+        return results
+
+    def chat(self, session: requests.Session) -> dict:
+        question = f'Сколько стоит тариф? #{uuid.uuid4().hex[:6]}'
+        _, latency, status = self._timed(
+            session.post, f'{self.base_url}/chat', json={'messages': [{'role': 'user', 'content': question}]},
+        )
+        return {'chat': (latency, status)}
+
+    def login(self, session: requests.Session) -> dict:
+        session.cookies.clear()
+        _, latency, status = self._timed(
+            session.post,
+            f'{self.base_url}/login',
+            data={'email': BENCH_EMAIL, 'password': BENCH_PASSWORD},
+            allow_redirects=False,
+        )
+        return {'login': (latency, status)}
+
+    def static(self, session: requests.Session) -> dict:
+        path = random.choice(('/', '/static/css/style.css', '/static/js/script.js'))
+        _, latency, status = self._timed(session.get, f'{self.base_url}{path}')
+        return {'static': (latency, status)}
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # Метод ближайшего ранга
+    index = max(0, math.ceil(q / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def run_scenario(scenario: Scenario, name: str, concurrency: int, total: int) -> dict:
+    samples: dict[str, list[tuple[float, int]]] = {}
+    lock = threading.Lock()
+    local = threading.local()
+    func = getattr(scenario, name)
+
+    def one(_):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        for metric, sample in func(local.session).items():
+            with lock:
+                samples.setdefault(metric, []).append(sample)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(total)))
+    elapsed = time.perf_counter() - started
+
+    report = {}
+    for metric, values in samples.items():
+        latencies = sorted(latency for latency, _ in values)
+        statuses: dict[str, int] = {}
+        for _, status in values:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        report[metric] = {
+            'concurrency': concurrency,
+            'requests': len(values),
+            'rps': round(len(values) / elapsed, 2) if elapsed else 0.0,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+            'statuses': statuses,
+        }
+    return report
+
+
+def compare(results: dict, baseline: dict, max_regression: float) -> list[str]:
+    """Список ухудшений относительно baseline больше чем на max_regression (доля)."""
+    problems = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if not previous:
+            continue
+        if previous['p95_ms'] and current['p95_ms'] > previous['p95_ms'] * (1 + max_regression):
+            problems.append(f"{key}: p95 {previous['p95_ms']} → {current['p95_ms']} мс")
+        if previous['rps'] and current['rps'] < previous['rps'] * (1 - max_regression):
+            problems.append(f"{key}: rps {previous['rps']} → {current['rps']}")
+    return problems
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='через запятую: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--concurrency', default='1,8,32', help='уровни параллельности через запятую')
+    parser.add_argument('--requests', type=int, default=100, help='запросов на сценарий и уровень')
+    parser.add_argument('--target', help='адрес уже запущенного приложения вместо встроенного')
+    parser.add_argument('--stubs-only', action='store_true', help='только поднять заглушки и ждать')
+    for name, latency in (('stability', 2.0), ('openai', 0.5)):
+        parser.add_argument(f'--{name}-latency', type=float, default=latency, help='средняя задержка, с')
+        parser.add_argument(f'--{name}-jitter', type=float, default=latency / 4, help='разброс задержки, с')
+        parser.add_argument(f'--{name}-error-rate', type=float, default=0.0, help='доля ответов 500')
+        parser.add_argument(f'--{name}-429-rate', type=float, default=0.0, help='доля случайных ответов 429')
+        parser.add_argument(f'--{name}-429-every', type=int, default=0, help='пачка 429 каждые N запросов')
+        parser.add_argument(f'--{name}-429-burst', type=int, default=0, help='длина пачки 429')
+    parser.add_argument('--save', help='записать результаты в JSON')
+    parser.add_argument('--baseline', help='JSON прошлого прогона для сравнения')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='допустимое ухудшение (0.2 = 20%%)')
+    return parser.parse_args(argv)
+
+
+def _behavior(args, name: str) -> StubBehavior:
+    return StubBehavior(
+        latency=getattr(args, f'{name}_latency'),
+        jitter=getattr(args, f'{name}_jitter'),
+        error_rate=getattr(args, f'{name}_error_rate'),
+        throttle_rate=getattr(args, f'{name}_429_rate'),
+        throttle_every=getattr(args, f'{name}_429_every'),
+        throttle_burst=getattr(args, f'{name}_429_burst'),
+    )
+
+
+def main(argv=None) -> int:
+    args = _parse_args(argv)
+    stability = start_stub(StabilityStubHandler, _behavior(args, 'stability'))
+    openai_stub = start_stub(OpenAIStubHandler, _behavior(args, 'openai'))
+    print(f'STABILITY_API_BASE={_server_url(stability)}')
+    print(f'OPENAI_BASE_URL={_server_url(openai_stub)}/v1')
+    if args.stubs_only:
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            return 0
+
+    with tempfile.TemporaryDirectory(prefix='pizz-bench-') as workdir:
+        if args.target:
+            base_url = args.target.rstrip('/')
+        else:
+            base_url, app_module = start_app(_server_url(stability), _server_url(openai_stub), workdir)
+        scenario = Scenario(base_url)
+        scenario.setup()
+
+        results = {}
+        print(f"{'сценарий':<14}{'конк.':>6}{'запр.':>7}{'rps':>9}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}  статусы")
+        for name in [s.strip() for s in args.scenarios.split(',') if s.strip()]:
+            if name not in SCENARIOS:
+                print(f'Неизвестный сценарий: {name}', file=sys.stderr)
+                return 2
+            for concurrency in [int(c) for c in args.concurrency.split(',')]:
+                for metric, row in run_scenario(scenario, name, concurrency, args.requests).items():
+                    results[f'{metric}@{concurrency}'] = row
+                    print(
+                        f"{metric:<14}{concurrency:>6}{row['requests']:>7}{row['rps']:>9}"
+                        f"{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}  {row['statuses']}"
+                    )
+        if not args.target:
+            app_module.file_writer.flush()
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            problems = compare(results, json.load(f), args.max_regression)
+        for problem in problems:
+            print(f'Регрессия: {problem}', file=sys.stderr)
+        if problems:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
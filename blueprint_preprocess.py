@@ -0,0 +1,112 @@
+import io
+import logging
+import time
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from metrics import REGISTRY, observe_stage
+
+logger = logging.getLogger(__name__)
+
+# Доля почти чёрных/почти белых пикселей, начиная с которой считаем картинку чертежом
+LINE_ART_RATIO = 0.95
+# Средняя насыщенность (0-255), ниже которой цвет не несёт информации
+GRAYSCALE_SATURATION = 16
+
+BYTES_SAVED = REGISTRY.counter('pizz_blueprint_bytes_saved_total', 'Сколько байт чертежей сэкономила предобработка')
+
+
+class InvalidBlueprintError(ValueError):
+    """Загруженный файл не удалось прочитать как изображение."""
+
+
+class PreprocessedBlueprint:
+    def __init__(self, data: bytes, extension: str, source_bytes: int):
+        self.data = data
+        self.extension = extension
+        self.source_bytes = source_bytes
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.source_bytes - len(self.data)
+
+
+def _classify(image: Image.Image) -> str:
+    """'line' для чёрно-белого чертежа, 'gray' для бесцветного изображения, иначе 'color'."""
+    sample = image.copy()
+    sample.thumbnail((128, 128))
+    if sample.mode not in ('L', '1'):
+        saturation = sample.convert('RGB').convert('HSV').getchannel('S')
+        histogram = saturation.histogram()
+        mean_saturation = sum(value * count for value, count in enumerate(histogram)) / max(1, sum(histogram))
+        if mean_saturation > GRAYSCALE_SATURATION:
+            return 'color'
+    histogram = sample.convert('L').histogram()
+    extremes = sum(histogram[:64]) + sum(histogram[192:])
+    return 'line' if extremes / max(1, sum(histogram)) >= LINE_ART_RATIO else 'gray'
+
+
+def preprocess_blueprint(raw: bytes, max_side: int = 1536, binarize: bool = True, quality: int = 90) -> PreprocessedBlueprint:
+    """Готовит чертёж к отправке в модель.
+
+    Декодирует, уменьшает до max_side, поворачивает по EXIF, переводит
+    чертежи в оттенки серого (или в чистый ч/б) и компактно пережимает.
+    Длительность этапов уходит в pizz_stage_seconds{stage="preprocess.*"}.
+    """
+    timings: dict[str, float] = {}
+    started = time.perf_counter()
+
+    try:
+        image = Image.open(io.BytesIO(raw))
+        # JPEG умеет декодироваться сразу в уменьшенном масштабе
+        image.draft('RGB', (max_side, max_side))
+        image.load()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError) as exc:
+        raise InvalidBlueprintError('Файл не является изображением') from exc
+    timings['decode'] = time.perf_counter() - started
+
+    # Уменьшаем сразу: ограничение квадратное, поэтому поворот после него даёт тот же результат
+    stage = time.perf_counter()
+    image.thumbnail((max_side, max_side))
+    timings['resize'] = time.perf_counter() - stage
+
+    stage = time.perf_counter()
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ('RGBA', 'LA', 'P'):
+        # Прозрачный фон чертежа делаем белым
+        rgba = image.convert('RGBA')
+        background = Image.new('RGBA', rgba.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, rgba).convert('RGB')
+    elif image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    timings['orient'] = time.perf_counter() - stage
+
+    stage = time.perf_counter()
+    kind = _classify(image)
+    if kind != 'color':
+        image = image.convert('L')
+    if kind == 'line' and binarize:
+        image = image.point(lambda value: 255 if value >= 128 else 0, mode='1')
+    timings['classify'] = time.perf_counter() - stage
+
+    stage = time.perf_counter()
+    out = io.BytesIO()
+    if image.mode == '1':
+        # Ч/б чертёж в PNG весит считанные килобайты
+        image.save(out, format='PNG', optimize=True)
+        extension = 'png'
+    else:
+        image.save(out, format='JPEG', quality=quality, optimize=True)
+        extension = 'jpg'
+    timings['encode'] = time.perf_counter() - stage
+
+    result = PreprocessedBlueprint(out.getvalue(), extension, len(raw))
+    for name, seconds in timings.items():
+        observe_stage(f'preprocess.{name}', seconds)
+    BYTES_SAVED.inc(max(0, result.bytes_saved))
+    logger.info(
+        'Чертёж подготовлен: %s %dx%d, %d → %d байт (сэкономлено %d), этапы: %s',
+        kind, image.size[0], image.size[1], len(raw), len(result.data), result.bytes_saved,
+        ', '.join(f'{name}={seconds * 1000:.1f}мс' for name, seconds in timings.items()),
+    )
+    return result
@@ -0,0 +1,285 @@
+"""Пакетная генерация интерьеров из командной строки::
+
+    python bulk_generate.py plans/ --styles modern,japanese --out out/
+    python bulk_generate.py manifest.csv --out out/ --concurrency 16
+    python bulk_generate.py manifest.jsonl --out out/
+
+Вход — папка с чертежами (каждый × каждый стиль из --styles) или манифест
+CSV/JSONL с полями blueprint, style, prompt и id (пути — относительно
+манифеста; без style берутся --styles). Запросы идут параллельно через все
+ключи STABILITY_API_KEYS: по умолчанию число потоков равно числу ключей ×
+STABILITY_KEY_MAX_CONCURRENCY, пул сам раздаёт ключи и обходит 429.
+
+Результаты пишутся в out/<id>.webp, а в out/results.jsonl — строка на
+каждую задачу: статус, время, ключ (последние символы) и коды попыток.
+Повторный запуск с тем же --out пропускает уже готовые задачи, поэтому
+прерванный или упавший прогон можно просто запустить снова. Ctrl+C
+дожидается уже начатых генераций, повторный Ctrl+C выходит сразу.
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from blueprint_preprocess import InvalidBlueprintError, preprocess_blueprint
+from generator_utils import STYLE_LABELS, build_prompt, generate_interior, get_stability_key_pool
+from metrics import end_trace, start_trace
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+LOG_FILENAME = 'results.jsonl'
+
+ITEM_DONE = 'done'
+ITEM_FAILED = 'failed'
+ITEM_INVALID = 'invalid'
+
+RESUME_HINT = 'Запустите ту же команду ещё раз: готовые задачи будут пропущены.'
+
+
+class BulkItem:
+    def __init__(self, item_id: str, blueprint: str, style: str, prompt: str = ''):
+        self.id = item_id
+        self.blueprint = blueprint
+        self.style = style
+        self.prompt = prompt
+
+
+def _safe_id(value: str) -> str:
+    # id — имя файла в --out, поэтому без разделителей пути
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', value)
+
+
+def _item_id(blueprint: str, style: str) -> str:
+    stem = os.path.splitext(os.path.basename(blueprint))[0]
+    return _safe_id(f'{stem}__{style}')
+
+
+def _parse_styles(value: str) -> list[str]:
+    if value == 'all':
+        return list(STYLE_LABELS)
+    styles = [style.strip() for style in value.split(',') if style.strip()]
+    unknown = [style for style in styles if style not in STYLE_LABELS]
+    if unknown:
+        raise SystemExit(f'Неизвестные стили: {", ".join(unknown)} (доступны: {", ".join(STYLE_LABELS)})')
+    return styles
+
+
+def _manifest_rows(path: str) -> list[dict]:
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if path.lower().endswith('.csv'):
+            return list(csv.DictReader(f))
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_items(source: str, styles: list[str], prompt: str = '') -> list[BulkItem]:
+    """Задачи из папки с чертежами или манифеста CSV/JSONL."""
+    items = []
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(source, name)
+                items.extend(BulkItem(_item_id(path, style), path, style, prompt) for style in styles)
+    else:
+        root = os.path.dirname(os.path.abspath(source))
+        for row in _manifest_rows(source):
+            blueprint = os.path.join(root, row['blueprint'])
+            row_styles = [row['style']] if row.get('style') else styles
+            for style in row_styles:
+                if style not in STYLE_LABELS:
+                    raise SystemExit(f'Неизвестный стиль в манифесте: {style}')
+                item_id = _item_id(blueprint, style)
+                if row.get('id'):
+                    item_id = _safe_id(f"{row['id']}__{style}" if len(row_styles) > 1 else str(row['id']))
+                items.append(BulkItem(item_id, blueprint, style, row.get('prompt') or prompt))
+    seen = set()
+    for item in items:
+        if item.id in seen:
+            raise SystemExit(f'Повторяющийся id задачи: {item.id}')
+        seen.add(item.id)
+    return items
+
+
+def previous_statuses(log_path: str, out_dir: str) -> dict[str, str]:
+    """Последний статус каждой задачи по журналу прошлых запусков.
+
+    Готовая задача, чей результат пропал с диска, считается невыполненной.
+    """
+    statuses = {}
+    try:
+        with open(log_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # строка, недописанная при падении
+                status = entry.get('status')
+                if status == ITEM_DONE and not os.path.exists(os.path.join(out_dir, entry.get('output', ''))):
+                    status = None
+                statuses[entry.get('id')] = status
+    except FileNotFoundError:
+        pass
+    return statuses
+
+
+class ResultsLog:
+    """Журнал JSONL: каждая строка дописывается и сбрасывается на диск сразу."""
+
+    def __init__(self, path: str):
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def write(self, entry: dict) -> None:
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class BlueprintLoader:
+    """Чертёж готовится один раз на все его стили (задачи одного чертежа идут подряд)."""
+
+    def __init__(self, max_side: int, binarize: bool, maxsize: int):
+        self.max_side = max_side
+        self.binarize = binarize
+        self.maxsize = max(1, maxsize)
+        self._cache: dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def load(self, path: str) -> bytes:
+        with self._lock:
+            data = self._cache.get(path)
+        if data is not None:
+            return data
+        with open(path, 'rb') as f:
+            data = preprocess_blueprint(f.read(), max_side=self.max_side, binarize=self.binarize).data
+        with self._lock:
+            self._cache[path] = data
+            while len(self._cache) > self.maxsize:
+                self._cache.pop(next(iter(self._cache)))
+        return data
+
+
+def run_item(item: BulkItem, out_dir: str, loader: BlueprintLoader) -> dict:
+    output = f'{item.id}.webp'
+    entry = {'id': item.id, 'blueprint': item.blueprint, 'style': item.style, 'output': output}
+    started = time.perf_counter()
+    try:
+        image_bytes = loader.load(item.blueprint)
+    except (OSError, InvalidBlueprintError) as exc:
+        entry.update(status=ITEM_INVALID, error=str(exc), latency=0.0, key=None, attempts=0, statuses=None, finished_at=time.time())
+        return entry
+    trace = start_trace(f'bulk {item.id}')
+    try:
+        result = generate_interior(
+            build_prompt(item.style, item.prompt),
+            item.blueprint,
+            os.path.join(out_dir, output),
+            item.style,
+            BASE_DIR,
+            image_bytes=image_bytes,
+        )
+        entry['status'] = ITEM_DONE if result else ITEM_FAILED
+    except Exception as exc:
+        entry['status'] = ITEM_FAILED
+        entry['error'] = str(exc)
+    finally:
+        end_trace()
+    entry['latency'] = round(time.perf_counter() - started, 3)
+    # Без ключа — результат взят из кэша (RESULT_CACHE_MAX_BYTES)
+    entry['key'] = trace.attrs.get('key')
+    entry['attempts'] = trace.attrs.get('attempts', 0)
+    entry['statuses'] = trace.attrs.get('statuses')
+    entry['finished_at'] = time.time()
+    return entry
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(description='Пакетная генерация интерьеров по чертежам')
+    parser.add_argument('source', help='папка с чертежами или манифест .csv/.jsonl')
+    parser.add_argument('--out', required=True, help='папка результатов и журнала results.jsonl')
+    parser.add_argument('--styles', default='scandinavian', help='стили через запятую или all')
+    parser.add_argument('--prompt', default='', help='дополнительные пожелания ко всем задачам')
+    parser.add_argument('--concurrency', type=int, default=0, help='параллельных задач (0 — ключи × STABILITY_KEY_MAX_CONCURRENCY)')
+    parser.add_argument('--retry-failed', action=argparse.BooleanOptionalAction, default=True, help='повторять задачи, упавшие в прошлых запусках')
+    parser.add_argument('--max-side', type=int, default=int(os.getenv('BLUEPRINT_MAX_SIDE', '1536')))
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    logging.basicConfig(level=logging.WARNING)
+    args = _parse_args(argv)
+    pool = get_stability_key_pool()
+    if not len(pool):
+        print('Не заданы ключи STABILITY_API_KEYS.', file=sys.stderr)
+        return 2
+
+    items = load_items(args.source, _parse_styles(args.styles), args.prompt)
+    os.makedirs(args.out, exist_ok=True)
+    log_path = os.path.join(args.out, LOG_FILENAME)
+    skip = {ITEM_DONE} if args.retry_failed else {ITEM_DONE, ITEM_FAILED, ITEM_INVALID}
+    statuses = previous_statuses(log_path, args.out)
+    pending = [item for item in items if statuses.get(item.id) not in skip]
+    concurrency = args.concurrency or len(pool) * pool.max_in_flight
+    print(f'Задач: {len(items)}, уже готово: {len(items) - len(pending)}, ключей: {len(pool)}, потоков: {concurrency}')
+
+    loader = BlueprintLoader(args.max_side, os.getenv('BLUEPRINT_BINARIZE', 'true').lower() == 'true', concurrency * 2)
+    log = ResultsLog(log_path)
+    counts = {ITEM_DONE: 0, ITEM_FAILED: 0, ITEM_INVALID: 0}
+    started = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='bulk')
+
+    recorded = set()
+
+    def record(future) -> None:
+        entry = future.result()
+        recorded.add(future)
+        log.write(entry)
+        counts[entry['status']] += 1
+        print(f"[{len(recorded)}/{len(pending)}] {entry['id']}: {entry['status']} {entry['latency']:.1f} с {entry['key'] or ''}".rstrip())
+
+    futures = []
+    try:
+        for item in pending:
+            futures.append(executor.submit(run_item, item, args.out, loader))
+        for future in as_completed(futures):
+            record(future)
+    except KeyboardInterrupt:
+        # Начатые генерации не прервать: дожидаемся их, чтобы записать в журнал.
+        # Завершившиеся, но ещё не записанные задачи тоже попадают в журнал
+        executor.shutdown(wait=False, cancel_futures=True)
+        left = [future for future in futures if future not in recorded and not future.cancelled()]
+        running = sum(1 for future in left if not future.done())
+        print(f'Прервано: дожидаемся {running} начатых генераций (Ctrl+C ещё раз — выйти сразу).')
+        try:
+            for future in as_completed(left):
+                record(future)
+        except KeyboardInterrupt:
+            # Потоки пула не демоны: обычный выход ждал бы их запросы к API
+            log.close()
+            print(RESUME_HINT, flush=True)
+            os._exit(130)
+        print(RESUME_HINT)
+        return 130
+    finally:
+        log.close()
+    executor.shutdown()
+
+    elapsed = time.perf_counter() - started
+    rate = counts[ITEM_DONE] / elapsed * 60 if elapsed > 0 else 0.0
+    print(f'Готово: {counts[ITEM_DONE]}, ошибок: {counts[ITEM_FAILED]}, негодных чертежей: {counts[ITEM_INVALID]}, '
+          f'{elapsed:.0f} с ({rate:.1f} генераций/мин)')
+    return 1 if counts[ITEM_FAILED] or counts[ITEM_INVALID] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
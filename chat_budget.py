@@ -0,0 +1,158 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# Грубая оценка: в среднем ~4 символа на токен, плюс накладные расходы на сообщение
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_PUNCTUATION = re.compile(r'[^\w\s]+', re.UNICODE)
+_SPACES = re.compile(r'\s+')
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def message_tokens(message: dict) -> int:
+    return estimate_tokens(message.get('content') or '') + MESSAGE_OVERHEAD_TOKENS
+
+
+def normalize_question(text: str) -> str:
+    """Приводит вопрос к канонической форме: регистр, ё/е, пунктуация, пробелы."""
+    text = text.lower().replace('ё', 'е')
+    text = _PUNCTUATION.sub(' ', text)
+    return _SPACES.sub(' ', text).strip()
+
+
+def build_system_prompt(plans: dict, styles: dict) -> str:
+    """Компактный системный промпт с тарифами и стилями, закреплённый на сервере."""
+    plan_lines = '; '.join(f"{plan['name']} — {plan['price']} ({plan['description']})" for plan in plans.values())
+    style_lines = ', '.join(styles.values())
+    return (
+        'Ты дружелюбный ассистент компании Pizz — сервиса, который превращает чертёж квартиры '
+        'в 3D-визуализацию интерьера (страница /generate). Отвечай кратко и по делу, '
+        'помогай с тарифами и продуктом. '
+        f'Тарифы: {plan_lines}. '
+        f'Стили генерации: {style_lines}.'
+    )
+
+
+def trim_history(messages: list[dict], budget: int) -> tuple[list[dict], int]:
+    """Оставляет самые свежие сообщения, укладывающиеся в бюджет токенов.
+
+    Последнее сообщение сохраняется всегда. Возвращает обрезанную историю
+    и число сэкономленных токенов.
+    """
+    kept: list[dict] = []
+    used = 0
+    dropped = 0
+    for index in range(len(messages) - 1, -1, -1):
+        cost = message_tokens(messages[index])
+        if kept and used + cost > budget:
+            dropped = sum(message_tokens(message) for message in messages[:index + 1])
+            break
+        kept.append(messages[index])
+        used += cost
+    kept.reverse()
+    # История не должна начинаться с ответа ассистента без вопроса
+    while len(kept) > 1 and kept[0].get('role') == 'assistant':
+        dropped += message_tokens(kept.pop(0))
+    return kept, dropped
+
+
+class AnswerCache:
+    """LRU-кэш ответов на типовые вопросы с ограниченным временем жизни."""
+
+    def __init__(self, maxsize: int = 256, ttl: float = 3600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+        self._entries: OrderedDict[str, tuple[float, str, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, question: str) -> str | None:
+        key = normalize_question(question)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.tokens_saved += entry[2]
+            return entry[1]
+
+    def put(self, question: str, answer: str, prompt_tokens: int) -> None:
+        key = normalize_question(question)
+        if not key or not answer:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), answer, prompt_tokens + estimate_tokens(answer))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'entries': len(self._entries),
+                'tokens_saved': self.tokens_saved,
+            }
+
+
+class ChatBudget:
+    """Готовит историю чата к отправке в OpenAI.
+
+    Системные сообщения клиента заменяются закреплённым промптом, история
+    обрезается до бюджета токенов. Первый вопрос диалога не зависит от
+    контекста, поэтому только для него используется кэш ответов.
+    """
+
+    def __init__(self, system_prompt: str, token_budget: int, cache: AnswerCache | None):
+        self.system_prompt = system_prompt
+        self.token_budget = token_budget
+        self.cache = cache
+        self.tokens_trimmed = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, messages: list[dict]) -> tuple[list[dict], str | None]:
+        """Возвращает сообщения для API и вопрос, который можно кэшировать (или None)."""
+        history = [
+            {'role': message['role'], 'content': str(message.get('content') or '')}
+            for message in messages
+            if message.get('role') in ('user', 'assistant')
+        ]
+        system = {'role': 'system', 'content': self.system_prompt}
+        trimmed, dropped = trim_history(history, max(0, self.token_budget - message_tokens(system)))
+        if dropped:
+            with self._lock:
+                self.tokens_trimmed += dropped
+        question = None
+        if len(history) == 1 and history[0]['role'] == 'user':
+            question = history[0]['content']
+        return [system] + trimmed, question
+
+    def cached_answer(self, question: str | None) -> str | None:
+        if not self.cache or not question:
+            return None
+        return self.cache.get(question)
+
+    def remember(self, question: str | None, answer: str, chat_messages: list[dict]) -> None:
+        if self.cache and question:
+            self.cache.put(question, answer, sum(message_tokens(message) for message in chat_messages))
+
+    def stats(self) -> dict:
+        data = self.cache.stats() if self.cache else {'hits': 0, 'misses': 0, 'hit_rate': 0.0, 'entries': 0, 'tokens_saved': 0}
+        data['tokens_trimmed'] = self.tokens_trimmed
+        data['tokens_saved'] += self.tokens_trimmed
+        return data
@@ -0,0 +1,95 @@
+import os
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+
+SQLITE_PRAGMAS = (
+    # WAL: читатели не блокируют писателя и наоборот
+    'PRAGMA journal_mode=WAL',
+    # В WAL-режиме NORMAL безопасен и заметно быстрее FULL
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA foreign_keys=ON',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-20000',
+)
+
+
+def database_uri(base_dir: str) -> str:
+    """DATABASE_URL (например, PostgreSQL) или локальный SQLite по умолчанию."""
+    url = os.getenv('DATABASE_URL', '').strip()
+    if not url:
+        return f"sqlite:///{os.path.join(base_dir, 'app.db')}"
+    # Heroku и др. отдают устаревшую схему postgres://
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def _is_memory_sqlite(uri: str) -> bool:
+    url = make_url(uri)
+    return url.database in (None, '', ':memory:') or url.query.get('mode') == 'memory'
+
+
+def engine_options(uri: str) -> dict:
+    if uri.startswith('sqlite'):
+        # База в памяти живёт в одном соединении (StaticPool), размеров пула у неё нет
+        if _is_memory_sqlite(uri):
+            return {'connect_args': {'check_same_thread': False}}
+        return {
+            'pool_size': int(os.getenv('DB_POOL_SIZE', '10')),
+            'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '10')),
+            'connect_args': {'timeout': 30, 'check_same_thread': False},
+        }
+    return {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '10')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '20')),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
+        'pool_pre_ping': True,
+    }
+
+
+@event.listens_for(Engine, 'connect')
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    if type(dbapi_connection).__module__.split('.')[0] not in ('sqlite3', 'pysqlite2'):
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+    finally:
+        cursor.close()
+
+
+class TTLCache:
+    """Небольшой потокобезопасный кэш с временем жизни записей."""
+
+    def __init__(self, ttl: float = 60.0, maxsize: int = 10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: dict = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                return None
+            return entry[1]
+
+    def set(self, key, value) -> None:
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if len(self._entries) >= self.maxsize:
+                self._entries.clear()
+            self._entries[key] = (time.monotonic(), value)
+
+    def invalidate(self, key) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
@@ -0,0 +1,83 @@
+import logging
+import os
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncFileWriter:
+    """Фоновая запись файлов на диск.
+
+    Пока файл не записан, его содержимое доступно через read(), так что
+    его можно отдавать клиенту из памяти. Если в очереди скопилось больше
+    max_pending_bytes, запись идёт синхронно — память не растёт без предела.
+    """
+
+    def __init__(self, max_pending_bytes: int = 256 * 1024 * 1024):
+        self.max_pending_bytes = max_pending_bytes
+        self._pending: dict[str, bytes] = {}
+        self._pending_bytes = 0
+        self._queue: queue.Queue[str] = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker, name='file-writer', daemon=True)
+            self._thread.start()
+
+    @staticmethod
+    def _write_file(path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def write(self, path: str, data: bytes) -> None:
+        path = os.path.abspath(path)
+        with self._lock:
+            if self._pending_bytes + len(data) > self.max_pending_bytes:
+                overflow = True
+            else:
+                overflow = False
+                previous = self._pending.get(path)
+                if previous is not None:
+                    self._pending_bytes -= len(previous)
+                self._pending[path] = data
+                self._pending_bytes += len(data)
+                self._ensure_thread()
+        if overflow:
+            self._write_file(path, data)
+            return
+        self._queue.put(path)
+
+    def read(self, path: str) -> bytes | None:
+        with self._lock:
+            return self._pending.get(os.path.abspath(path))
+
+    def flush(self) -> None:
+        """Дожидается записи всего, что уже поставлено в очередь."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def _worker(self) -> None:
+        while True:
+            path = self._queue.get()
+            try:
+                with self._lock:
+                    data = self._pending.get(path)
+                if data is None:
+                    continue
+                try:
+                    self._write_file(path, data)
+                except OSError as exc:
+                    logger.exception('Не удалось записать файл %s: %s', path, exc)
+                with self._lock:
+                    # Файл могли перезаписать, пока шла запись — тогда оставляем новую версию
+                    if self._pending.get(path) is data:
+                        del self._pending[path]
+                        self._pending_bytes -= len(data)
+            finally:
+                self._queue.task_done()
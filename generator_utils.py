@@ -1,5 +1,72 @@
+import asyncio
+import contextvars
 import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import encode_multipart_formdata
+
+from file_writer import AsyncFileWriter
+from key_pool import KeyPool, get_key_pool
+from metrics import REGISTRY, annotate, span
+from result_cache import ResultCache, get_result_cache
+from retry_policy import RETRY_BACKOFF, RETRY_DONE, RETRY_FATAL, RetryBudget, RetryPolicy, get_retry_policy
+from style_assets import StyleAsset, StyleAssetRegistry
+
+if TYPE_CHECKING:
+	import httpx
+
+
+STYLE_DESCRIPTIONS = {
+	"minimalism": (
+		"Minimalist interior design with clean lines, neutral color palette (whites, grays, beiges), "
+		"minimal furniture, open spaces, natural light, simple geometric shapes, "
+		"uncluttered surfaces, monochromatic scheme, high-quality materials like marble and wood."
+	),
+	"modern": (
+		"Modern contemporary interior with sleek furniture, bold colors mixed with neutrals, "
+		"metallic accents (chrome, gold), geometric patterns, statement lighting fixtures, "
+		"glass and metal materials, vibrant artwork, mixed textures, urban sophistication."
+	),
+	"gothic": (
+		"Gothic interior design with dark colors (deep purples, blacks, burgundy), "
+		"ornate furniture with intricate details, dramatic lighting, velvet and brocade fabrics, "
+		"arched windows, antique elements, rich textures, medieval-inspired decor, "
+		"candles and chandeliers, luxurious and mysterious atmosphere."
+	),
+	"shabby_chic": (
+		"Shabby chic interior with vintage furniture, distressed wood finishes, pastel colors "
+		"(soft pinks, mint greens, lavender), floral patterns, whitewashed walls, "
+		"rustic elements, antique accessories, lace and cotton fabrics, "
+		"romantic and cozy atmosphere with worn elegance."
+	),
+	"japanese": (
+		"Japanese interior design with tatami mats, sliding shoji screens, natural wood materials, "
+		"neutral color palette (browns, beiges, whites), minimal furniture, low seating, "
+		"zen garden elements, bamboo accents, paper lanterns, natural lighting, "
+		"serene and peaceful atmosphere with emphasis on harmony and simplicity."
+	),
+	"scandinavian": (
+		"Scandinavian interior design with light wood flooring, white and pastel walls, "
+		"cozy textiles (wool, linen), natural materials, hygge elements, simple furniture, "
+		"warm lighting, plants, neutral color palette with pops of color, "
+		"functional and comfortable design with emphasis on coziness and natural light."
+	),
+}
+
+# Названия стилей для интерфейса (в том же порядке, что и в форме генерации)
+STYLE_LABELS = {
+	"minimalism": "Минимализм",
+	"modern": "Модерн",
+	"gothic": "Готика",
+	"shabby_chic": "Шебби шик",
+	"japanese": "Японский",
+	"scandinavian": "Скандинавский",
+}
 
 
 def get_style_prompt(style: str) -> str:
@@ -10,47 +77,18 @@ def get_style_prompt(style: str) -> str:
 		"Keep the exact layout and proportions from the blueprint — do not alter the architecture. "
 	)
 
-	style_descriptions = {
-		"minimalism": (
-			"Minimalist interior design with clean lines, neutral color palette (whites, grays, beiges), "
-			"minimal furniture, open spaces, natural light, simple geometric shapes, "
-			"uncluttered surfaces, monochromatic scheme, high-quality materials like marble and wood."
-		),
-		"modern": (
-			"Modern contemporary interior with sleek furniture, bold colors mixed with neutrals, "
-			"metallic accents (chrome, gold), geometric patterns, statement lighting fixtures, "
-			"glass and metal materials, vibrant artwork, mixed textures, urban sophistication."
-		),
-		"gothic": (
-			"Gothic interior design with dark colors (deep purples, blacks, burgundy), "
-			"ornate furniture with intricate details, dramatic lighting, velvet and brocade fabrics, "
-			"arched windows, antique elements, rich textures, medieval-inspired decor, "
-			"candles and chandeliers, luxurious and mysterious atmosphere."
-		),
-		"shabby_chic": (
-			"Shabby chic interior with vintage furniture, distressed wood finishes, pastel colors "
-			"(soft pinks, mint greens, lavender), floral patterns, whitewashed walls, "
-			"rustic elements, antique accessories, lace and cotton fabrics, "
-			"romantic and cozy atmosphere with worn elegance."
-		),
-		"japanese": (
-			"Japanese interior design with tatami mats, sliding shoji screens, natural wood materials, "
-			"neutral color palette (browns, beiges, whites), minimal furniture, low seating, "
-			"zen garden elements, bamboo accents, paper lanterns, natural lighting, "
-			"serene and peaceful atmosphere with emphasis on harmony and simplicity."
-		),
-		"scandinavian": (
-			"Scandinavian interior design with light wood flooring, white and pastel walls, "
-			"cozy textiles (wool, linen), natural materials, hygge elements, simple furniture, "
-			"warm lighting, plants, neutral color palette with pops of color, "
-			"functional and comfortable design with emphasis on coziness and natural light."
-		),
-	}
-
-	style_text = style_descriptions.get(style, style_descriptions["scandinavian"])
+	style_text = STYLE_DESCRIPTIONS.get(style, STYLE_DESCRIPTIONS["scandinavian"])
 	return f"{base_prompt}Interior style: {style_text}"
 
 
+def build_prompt(style: str, user_prompt: str = "") -> str:
+	"""Промпт стиля с дополнительными пожеланиями пользователя."""
+	style_prompt = get_style_prompt(style)
+	if user_prompt:
+		return f"{style_prompt}\nAdditional requirements: {user_prompt}".strip()
+	return style_prompt
+
+
 def _get_api_keys() -> list[str]:
 	keys_env = os.getenv("STABILITY_API_KEYS", "").strip()
 	if keys_env:
@@ -65,83 +103,587 @@ def _get_api_keys() -> list[str]:
 	return [single] if single else []
 
 
-def _get_style_reference_image_path(style: str, base_dir: str) -> str | None:
-	static_dir = os.path.join(base_dir, "static", "images")
-	mapping = {
-		"minimalism": os.path.join(static_dir, "example_interior.png"),
-		"modern": os.path.join(static_dir, "modern.png"),
-		"gothic": os.path.join(static_dir, "gothic.png"),
-		"shabby_chic": os.path.join(static_dir, "shabby-chic.png"),
-		"japanese": os.path.join(static_dir, "japanese.png"),
-		"scandinavian": os.path.join(static_dir, "scandinavian.png"),
-	}
-	path = mapping.get(style)
-	return path if path and os.path.exists(path) else None
+STYLE_REFERENCE_FILES = {
+	"minimalism": "example_interior.png",
+	"modern": "modern.png",
+	"gothic": "gothic.png",
+	"shabby_chic": "shabby-chic.png",
+	"japanese": "japanese.png",
+	"scandinavian": "scandinavian.png",
+}
 
 
-def generate_interior(prompt: str, image_path: str, output_path: str, style: str | None = None, base_dir: str | None = None) -> str | None:
-	api_keys = _get_api_keys()
-	if not api_keys:
-		raise RuntimeError("STABILITY_API_KEY(S) is not set in environment")
+_style_registries: dict[str, StyleAssetRegistry] = {}
+_style_registries_lock = threading.Lock()
+
+
+def get_style_assets(base_dir: str) -> StyleAssetRegistry:
+	"""Реестр сжатых референсов стилей; собирается один раз на процесс."""
+	with _style_registries_lock:
+		registry = _style_registries.get(base_dir)
+		if registry is None:
+			static_dir = os.path.join(base_dir, "static", "images")
+			registry = StyleAssetRegistry(
+				{style: os.path.join(static_dir, filename) for style, filename in STYLE_REFERENCE_FILES.items()},
+				max_side=int(os.getenv("STYLE_REFERENCE_MAX_SIDE", "1024")),
+				image_format=os.getenv("STYLE_REFERENCE_FORMAT", "WEBP"),
+				quality=int(os.getenv("STYLE_REFERENCE_QUALITY", "85")),
+			)
+			_style_registries[base_dir] = registry
+	registry.load()
+	return registry
+
+
+def _get_result_cache(output_path: str, cache_dir: str | None = None) -> ResultCache | None:
+	cache_dir = cache_dir or os.getenv("RESULT_CACHE_DIR") or os.path.join(os.path.dirname(os.path.abspath(output_path)), "cache")
+	return get_result_cache(cache_dir)
+
+
+def get_stability_key_pool() -> KeyPool:
+	"""Общий пул ключей STABILITY_API_KEYS."""
+	return get_key_pool(_get_api_keys)
+
+
+def _build_session() -> requests.Session:
+	# Keep-alive соединения переиспользуются между попытками и запросами,
+	# повторы делает сам generate_interior, поэтому у адаптера их нет
+	pool_size = int(os.getenv("STABILITY_HTTP_POOL_SIZE", "16"))
+	adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+	session = requests.Session()
+	session.mount("https://", adapter)
+	session.mount("http://", adapter)
+	return session
+
+
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+
+
+def _get_session() -> requests.Session:
+	# Сессия создаётся при первой генерации, а не при импорте модуля
+	global _session
+	if _session is None:
+		with _session_lock:
+			if _session is None:
+				_session = _build_session()
+	return _session
+
+
+STABILITY_ATTEMPTS = REGISTRY.counter(
+	"pizz_stability_attempts_total", "Запросы к Stability по коду ответа (error — сетевая ошибка)", ("status",)
+)
+STABILITY_ATTEMPTS_PER_GENERATION = REGISTRY.histogram(
+	"pizz_stability_attempts_per_generation", "Сколько ключей перебрала одна генерация", buckets=(1, 2, 3, 4, 6, 8, 12, 16)
+)
+GENERATIONS = REGISTRY.counter("pizz_generations_total", "Генерации по исходу", ("outcome",))
+HEDGES = REGISTRY.counter(
+	"pizz_stability_hedges_total", "Дублирующие попытки к Stability (fired — отправлена, won — ответила первой)", ("outcome",)
+)
 
-	url = "https://api.stability.ai/v2beta/stable-image/control/structure"
 
-	data = {
-		"prompt": prompt,
-		"output_format": "webp",
-		"strength": 0.7,
-	}
+def _build_multipart(data: dict, image_name: str, image_bytes: bytes, ref_asset: StyleAsset | None) -> tuple[bytes, str]:
+	"""Собирает multipart-тело один раз, чтобы не пересобирать его на каждый ключ."""
+	fields = [(name, str(value)) for name, value in data.items()]
+	fields.append(("image", (image_name, image_bytes)))
+	if ref_asset is not None:
+		fields.append(("reference_image", (ref_asset.filename, ref_asset.data, ref_asset.mime)))
+	return encode_multipart_formdata(fields)
+
+
+GENERATION_DATA = {
+	"output_format": "webp",
+	"strength": 0.7,
+}
+
+
+def _structure_url() -> str:
+	# STABILITY_API_BASE позволяет направить запросы на заглушку (бенчмарк) или прокси
+	return f"{os.getenv('STABILITY_API_BASE', 'https://api.stability.ai').rstrip('/')}/v2beta/stable-image/control/structure"
+
+
+def _prepare_generation(
+	prompt: str,
+	image_path: str,
+	output_path: str,
+	style: str | None,
+	base_dir: str | None,
+	image_bytes: bytes | memoryview | None,
+	cache_dir: str | None = None,
+) -> tuple | None:
+	"""Готовит тело запроса; None — результат уже взят из кэша и лежит в output_path."""
+	data = dict(GENERATION_DATA, prompt=prompt)
 	
-	# Получаем путь к reference image один раз
-	ref_path = None
+	# Референс стиля берём из памяти: он уже уменьшен и пережат при старте
+	ref_asset = None
 	if base_dir:
-		ref_path = _get_style_reference_image_path(style or "", base_dir)
-	
-	last_status = None
-	last_text = None
-	
-	# Пробуем каждый ключ, перечитывая файлы для каждой попытки
-	for key in api_keys:
-		headers = {"authorization": f"Bearer {key}", "accept": "image/*"}
-		
-		# Открываем файлы заново для каждой попытки
-		with open(image_path, "rb") as f:
-			files = {"image": f}
-			
-			# Открываем reference image, если есть
-			ref_file = None
-			if ref_path:
-				ref_file = open(ref_path, "rb")
-				files["reference_image"] = (os.path.basename(ref_path), ref_file, "image/png")
+		with span("stability.reference"):
+			ref_asset = get_style_assets(base_dir).get(style or "")
+	ref_bytes = ref_asset.data if ref_asset else None
+	
+	# Чертёж читается один раз на запрос, а не на каждую попытку
+	if image_bytes is None:
+		with span("stability.read_image"), open(image_path, "rb") as f:
+			image_bytes = f.read()
+	
+	# Одинаковый чертёж + промпт + референс + параметры дают результат из кэша
+	cache = _get_result_cache(output_path, cache_dir)
+	cache_key = None
+	if cache:
+		with span("stability.cache_lookup"):
+			cache_key = ResultCache.make_key(image_bytes, prompt, ref_bytes, data["strength"], data["output_format"])
+			cached = cache.get(cache_key, output_path)
+		if cached:
+			GENERATIONS.inc(outcome="cache_hit")
+			return None
+	
+	with span("stability.build_body"):
+		body, content_type = _build_multipart(
+			data,
+			os.path.basename(image_path),
+			image_bytes,
+			ref_asset,
+		)
+	return body, content_type, cache, cache_key
+
+
+def _save_result(
+	content: bytes,
+	output_path: str,
+	writer: AsyncFileWriter | None,
+	cache: ResultCache | None,
+	cache_key: str | None,
+) -> None:
+	with span("result.write"):
+		if writer:
+			writer.write(output_path, content)
+		else:
+			with open(output_path, "wb") as out:
+				out.write(content)
+	if cache_key:
+		with span("stability.cache_put"):
+			cache.put(cache_key, content, GENERATION_DATA["output_format"])
+
+
+def _release_attempt(
+	pool: KeyPool,
+	key: str,
+	status: int | None,
+	started: float,
+	retry_after: str | None,
+	attempts: list[str],
+	cancelled: bool = False,
+) -> None:
+	latency = time.monotonic() - started
+	pool.release(key, status, latency, retry_after)
+	if status == 200:
+		get_retry_policy().observe(latency)
+	attempts.append("cancelled" if cancelled else str(status) if status else "error")
+	STABILITY_ATTEMPTS.inc(status=attempts[-1])
+
+
+class _KeySlot:
+	"""Ключ, занятый одной попыткой; возвращается в пул ровно один раз."""
+	
+	def __init__(self, pool: KeyPool, key: str, attempts: list[str]):
+		self.pool = pool
+		self.key = key
+		self.attempts = attempts
+		self.started = time.monotonic()
+		self._released = False
+		self._lock = threading.Lock()
+	
+	def release(self, status: int | None, retry_after: str | None, cancelled: bool = False) -> None:
+		with self._lock:
+			if self._released:
+				return
+			self._released = True
+		_release_attempt(self.pool, self.key, status, self.started, retry_after, self.attempts, cancelled)
+
+
+class _Attempt:
+	"""Итог одной попытки: статус (None — сетевая ошибка или таймаут), Retry-After и тело ответа."""
+	
+	def __init__(self, key: str):
+		self.key = key
+		self.status: int | None = None
+		self.retry_after: str | None = None
+		self.content: bytes | None = None
+	
+	@property
+	def succeeded(self) -> bool:
+		return self.status == 200 and self.content is not None
+
+
+def key_label(key: str) -> str:
+	"""Ключ для журналов: только последние символы."""
+	return f"…{key[-4:]}"
+
+
+def _record_attempts(attempts: list[str]) -> None:
+	STABILITY_ATTEMPTS_PER_GENERATION.observe(len(attempts))
+	annotate(attempts=len(attempts), statuses="/".join(attempts) or "-")
+
+
+def generate_interior(
+	prompt: str,
+	image_path: str,
+	output_path: str,
+	style: str | None = None,
+	base_dir: str | None = None,
+	image_bytes: bytes | memoryview | None = None,
+	writer: AsyncFileWriter | None = None,
+	cache_dir: str | None = None,
+) -> str | None:
+	"""Генерирует интерьер по чертежу и сохраняет результат в output_path.
+
+	Если чертёж уже в памяти, его передают через image_bytes — тогда
+	image_path используется только как имя файла. С writer результат
+	пишется на диск в фоне, а до этого доступен через writer.read().
+	cache_dir — папка кэша результатов; без неё — RESULT_CACHE_DIR или
+	папка cache рядом с output_path.
+	"""
+	pool = get_stability_key_pool()
+	if not len(pool):
+		raise RuntimeError("STABILITY_API_KEY(S) is not set in environment")
+
+	url = _structure_url()
+	prepared = _prepare_generation(prompt, image_path, output_path, style, base_dir, image_bytes, cache_dir)
+	if prepared is None:
+		return output_path
+	body, content_type, cache, cache_key = prepared
+	
+	policy = get_retry_policy()
+	budget = policy.start()
+	tried: set[str] = set()
+	# Ключи, сорвавшиеся на временной ошибке: к ним можно вернуться, когда другие кончатся
+	transient: set[str] = set()
+	attempts: list[str] = []
+	
+	# Берём наименее загруженный здоровый ключ; ключи на паузе или в карантине пропускаются
+	try:
+		while not budget.exhausted():
+			with span("stability.key_wait"):
+				key = pool.acquire(exclude=tried, timeout=budget.remaining())
+			if key is None:
+				if not transient:
+					break
+				tried -= transient
+				transient.clear()
+				continue
+			tried.add(key)
+			budget.attempts += 1
+			attempt = _race_attempts(pool, policy, budget, url, key, content_type, body, tried, attempts)
 			
-			try:
-				response = requests.post(url, headers=headers, files=files, data=data, timeout=120)
-				last_status, last_text = response.status_code, getattr(response, "text", "")
-				
-				if response.status_code == 200:
-					with open(output_path, "wb") as out:
-						out.write(response.content)
-					# Закрываем ref_file перед возвратом
-					if ref_file:
-						ref_file.close()
-					return output_path
-				
-				# Если ошибка авторизации или лимита, пробуем следующий ключ
-				if response.status_code in (401, 402, 403, 429):
-					if ref_file:
-						ref_file.close()
-					continue
-				
-				# Для других ошибок прерываем цикл
-				if ref_file:
-					ref_file.close()
+			outcome = policy.classify(attempt.status)
+			if outcome == RETRY_DONE and attempt.succeeded:
+				_save_result(attempt.content, output_path, writer, cache, cache_key)
+				GENERATIONS.inc(outcome="done")
+				annotate(key=key_label(attempt.key))
+				return output_path
+			# Запрос отвергнут по существу — другой ключ не поможет
+			if outcome == RETRY_FATAL:
+				break
+			if outcome == RETRY_BACKOFF:
+				transient.update((key, attempt.key))
+				delay = budget.backoff(attempt.retry_after)
+				# Пауза, после которой повторить уже не успеть, бессмысленна
+				if budget.attempts >= policy.max_attempts or delay >= budget.remaining():
+					break
+				with span("stability.backoff"):
+					time.sleep(delay)
+	finally:
+		_record_attempts(attempts)
+	
+	GENERATIONS.inc(outcome="failed")
+	return None
+
+
+def _send_attempt(
+	pool: KeyPool,
+	url: str,
+	key: str,
+	content_type: str,
+	body: bytes,
+	timeout: float,
+	attempts: list[str],
+	cancelled: threading.Event | None = None,
+	slot: _KeySlot | None = None,
+) -> _Attempt:
+	attempt = _Attempt(key)
+	headers = {"authorization": f"Bearer {key}", "accept": "image/*", "content-type": content_type}
+	slot = slot or _KeySlot(pool, key, attempts)
+	try:
+		# Отправка чертежа и работа модели — до заголовков ответа, скачивание — отдельно
+		with span("stability.request"):
+			response = _get_session().post(url, headers=headers, data=body, timeout=timeout, stream=True)
+		with response:
+			attempt.status = response.status_code
+			attempt.retry_after = response.headers.get("Retry-After")
+			# Проигравшему дублю скачивать результат незачем
+			if cancelled is None or not cancelled.is_set():
+				with span("stability.download"):
+					attempt.content = response.content
+	except requests.RequestException:
+		pass
+	finally:
+		# Если ключ уже отдан победителем гонки, повторно он не освобождается
+		slot.release(attempt.status, attempt.retry_after)
+	return attempt
+
+
+_hedge_executor: ThreadPoolExecutor | None = None
+_hedge_executor_lock = threading.Lock()
+
+
+def _get_hedge_executor() -> ThreadPoolExecutor:
+	global _hedge_executor
+	if _hedge_executor is None:
+		with _hedge_executor_lock:
+			if _hedge_executor is None:
+				_hedge_executor = ThreadPoolExecutor(
+					max_workers=int(os.getenv("STABILITY_HEDGE_THREADS", "32")), thread_name_prefix="stability-hedge"
+				)
+	return _hedge_executor
+
+
+def _race_attempts(
+	pool: KeyPool,
+	policy: RetryPolicy,
+	budget: RetryBudget,
+	url: str,
+	key: str,
+	content_type: str,
+	body: bytes,
+	tried: set[str],
+	attempts: list[str],
+) -> _Attempt:
+	"""Попытка на ключе key; если она дольше порога хеджирования — дубль на втором ключе.
+
+	Побеждает первый успешный ответ. Дубль считается попыткой бюджета. Запрос
+	проигравшего потока прервать нельзя: он дорабатывает в фоне без скачивания
+	результата, а его ключ возвращается в пул сразу после выбора победителя.
+	"""
+	timeout = budget.attempt_timeout()
+	hedge_delay = policy.hedge_delay()
+	if hedge_delay is None or hedge_delay >= budget.remaining():
+		return _send_attempt(pool, url, key, content_type, body, timeout, attempts)
+	
+	cancelled = threading.Event()
+	executor = _get_hedge_executor()
+	slots: dict[Future, _KeySlot] = {}
+	
+	def submit(attempt_key: str) -> Future:
+		slot = _KeySlot(pool, attempt_key, attempts)
+		# Копия контекста — чтобы замеры этапов попали в трассировку генерации
+		context = contextvars.copy_context()
+		future = executor.submit(
+			context.run, _send_attempt, pool, url, attempt_key, content_type, body, timeout, attempts, cancelled, slot
+		)
+		slots[future] = slot
+		return future
+	
+	primary = submit(key)
+	pending = {primary}
+	done, _ = wait(pending, timeout=hedge_delay)
+	if not done and budget.attempts < policy.max_attempts:
+		hedge_key = pool.acquire(exclude=tried | {key}, timeout=0)
+		if hedge_key is not None:
+			tried.add(hedge_key)
+			budget.attempts += 1
+			HEDGES.inc(outcome="fired")
+			pending.add(submit(hedge_key))
+	
+	result = _Attempt(key)
+	try:
+		while pending:
+			done, pending = wait(pending, timeout=budget.remaining(), return_when=FIRST_COMPLETED)
+			if not done:
 				break
-				
-			except requests.RequestException as e:
-				last_text = str(e)
-				if ref_file:
-					ref_file.close()
+			for future in done:
+				attempt = future.result()
+				if attempt.succeeded:
+					if future is not primary:
+						HEDGES.inc(outcome="won")
+					return attempt
+				result = attempt
+	finally:
+		cancelled.set()
+		# Проигравший или не уложившийся в дедлайн запрос больше не держит ключ
+		for future in pending:
+			slots[future].release(None, None, cancelled=True)
+	return result
+
+
+_async_clients: dict[int, "httpx.AsyncClient"] = {}
+
+
+def _get_async_client() -> "httpx.AsyncClient":
+	"""Пул соединений для асинхронных запросов — свой у каждого event loop."""
+	import httpx
+	
+	loop_id = id(asyncio.get_running_loop())
+	client = _async_clients.get(loop_id)
+	if client is None:
+		pool_size = int(os.getenv("STABILITY_ASYNC_HTTP_POOL_SIZE", "256"))
+		client = httpx.AsyncClient(
+			timeout=120,
+			limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+		)
+		_async_clients[loop_id] = client
+	return client
+
+
+async def generate_interior_async(
+	prompt: str,
+	image_path: str,
+	output_path: str,
+	style: str | None = None,
+	base_dir: str | None = None,
+	image_bytes: bytes | memoryview | None = None,
+	writer: AsyncFileWriter | None = None,
+	cache_dir: str | None = None,
+) -> str | None:
+	"""То же, что generate_interior, но ожидание ответа модели не занимает поток.
+
+	Работа с диском и сборка тела идут в пуле потоков asyncio, запрос — через
+	общий httpx.AsyncClient, поэтому один процесс держит сотни генераций.
+	"""
+	pool = get_stability_key_pool()
+	if not len(pool):
+		raise RuntimeError("STABILITY_API_KEY(S) is not set in environment")
+
+	url = _structure_url()
+	prepared = await asyncio.to_thread(_prepare_generation, prompt, image_path, output_path, style, base_dir, image_bytes, cache_dir)
+	if prepared is None:
+		return output_path
+	body, content_type, cache, cache_key = prepared
+	client = _get_async_client()
+	
+	policy = get_retry_policy()
+	budget = policy.start()
+	tried: set[str] = set()
+	transient: set[str] = set()
+	attempts: list[str] = []
+	
+	try:
+		while not budget.exhausted():
+			with span("stability.key_wait"):
+				key = await pool.acquire_async(exclude=tried, timeout=budget.remaining())
+			if key is None:
+				if not transient:
+					break
+				tried -= transient
+				transient.clear()
 				continue
+			tried.add(key)
+			budget.attempts += 1
+			attempt = await _race_attempts_async(client, pool, policy, budget, url, key, content_type, body, tried, attempts)
+			
+			outcome = policy.classify(attempt.status)
+			if outcome == RETRY_DONE and attempt.succeeded:
+				await asyncio.to_thread(_save_result, attempt.content, output_path, writer, cache, cache_key)
+				GENERATIONS.inc(outcome="done")
+				annotate(key=key_label(attempt.key))
+				return output_path
+			if outcome == RETRY_FATAL:
+				break
+			if outcome == RETRY_BACKOFF:
+				transient.update((key, attempt.key))
+				delay = budget.backoff(attempt.retry_after)
+				# Пауза, после которой повторить уже не успеть, бессмысленна
+				if budget.attempts >= policy.max_attempts or delay >= budget.remaining():
+					break
+				with span("stability.backoff"):
+					await asyncio.sleep(delay)
+	finally:
+		_record_attempts(attempts)
 	
+	GENERATIONS.inc(outcome="failed")
 	return None
 
+
+async def _send_attempt_async(
+	client: "httpx.AsyncClient",
+	pool: KeyPool,
+	url: str,
+	key: str,
+	content_type: str,
+	body: bytes,
+	timeout: float,
+	attempts: list[str],
+) -> _Attempt:
+	import httpx
+	
+	attempt = _Attempt(key)
+	headers = {"authorization": f"Bearer {key}", "accept": "image/*", "content-type": content_type}
+	started = time.monotonic()
+	response = None
+	cancelled = False
+	try:
+		with span("stability.request"):
+			request = client.build_request("POST", url, headers=headers, content=body, timeout=timeout)
+			response = await client.send(request, stream=True)
+		attempt.status = response.status_code
+		attempt.retry_after = response.headers.get("Retry-After")
+		with span("stability.download"):
+			attempt.content = await response.aread()
+	except httpx.HTTPError:
+		pass
+	except asyncio.CancelledError:
+		cancelled = True
+		raise
+	finally:
+		if response is not None:
+			await response.aclose()
+		_release_attempt(pool, key, attempt.status, started, attempt.retry_after, attempts, cancelled)
+	return attempt
+
+
+async def _race_attempts_async(
+	client: "httpx.AsyncClient",
+	pool: KeyPool,
+	policy: RetryPolicy,
+	budget: RetryBudget,
+	url: str,
+	key: str,
+	content_type: str,
+	body: bytes,
+	tried: set[str],
+	attempts: list[str],
+) -> _Attempt:
+	"""Как _race_attempts, но проигравший запрос отменяется сразу вместе с соединением."""
+	timeout = budget.attempt_timeout()
+	primary = asyncio.ensure_future(_send_attempt_async(client, pool, url, key, content_type, body, timeout, attempts))
+	pending = {primary}
+	result = _Attempt(key)
+	try:
+		hedge_delay = policy.hedge_delay()
+		if hedge_delay is not None and hedge_delay < budget.remaining():
+			done, _ = await asyncio.wait(pending, timeout=hedge_delay)
+			if not done and budget.attempts < policy.max_attempts:
+				hedge_key = await pool.acquire_async(exclude=tried | {key}, timeout=0)
+				if hedge_key is not None:
+					tried.add(hedge_key)
+					budget.attempts += 1
+					HEDGES.inc(outcome="fired")
+					pending.add(asyncio.ensure_future(
+						_send_attempt_async(client, pool, url, hedge_key, content_type, body, timeout, attempts)
+					))
+		while pending:
+			done, pending = await asyncio.wait(pending, timeout=budget.remaining(), return_when=asyncio.FIRST_COMPLETED)
+			if not done:
+				break
+			for task in done:
+				attempt = task.result()
+				if attempt.succeeded:
+					if task is not primary:
+						HEDGES.inc(outcome="won")
+					return attempt
+				result = attempt
+	finally:
+		# Проигравший дубль или попытка, не уложившаяся в дедлайн, отменяются
+		for task in pending:
+			task.cancel()
+		if pending:
+			await asyncio.gather(*pending, return_exceptions=True)
+	return result
@@ -0,0 +1,445 @@
+import asyncio
+import inspect
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+from auth_security import TokenBucketLimiter
+from metrics import REGISTRY, end_trace, log_if_slow, observe_stage, start_trace
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+DEFAULT_TIER = 'default'
+
+QUEUE_DEPTH = REGISTRY.gauge('pizz_generation_queue_depth', 'Задачи в очереди по тарифу', ('tier',))
+QUEUE_RUNNING = REGISTRY.gauge('pizz_generation_running', 'Выполняющиеся задачи по тарифу', ('tier',))
+QUEUE_WAIT_SECONDS = REGISTRY.histogram('pizz_generation_queue_wait_seconds', 'Ожидание задачи в очереди по тарифу, с', ('tier',))
+ADMISSIONS = REGISTRY.counter('pizz_generation_admissions_total', 'Решения о приёме задач по тарифу', ('tier', 'result'))
+
+
+class QueueFullError(RuntimeError):
+    """Очередь генераций переполнена — задачу нужно отклонить сразу.
+
+    retry_after — через сколько секунд, по оценке очереди, стоит повторить.
+    """
+
+    def __init__(self, message: str, retry_after: float = 0.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QuotaExceededError(QueueFullError):
+    """Клиент исчерпал квоту запросов своего тарифа."""
+
+
+class TierPolicy:
+    """Правила очереди для одного тарифа.
+
+    weight — доля мощности при конкуренции тарифов (взвешенная справедливая очередь);
+    concurrency — сколько задач тарифа выполняется одновременно (0 — без ограничения);
+    rate_per_minute, burst — квота постановок в очередь одним клиентом (0 — без ограничения);
+    max_queued, max_wait — при большей очереди тарифа или оценке ожидания (с) задача
+    сразу отклоняется (0 — без ограничения).
+    """
+
+    def __init__(
+        self,
+        weight: float = 1.0,
+        concurrency: int = 0,
+        rate_per_minute: float = 0.0,
+        burst: int = 1,
+        max_queued: int = 0,
+        max_wait: float = 0.0,
+    ):
+        self.weight = max(weight, 0.01)
+        self.concurrency = concurrency
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+
+
+class _TierState:
+    def __init__(self, name: str, policy: TierPolicy):
+        self.name = name
+        self.policy = policy
+        self.limiter = TokenBucketLimiter(policy.rate_per_minute / 60, max(1, policy.burst))
+        self.queued: deque[Job] = deque()
+        self.running = 0
+        # Виртуальное время справедливой очереди: растёт на 1/weight с каждой выданной задачей
+        self.virtual_time = 0.0
+        self.avg_wait = 0.0
+
+    def can_run(self) -> bool:
+        return bool(self.queued) and (not self.policy.concurrency or self.running < self.policy.concurrency)
+
+
+class Job:
+    def __init__(self, func, args: tuple, kwargs: dict, meta: dict | None = None):
+        self.id = uuid.uuid4().hex
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.meta = dict(meta or {})
+        self.batch_id: str | None = None
+        self.tier = DEFAULT_TIER
+        self.status = JOB_QUEUED
+        self.result = None
+        self.error: str | None = None
+        self.created_at = time.time()
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        # on_change(job) вызывается при постановке, запуске и завершении задачи —
+        # например, чтобы сохранить состояние в общей для всех воркеров БД
+        self.on_change = None
+        self._notify_lock = threading.Lock()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (JOB_DONE, JOB_FAILED)
+
+    def to_dict(self) -> dict:
+        data = {
+            'id': self.id,
+            'batch_id': self.batch_id,
+            'tier': self.tier,
+            'status': self.status,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+        data.update(self.meta)
+        return data
+
+
+class JobQueue:
+    """Ограниченная очередь задач с пулом фоновых потоков.
+
+    Потоки стартуют лениво при первой задаче, чтобы не плодить их до fork()
+    в gunicorn. Завершённые задачи хранятся ограниченное время/количество.
+
+    Задачи делятся по тарифам (tiers): у каждого своя очередь, а потоки берут
+    задачи по взвешенной справедливой схеме — тариф с весом 4 получает вчетверо
+    больше мощности, чем с весом 1, но и лёгкий тариф не простаивает. Квоты и
+    пределы ожидания TierPolicy проверяются при постановке задачи.
+    """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        maxsize: int = 32,
+        keep_finished: int = 1000,
+        ttl: float = 3600.0,
+        slow_threshold: float = 0.0,
+        async_runner=None,
+        async_concurrency: int = 256,
+        tiers: dict[str, TierPolicy] | None = None,
+        default_tier: str = DEFAULT_TIER,
+        capacity=None,
+    ):
+        self.workers = max(1, workers)
+        self.maxsize = maxsize
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        self._batches: dict[str, list[str]] = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._tiers = {name: _TierState(name, policy) for name, policy in (tiers or {default_tier: TierPolicy()}).items()}
+        self._default_tier = default_tier
+        self._queued = 0
+        self._virtual_time = 0.0
+        # Среднее время выполнения задачи — для оценки ожидания (0 — ещё не измерено)
+        self._avg_run = 0.0
+        self._threads: list[threading.Thread] = []
+        self._keep_finished = keep_finished
+        self._ttl = ttl
+        # Задачи дольше slow_threshold секунд попадают в журнал с разбивкой по этапам
+        self._slow_threshold = slow_threshold
+        # Асинхронные задачи (async def) выполняются в event loop async_runner,
+        # одновременно не больше async_concurrency
+        self._async_runner = async_runner
+        self._async_slots = threading.BoundedSemaphore(max(1, async_concurrency))
+        self._capacity = max(1, async_concurrency) if async_runner is not None else self.workers
+        # capacity() — сколько задач на деле выполняется одновременно (например, ключи API ×
+        # запросы на ключ): сверх этого задачи ждут внутри, и оценка ожидания вышла бы занижена
+        self._capacity_func = capacity
+
+    def _ensure_workers(self) -> None:
+        if self._threads:
+            return
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'generation-worker-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(
+        self,
+        func,
+        *args,
+        meta: dict | None = None,
+        tier: str | None = None,
+        client: str | None = None,
+        on_change=None,
+        **kwargs,
+    ) -> Job:
+        """Ставит задачу в очередь тарифа tier; client — ключ квоты запросов (пользователь, IP)."""
+        job = Job(func, args, kwargs, meta)
+        job.on_change = on_change
+        self._enqueue([job], tier, client)
+        return job
+
+    def submit_batch(self, calls: list[tuple], tier: str | None = None, client: str | None = None, on_change=None) -> str:
+        """Ставит группу задач (func, args, kwargs, meta) — все сразу или ни одной."""
+        jobs = [Job(func, args, kwargs, meta) for func, args, kwargs, meta in calls]
+        for job in jobs:
+            job.on_change = on_change
+        batch_id = uuid.uuid4().hex
+        self._enqueue(jobs, tier, client, batch_id)
+        return batch_id
+
+    def _tier_state(self, tier: str | None) -> _TierState:
+        return self._tiers.get(tier) or self._tiers[self._default_tier]
+
+    def admit(self, count: int = 1, tier: str | None = None, client: str | None = None) -> None:
+        """Проверяет заранее, примет ли очередь count задач тарифа, и списывает квоту client.
+
+        Вызывается до дорогой подготовки запроса (разбор файла, запись на диск).
+        Задачи после admit() ставятся с client=None, а если очередь к тому
+        времени всё же отказала, квоту возвращает refund().
+        """
+        state = self._tier_state(tier)
+        with self._lock:
+            self._prune()
+            self._check_overload(state, count)
+            self._consume_quota(state, client)
+
+    def refund(self, tier: str | None, client: str) -> None:
+        """Возвращает квоту, списанную admit(), когда задачи так и не попали в очередь."""
+        self._tier_state(tier).limiter.refund(client)
+
+    def _check_overload(self, state: _TierState, count: int) -> None:
+        retry_after = self._overload_retry_after(state, count)
+        if retry_after is not None:
+            ADMISSIONS.inc(tier=state.name, result='rejected')
+            raise QueueFullError('Очередь генераций переполнена', retry_after)
+
+    @staticmethod
+    def _consume_quota(state: _TierState, client: str | None) -> None:
+        # Пакет стилей — одна постановка, квота считается по запросам, а не по задачам
+        if client is None:
+            return
+        wait = state.limiter.consume(client)
+        if wait:
+            ADMISSIONS.inc(tier=state.name, result='rate_limited')
+            raise QuotaExceededError('Превышена квота запросов тарифа', wait)
+
+    def _enqueue(self, jobs: list[Job], tier: str | None, client: str | None, batch_id: str | None = None) -> None:
+        state = self._tier_state(tier)
+        with self._ready:
+            self._ensure_workers()
+            self._prune()
+            # Сначала перегрузка, потом квота: отказ с 503 не тратит квоту клиента
+            self._check_overload(state, len(jobs))
+            self._consume_quota(state, client)
+            if not state.queued:
+                # Тариф, простаивавший без задач, не копит «кредит» в справедливой очереди
+                state.virtual_time = max(state.virtual_time, self._virtual_time)
+            for job in jobs:
+                job.tier = state.name
+                job.batch_id = batch_id
+                state.queued.append(job)
+                self._jobs[job.id] = job
+            if batch_id is not None:
+                self._batches[batch_id] = [job.id for job in jobs]
+            self._queued += len(jobs)
+            QUEUE_DEPTH.set(len(state.queued), tier=state.name)
+            self._ready.notify(len(jobs))
+        ADMISSIONS.inc(len(jobs), tier=state.name, result='admitted')
+        for job in jobs:
+            self._notify(job)
+
+    @staticmethod
+    def _notify(job: Job) -> None:
+        """Сообщает on_change о новом состоянии задачи; его ошибка не должна ронять очередь.
+
+        Вызовы по одной задаче идут по очереди, а обработчик читает её текущее
+        состояние, поэтому запоздавшее уведомление не затрёт более новое.
+        """
+        if job.on_change is None:
+            return
+        with job._notify_lock:
+            try:
+                job.on_change(job)
+            except Exception as exc:
+                logger.exception('Не удалось передать состояние задачи %s: %s', job.id, exc)
+
+    def _overload_retry_after(self, state: _TierState, count: int) -> float | None:
+        """None, если задачи можно принять, иначе рекомендуемая пауза перед повтором, с."""
+        policy = state.policy
+        wait = self._estimate_wait(state, count)
+        if policy.max_wait and wait > policy.max_wait:
+            return wait
+        if (policy.max_queued and len(state.queued) + count > policy.max_queued) or (
+            self.maxsize and self._queued + count > self.maxsize
+        ):
+            return max(1.0, wait, self._avg_run)
+        return None
+
+    def _estimate_wait(self, state: _TierState, count: int = 1) -> float:
+        """Примерное ожидание новой задачи тарифа: задачи впереди неё с учётом весов на среднее время задачи."""
+        if self._avg_run <= 0:
+            return 0.0
+        position = len(state.queued) + count
+        ahead = float(position)
+        for other in self._tiers.values():
+            if other is not state and other.queued:
+                ahead += min(len(other.queued), position * other.policy.weight / state.policy.weight)
+        slots = self._capacity
+        if self._capacity_func is not None:
+            slots = min(slots, max(1, self._capacity_func()))
+        if state.policy.concurrency:
+            slots = min(slots, state.policy.concurrency)
+        return ahead * self._avg_run / slots
+
+    def get_batch(self, batch_id: str) -> list[Job] | None:
+        with self._lock:
+            job_ids = self._batches.get(batch_id)
+            if job_ids is None:
+                return None
+            return [self._jobs[job_id] for job_id in job_ids if job_id in self._jobs]
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def position(self, job: Job) -> int:
+        """Примерное число задач своего тарифа, стоящих в очереди перед данной."""
+        if job.status != JOB_QUEUED:
+            return 0
+        with self._lock:
+            queued = self._tier_state(job.tier).queued
+            return queued.index(job) if job in queued else 0
+
+    def stats(self) -> dict:
+        """Очередь, выполняющиеся задачи и ожидание по тарифам."""
+        with self._lock:
+            return {
+                state.name: {
+                    'queued': len(state.queued),
+                    'running': state.running,
+                    'weight': state.policy.weight,
+                    'concurrency': state.policy.concurrency,
+                    'avg_wait': round(state.avg_wait, 2),
+                    'estimated_wait': round(self._estimate_wait(state), 2),
+                }
+                for state in self._tiers.values()
+            }
+
+    def _prune(self) -> None:
+        now = time.time()
+        finished = [j for j in self._jobs.values() if j.finished]
+        excess = len(finished) - self._keep_finished
+        for job in finished:
+            if excess > 0 or (job.finished_at and now - job.finished_at > self._ttl):
+                self._jobs.pop(job.id, None)
+                excess -= 1
+        for batch_id, job_ids in list(self._batches.items()):
+            if not any(job_id in self._jobs for job_id in job_ids):
+                del self._batches[batch_id]
+
+    def _next_job(self) -> Job:
+        """Ждёт задачу тарифа с наименьшим виртуальным временем, у которого есть свободный слот."""
+        with self._ready:
+            while True:
+                candidates = [state for state in self._tiers.values() if state.can_run()]
+                if candidates:
+                    break
+                self._ready.wait()
+            state = min(candidates, key=lambda item: item.virtual_time)
+            job = state.queued.popleft()
+            self._queued -= 1
+            state.running += 1
+            self._virtual_time = state.virtual_time
+            state.virtual_time += 1 / state.policy.weight
+            QUEUE_DEPTH.set(len(state.queued), tier=state.name)
+            QUEUE_RUNNING.set(state.running, tier=state.name)
+            return job
+
+    def _release(self, job: Job) -> None:
+        with self._ready:
+            state = self._tier_state(job.tier)
+            state.running -= 1
+            run_time = job.finished_at - job.started_at
+            self._avg_run = run_time if self._avg_run <= 0 else 0.8 * self._avg_run + 0.2 * run_time
+            QUEUE_RUNNING.set(state.running, tier=state.name)
+            # Освободился слот тарифа — его задачи могли ждать при свободных потоках
+            self._ready.notify_all()
+
+    def _start(self, job: Job):
+        job.status = JOB_RUNNING
+        job.started_at = time.time()
+        trace = start_trace(f'job {job.id}')
+        wait = job.started_at - job.created_at
+        observe_stage('queue.wait', wait)
+        QUEUE_WAIT_SECONDS.observe(wait, tier=job.tier)
+        state = self._tier_state(job.tier)
+        state.avg_wait = 0.8 * state.avg_wait + 0.2 * wait
+        return trace
+
+    def _finish(self, job: Job, trace, result=None, exc: Exception | None = None) -> None:
+        if exc is not None:
+            logger.error('Ошибка в задаче %s: %s', job.id, exc, exc_info=exc)
+            job.status = JOB_FAILED
+            job.error = f'Ошибка генерации: {exc}'
+        else:
+            job.result = result
+            job.status = JOB_DONE if result else JOB_FAILED
+            if not result and not job.error:
+                job.error = 'Ошибка генерации. Проверьте ключ API.'
+        job.finished_at = time.time()
+        self._release(job)
+        observe_stage('job.run', job.finished_at - job.started_at)
+        trace.attrs['status'] = job.status
+        end_trace()
+        log_if_slow(trace, self._slow_threshold, logger, elapsed=job.finished_at - job.created_at)
+
+    async def _run_async(self, job: Job) -> None:
+        try:
+            trace = self._start(job)
+            # on_change может ходить в БД — не в event loop
+            await asyncio.to_thread(self._notify, job)
+            try:
+                result = await job.func(*job.args, **job.kwargs)
+            except Exception as exc:
+                self._finish(job, trace, exc=exc)
+            else:
+                self._finish(job, trace, result)
+            await asyncio.to_thread(self._notify, job)
+        finally:
+            self._async_slots.release()
+
+    def _worker(self) -> None:
+        while True:
+            job = self._next_job()
+            if self._async_runner is not None and inspect.iscoroutinefunction(job.func):
+                # Корутина ждёт сеть в event loop и не держит поток; пока нет свободного
+                # слота, следующие задачи остаются в очереди — так лимит очереди продолжает работать
+                self._async_slots.acquire()
+                self._async_runner.submit(self._run_async(job))
+                continue
+            trace = self._start(job)
+            self._notify(job)
+            try:
+                result = job.func(*job.args, **job.kwargs)
+            except Exception as exc:
+                self._finish(job, trace, exc=exc)
+            else:
+                self._finish(job, trace, result)
+            self._notify(job)
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+logger = logging.getLogger(__name__)
+
+QUARANTINE_STATUSES = (401, 402, 403)
+RATE_LIMIT_STATUS = 429
+
+
+def parse_retry_after(value: str | None, default: float) -> float:
+    """Retry-After бывает числом секунд или HTTP-датой."""
+    if not value:
+        return default
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class KeyState:
+    def __init__(self, key: str):
+        self.key = key
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.quarantined_until = 0.0
+        self.latency: float | None = None
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.cooldown_until and now >= self.quarantined_until
+
+
+class KeyPool:
+    """Пул ключей Stability с учётом их состояния.
+
+    Ключ после 429 уходит на паузу (с учётом Retry-After), после 401/402/403 —
+    в карантин. Выдаётся наименее загруженный здоровый ключ, с ограничением
+    числа одновременных запросов на ключ.
+    """
+
+    def __init__(
+        self,
+        keys: list[str],
+        max_in_flight: int = 4,
+        cooldown: float = 30.0,
+        quarantine: float = 600.0,
+        latency_alpha: float = 0.3,
+    ):
+        self.max_in_flight = max(1, max_in_flight)
+        self.cooldown = cooldown
+        self.quarantine = quarantine
+        self.latency_alpha = latency_alpha
+        self._states = {key: KeyState(key) for key in dict.fromkeys(keys)}
+        self._cond = threading.Condition()
+        # Ожидающие acquire_async: (loop, event) — будятся из release() любого потока
+        self._async_waiters: set[tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def _pick(self, exclude: set[str], now: float) -> tuple[KeyState | None, bool]:
+        best = None
+        busy = False
+        for state in self._states.values():
+            if state.key in exclude or not state.healthy(now):
+                continue
+            if state.in_flight >= self.max_in_flight:
+                busy = True
+                continue
+            rank = (state.in_flight, state.latency if state.latency is not None else 0.0)
+            if best is None or rank < best[0]:
+                best = (rank, state)
+        return (best[1] if best else None), busy
+
+    def acquire(self, exclude: set[str] | None = None, timeout: float | None = None) -> str | None:
+        """Возвращает ключ или None, если здоровых ключей не осталось.
+
+        Если все здоровые ключи заняты, ждёт освобождения до timeout секунд.
+        """
+        exclude = exclude or set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                state, busy = self._pick(exclude, time.monotonic())
+                if state:
+                    state.in_flight += 1
+                    return state.key
+                if not busy:
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    async def acquire_async(self, exclude: set[str] | None = None, timeout: float | None = None) -> str | None:
+        """Как acquire(), но ожидание свободного ключа не блокирует event loop."""
+        exclude = exclude or set()
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            waiter = (loop, asyncio.Event())
+            with self._cond:
+                state, busy = self._pick(exclude, time.monotonic())
+                if state:
+                    state.in_flight += 1
+                    return state.key
+                if not busy:
+                    return None
+                self._async_waiters.add(waiter)
+            remaining = None if deadline is None else deadline - loop.time()
+            try:
+                if remaining is not None and remaining <= 0:
+                    return None
+                await asyncio.wait_for(waiter[1].wait(), remaining)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                with self._cond:
+                    self._async_waiters.discard(waiter)
+
+    def release(self, key: str, status: int | None, latency: float, retry_after: str | None = None) -> None:
+        with self._cond:
+            state = self._states.get(key)
+            if state is None:
+                return
+            state.in_flight = max(0, state.in_flight - 1)
+            now = time.monotonic()
+            if status == 200:
+                if state.latency is None:
+                    state.latency = latency
+                else:
+                    state.latency += self.latency_alpha * (latency - state.latency)
+            if status == RATE_LIMIT_STATUS:
+                state.cooldown_until = now + parse_retry_after(retry_after, self.cooldown)
+                logger.warning('Ключ …%s упёрся в лимит, пауза до %.0f с', key[-4:], state.cooldown_until - now)
+            elif status in QUARANTINE_STATUSES:
+                state.quarantined_until = now + self.quarantine
+                logger.warning('Ключ …%s отклонён (%s), карантин %.0f с', key[-4:], status, self.quarantine)
+            self._cond.notify_all()
+            for loop, event in self._async_waiters:
+                if not loop.is_closed():
+                    loop.call_soon_threadsafe(event.set)
+
+
+_pool: KeyPool | None = None
+_pool_source: tuple | None = None
+_pool_lock = threading.Lock()
+
+
+def get_key_pool(parse_keys) -> KeyPool:
+    """Общий для процесса пул; пересобирается только при смене ключей в окружении."""
+    global _pool, _pool_source
+    source = (os.getenv('STABILITY_API_KEYS', ''), os.getenv('STABILITY_API_KEY', ''))
+    with _pool_lock:
+        if _pool is None or source != _pool_source:
+            _pool = KeyPool(
+                parse_keys(),
+                max_in_flight=int(os.getenv('STABILITY_KEY_MAX_CONCURRENCY', '4')),
+                cooldown=float(os.getenv('STABILITY_KEY_COOLDOWN', '30')),
+                quarantine=float(os.getenv('STABILITY_KEY_QUARANTINE', '600')),
+            )
+            _pool_source = source
+        return _pool
@@ -0,0 +1,140 @@
+import logging
+import os
+import random
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_PENDING = 'pending'
+OUTBOX_SENDING = 'sending'
+OUTBOX_SENT = 'sent'
+OUTBOX_FAILED = 'failed'
+
+# Сервер недоступен или не пускает нас: проблема не в конкретном письме
+CONNECTION_SMTP_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, smtplib.SMTPAuthenticationError)
+
+
+def retry_delay(attempts: int, base: float = 30.0, cap: float = 3600.0) -> float:
+    """Экспоненциальная пауза перед повторной отправкой с небольшим разбросом."""
+    delay = min(cap, base * (2 ** max(0, attempts - 1)))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def is_connection_error(exc: Exception) -> bool:
+    """Ошибка соединения/авторизации, а не отказ по конкретному письму."""
+    if isinstance(exc, CONNECTION_SMTP_ERRORS):
+        return True
+    # 421 — сервер закрывает сессию, остальные письма тоже не пройдут
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return exc.smtp_code == 421
+    # SMTPException наследует OSError, поэтому сетевыми считаются только прочие OSError
+    return isinstance(exc, OSError) and not isinstance(exc, smtplib.SMTPException)
+
+
+def is_permanent_error(exc: Exception) -> bool:
+    """Отказ 5xx по письму (адрес, отправитель, содержимое): повторять бессмысленно."""
+    if is_connection_error(exc):
+        return False
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return all(500 <= code < 600 for code, _ in exc.recipients.values())
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return 500 <= exc.smtp_code < 600
+    return False
+
+
+class SMTPSender:
+    """Одно авторизованное SMTP-соединение, переиспользуемое между письмами.
+
+    Соединение открывается при первой отправке и закрывается, если простаивало
+    дольше idle_timeout (серверы сами рвут «висящие» сессии).
+    """
+
+    def __init__(
+        self,
+        server: str,
+        port: int,
+        username: str,
+        password: str,
+        use_tls: bool = True,
+        timeout: float = 30.0,
+        idle_timeout: float = 120.0,
+    ):
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._smtp: smtplib.SMTP | None = None
+        self._last_used = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> 'SMTPSender | None':
+        server = os.getenv('SMTP_SERVER')
+        username = os.getenv('SMTP_USERNAME')
+        password = os.getenv('SMTP_PASSWORD')
+        if not all([server, username, password]):
+            return None
+        return cls(
+            server,
+            int(os.getenv('SMTP_PORT', '587')),
+            username,
+            password,
+            use_tls=os.getenv('SMTP_USE_TLS', 'true').lower() == 'true',
+            idle_timeout=float(os.getenv('SMTP_IDLE_TIMEOUT', '120')),
+        )
+
+    def _connect(self) -> smtplib.SMTP:
+        smtp = smtplib.SMTP(self.server, self.port, timeout=self.timeout)
+        try:
+            if self.use_tls:
+                smtp.starttls()
+            smtp.login(self.username, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        return smtp
+
+    def send(self, msg: EmailMessage) -> None:
+        with self._lock:
+            if self._smtp is not None and time.monotonic() - self._last_used > self.idle_timeout:
+                self._close()
+            if self._smtp is None:
+                self._smtp = self._connect()
+            try:
+                self._smtp.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                # Сервер закрыл соединение между письмами — переподключаемся один раз
+                self._close()
+                self._smtp = self._connect()
+                self._smtp.send_message(msg)
+            except smtplib.SMTPRecipientsRefused:
+                raise
+            except smtplib.SMTPResponseException as exc:
+                # Отказ по конкретному письму не мешает слать следующие; 421 — сервер закрывает сессию
+                if exc.smtp_code == 421:
+                    self._close()
+                raise
+            except (OSError, smtplib.SMTPException):
+                self._close()
+                raise
+            self._last_used = time.monotonic()
+
+    def close_if_idle(self) -> None:
+        with self._lock:
+            if self._smtp is not None and time.monotonic() - self._last_used > self.idle_timeout:
+                self._close()
+
+    def _close(self) -> None:
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (OSError, smtplib.SMTPException):
+            self._smtp.close()
+        self._smtp = None
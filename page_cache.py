@@ -0,0 +1,194 @@
+"""Кэш отрендеренных страниц для анонимных посетителей.
+
+Декоратор cached_page сохраняет готовый HTML страницы (главная, форма
+генерации и т.п.) на PAGE_CACHE_TTL секунд. Ключ — путь страницы, язык
+посетителя и только перечисленные в query параметры запроса: произвольные
+?x=1, ?x=2… не заводят новых записей и не вытесняют настоящие страницы.
+Авторизованным пользователям и запросам с неотображёнными flash-сообщениями
+страница рендерится как обычно. Ответ несёт ETag, и
+повторный запрос браузера с If-None-Match получает пустой 304.
+
+Хранилище подключаемое: по умолчанию LRU в памяти процесса, 'redis' —
+общий кэш всех воркеров (нужен пакет redis), либо свой объект с методами
+get/set/delete_prefix.
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from functools import partial, wraps
+from urllib.parse import urlencode
+
+from flask import Response, current_app, request, session
+from flask_login import current_user
+
+from metrics import REGISTRY
+
+PAGE_CACHE_REQUESTS = REGISTRY.counter('pizz_page_cache_total', 'Запросы к кэшу страниц', ('result',))
+
+
+class MemoryPageBackend:
+    """LRU в памяти процесса: у каждого воркера свой."""
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete_prefix(self, prefix: str) -> int:
+        with self._lock:
+            keys = [key for key in self._entries if key.startswith(prefix)]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+
+class RedisPageBackend:
+    """Общий для всех воркеров кэш в Redis."""
+
+    def __init__(self, url: str):
+        try:
+            import redis
+        except ImportError as exc:  # redis необязателен: нужен только для общего кэша
+            raise RuntimeError('Для PAGE_CACHE_BACKEND=redis установите пакет redis.') from exc
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> bytes | None:
+        return self._client.get(key)
+
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        self._client.set(key, value, px=max(1, int(ttl * 1000)))
+
+    def delete_prefix(self, prefix: str) -> int:
+        removed = 0
+        for key in self._client.scan_iter(match=f'{prefix}*', count=500):
+            removed += self._client.delete(key)
+        return removed
+
+
+class CachedPage:
+    def __init__(self, body: bytes, content_type: str, etag: str):
+        self.body = body
+        self.content_type = content_type
+        self.etag = etag
+
+    def dumps(self) -> bytes:
+        header = json.dumps({'content_type': self.content_type, 'etag': self.etag}).encode('utf-8')
+        return header + b'\n' + self.body
+
+    @classmethod
+    def loads(cls, raw: bytes) -> 'CachedPage':
+        header, body = raw.split(b'\n', 1)
+        meta = json.loads(header)
+        return cls(body, meta['content_type'], meta['etag'])
+
+
+class PageCache:
+    def __init__(self, backend, ttl: float = 60.0, locales: tuple = ('ru',), key_prefix: str = 'pizz:page:'):
+        self.backend = backend
+        self.ttl = ttl
+        self.locales = tuple(locales)
+        self.key_prefix = key_prefix
+
+    @classmethod
+    def from_config(cls, config) -> 'PageCache | None':
+        """Кэш по настройкам приложения; None, если кэш выключен."""
+        backend = config.get('PAGE_CACHE_BACKEND', 'memory')
+        if not backend or backend == 'none' or config.get('PAGE_CACHE_TTL', 0) <= 0:
+            return None
+        if backend == 'memory':
+            backend = MemoryPageBackend(config.get('PAGE_CACHE_SIZE', 256))
+        elif backend == 'redis':
+            backend = RedisPageBackend(config['PAGE_CACHE_REDIS_URL'])
+        elif isinstance(backend, str):
+            raise ValueError(f'Неизвестный PAGE_CACHE_BACKEND: {backend}')
+        return cls(backend, config['PAGE_CACHE_TTL'], config.get('PAGE_CACHE_LOCALES', ('ru',)))
+
+    def key(self, endpoint: str, path: str, locale: str) -> str:
+        return f'{self.key_prefix}{endpoint}:{locale}:{path}'
+
+    def get(self, key: str) -> CachedPage | None:
+        raw = self.backend.get(key)
+        return CachedPage.loads(raw) if raw is not None else None
+
+    def set(self, key: str, page: CachedPage) -> None:
+        self.backend.set(key, page.dumps(), self.ttl)
+
+    def invalidate(self, endpoint: str | None = None) -> int:
+        """Сбрасывает кэш одной страницы (по endpoint) или всех."""
+        prefix = self.key_prefix + (f'{endpoint}:' if endpoint else '')
+        return self.backend.delete_prefix(prefix)
+
+
+def _page_response(page: CachedPage, cache_result: str) -> Response:
+    response = Response(page.body, content_type=page.content_type)
+    response.set_etag(page.etag)
+    # Браузер всегда переспрашивает сервер, но по ETag получает 304 без тела
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Page-Cache'] = cache_result
+    response.vary.update(('Cookie', 'Accept-Language'))
+    return response.make_conditional(request)
+
+
+def _page_path(query: tuple[str, ...]) -> str:
+    """Путь страницы и только те параметры запроса, от которых она зависит."""
+    params = sorted((name, value) for name in query for value in request.args.getlist(name))
+    return f'{request.path}?{urlencode(params)}' if params else request.path
+
+
+def cached_page(view=None, *, query: tuple[str, ...] = ()):
+    """Отдаёт GET-запросы анонимных посетителей из кэша страниц.
+
+    query — параметры строки запроса, меняющие страницу: @cached_page(query=('page',)).
+    """
+    if view is None:
+        return partial(cached_page, query=tuple(query))
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        cache = current_app.extensions.get('pizz_page_cache')
+        if (
+            cache is None
+            or request.method != 'GET'
+            or current_user.is_authenticated
+            or session.get('_flashes')
+        ):
+            PAGE_CACHE_REQUESTS.inc(result='bypass')
+            return view(*args, **kwargs)
+
+        locale = request.accept_languages.best_match(cache.locales) or cache.locales[0]
+        key = cache.key(request.endpoint, _page_path(query), locale)
+        page = cache.get(key)
+        if page is not None:
+            PAGE_CACHE_REQUESTS.inc(result='hit')
+            return _page_response(page, 'HIT')
+
+        PAGE_CACHE_REQUESTS.inc(result='miss')
+        response = current_app.make_response(view(*args, **kwargs))
+        if response.status_code != 200 or response.direct_passthrough or session.get('_flashes'):
+            return response
+        body = response.get_data()
+        page = CachedPage(body, response.content_type, hashlib.sha1(body).hexdigest())
+        cache.set(key, page)
+        return _page_response(page, 'MISS')
+
+    return wrapper
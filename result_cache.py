@@ -0,0 +1,207 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: индекс не защищён от параллельной записи процессами
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = 'index.json'
+LOCK_FILENAME = 'index.lock'
+
+
+class ResultCache:
+    """Кэш результатов генерации, адресуемый по содержимому запроса.
+
+    Файлы лежат в отдельной папке, индекс (ключ → файл, размер, время
+    последнего доступа) хранится на диске в index.json. При превышении
+    лимита по байтам вытесняются давно не использованные записи.
+
+    Папку делят все воркеры: при записи процесс под файловой блокировкой
+    сливает свои записи с индексом на диске, поэтому лимит общий.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, INDEX_FILENAME)
+        self.lock_path = os.path.join(directory, LOCK_FILENAME)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._index_mtime = 0.0
+
+    @staticmethod
+    def make_key(image_bytes: bytes, prompt: str, reference: bytes | None, strength: float, output_format: str) -> str:
+        digest = hashlib.sha256()
+        for part in (
+            hashlib.sha256(image_bytes).digest(),
+            prompt.encode('utf-8'),
+            hashlib.sha256(reference).digest() if reference else b'',
+            repr(strength).encode('ascii'),
+            output_format.encode('ascii'),
+        ):
+            digest.update(len(part).to_bytes(8, 'big'))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def _read_index(self) -> dict:
+        try:
+            self._index_mtime = os.path.getmtime(self.index_path)
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as exc:
+            logger.warning('Не удалось прочитать индекс кэша %s: %s', self.index_path, exc)
+            return {}
+
+    def _merge(self, disk: dict) -> dict:
+        """Записи с диска и свои; из двух версий одной записи — с более поздним доступом."""
+        merged = dict(disk)
+        for key, entry in self._entries.items():
+            other = merged.get(key)
+            if other is None or entry.get('last_access', 0) >= other.get('last_access', 0):
+                merged[key] = entry
+        return merged
+
+    def _set_entries(self, entries: dict) -> None:
+        # Записи без файла (вытесненные другим процессом) отбрасываются
+        entries = {
+            key: entry
+            for key, entry in entries.items()
+            if os.path.exists(os.path.join(self.directory, entry.get('file', '')))
+        }
+        self._entries = OrderedDict(sorted(entries.items(), key=lambda item: item[1].get('last_access', 0)))
+        self._total_bytes = sum(int(entry.get('size', 0)) for entry in self._entries.values())
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        os.makedirs(self.directory, exist_ok=True)
+        self._set_entries(self._read_index())
+
+    def _refresh(self) -> None:
+        """Подхватывает записи, добавленные другими процессами после последнего чтения индекса."""
+        try:
+            changed = os.path.getmtime(self.index_path) != self._index_mtime
+        except OSError:
+            return
+        if changed:
+            self._set_entries(self._merge(self._read_index()))
+
+    @contextmanager
+    def _index_lock(self):
+        with open(self.lock_path, 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _sync(self) -> None:
+        """Сливает свои записи с индексом на диске, вытесняет лишнее по общему лимиту и сохраняет индекс."""
+        with self._index_lock():
+            self._set_entries(self._merge(self._read_index()))
+            self._evict()
+            tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._entries, f)
+            os.replace(tmp_path, self.index_path)
+            self._index_mtime = os.path.getmtime(self.index_path)
+
+    def _evict(self) -> None:
+        while self._entries and self._total_bytes > self.max_bytes:
+            _, entry = self._entries.popitem(last=False)
+            self._total_bytes -= int(entry.get('size', 0))
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.directory, entry['file']))
+            except OSError:
+                pass
+
+    def get(self, key: str, output_path: str) -> bool:
+        """Копирует закэшированный результат в output_path. True при попадании."""
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+            if entry is None:
+                self._refresh()
+                entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False
+            cached_path = os.path.join(self.directory, entry['file'])
+            try:
+                shutil.copyfile(cached_path, output_path)
+            except OSError:
+                self._entries.pop(key, None)
+                self._total_bytes -= int(entry.get('size', 0))
+                self.misses += 1
+                return False
+            entry['last_access'] = time.time()
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def put(self, key: str, content: bytes, extension: str) -> None:
+        if len(content) > self.max_bytes:
+            return
+        with self._lock:
+            self._load()
+            filename = f'{key}.{extension}'
+            tmp_path = os.path.join(self.directory, f'{filename}.{os.getpid()}.tmp')
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, os.path.join(self.directory, filename))
+            previous = self._entries.pop(key, None)
+            if previous:
+                self._total_bytes -= int(previous.get('size', 0))
+            self._entries[key] = {'file': filename, 'size': len(content), 'last_access': time.time()}
+            self._total_bytes += len(content)
+            self._sync()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+_caches: dict[str, ResultCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_result_cache(directory: str) -> ResultCache | None:
+    """Общий для процесса кэш для папки; None, если кэш выключен."""
+    max_bytes = int(os.getenv('RESULT_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+    if max_bytes <= 0:
+        return None
+    with _caches_lock:
+        cache = _caches.get(directory)
+        if cache is None:
+            cache = _caches[directory] = ResultCache(directory, max_bytes)
+        return cache
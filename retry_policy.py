@@ -0,0 +1,147 @@
+"""Политика повторов запросов к Stability.
+
+У каждой генерации общий бюджет времени (deadline) на все попытки и
+ожидание ключей, поэтому с несколькими ключами запрос не висит минутами.
+Ответы делятся на:
+
+* done — успех;
+* next_key — проблема конкретного ключа (401/402/403/429): сразу другой ключ;
+* retry — временный сбой (сеть, 408, 5xx): повтор с экспоненциальной паузой
+  со случайным разбросом, по возможности на другом ключе;
+* fatal — запрос отвергнут по существу (400, 413, 422…): повторять бессмысленно.
+
+Хеджирование (STABILITY_HEDGE=true): если попытка идёт дольше наблюдаемого
+p95, такой же запрос уходит на второй свободный ключ; побеждает первый
+успешный ответ, второй отменяется. Срезает хвост задержек ценой лишних
+запросов, поэтому по умолчанию выключено.
+"""
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from key_pool import parse_retry_after
+
+RETRY_DONE = 'done'
+RETRY_NEXT_KEY = 'next_key'
+RETRY_BACKOFF = 'retry'
+RETRY_FATAL = 'fatal'
+
+KEY_STATUSES = (401, 402, 403, 429)
+RETRYABLE_STATUSES = (408, 425, 500, 502, 503, 504)
+
+
+class RetryBudget:
+    """Состояние повторов одной генерации: оставшееся время и попытки."""
+
+    def __init__(self, policy: 'RetryPolicy'):
+        self.policy = policy
+        self.deadline = time.monotonic() + policy.deadline
+        self.attempts = 0
+        self.retries = 0
+
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    def exhausted(self) -> bool:
+        return self.remaining() <= 0 or self.attempts >= self.policy.max_attempts
+
+    def attempt_timeout(self) -> float:
+        return max(0.001, min(self.policy.attempt_timeout, self.remaining()))
+
+    def backoff(self, retry_after: str | None = None) -> float:
+        """Пауза перед повтором: «полный разброс» от 0 до base·2ⁿ, не меньше Retry-After и не дальше дедлайна."""
+        self.retries += 1
+        ceiling = min(self.policy.backoff_cap, self.policy.backoff_base * (2 ** (self.retries - 1)))
+        delay = random.uniform(0, ceiling)
+        if retry_after:
+            delay = max(delay, parse_retry_after(retry_after, 0.0))
+        return min(delay, self.remaining())
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        deadline: float = 180.0,
+        attempt_timeout: float = 120.0,
+        max_attempts: int = 6,
+        backoff_base: float = 0.5,
+        backoff_cap: float = 8.0,
+        hedge: bool = False,
+        hedge_quantile: float = 0.95,
+        hedge_min_delay: float = 2.0,
+        hedge_min_samples: int = 20,
+        window: int = 200,
+    ):
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        # Длительности последних успешных попыток — по ним считается порог хеджирования
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> 'RetryPolicy':
+        return cls(
+            deadline=float(os.getenv('STABILITY_DEADLINE', '180')),
+            attempt_timeout=float(os.getenv('STABILITY_ATTEMPT_TIMEOUT', '120')),
+            max_attempts=int(os.getenv('STABILITY_MAX_ATTEMPTS', '6')),
+            backoff_base=float(os.getenv('STABILITY_BACKOFF_BASE', '0.5')),
+            backoff_cap=float(os.getenv('STABILITY_BACKOFF_CAP', '8')),
+            hedge=os.getenv('STABILITY_HEDGE', 'false').lower() == 'true',
+            hedge_quantile=float(os.getenv('STABILITY_HEDGE_QUANTILE', '0.95')),
+            hedge_min_delay=float(os.getenv('STABILITY_HEDGE_MIN_DELAY', '2')),
+            hedge_min_samples=int(os.getenv('STABILITY_HEDGE_MIN_SAMPLES', '20')),
+        )
+
+    def start(self) -> RetryBudget:
+        return RetryBudget(self)
+
+    @staticmethod
+    def classify(status: int | None) -> str:
+        """Что делать после ответа со статусом status (None — сетевая ошибка или таймаут)."""
+        if status == 200:
+            return RETRY_DONE
+        if status in KEY_STATUSES:
+            return RETRY_NEXT_KEY
+        if status is None or status in RETRYABLE_STATUSES:
+            return RETRY_BACKOFF
+        return RETRY_FATAL
+
+    def observe(self, seconds: float) -> None:
+        """Запоминает длительность успешной попытки."""
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def hedge_delay(self) -> float | None:
+        """Через сколько секунд дублировать попытку; None — хеджирование выключено или мало данных."""
+        if not self.hedge:
+            return None
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < self.hedge_min_samples:
+            return None
+        index = min(len(samples) - 1, max(0, math.ceil(self.hedge_quantile * len(samples)) - 1))
+        return max(self.hedge_min_delay, samples[index])
+
+
+_policy: RetryPolicy | None = None
+_policy_lock = threading.Lock()
+
+
+def get_retry_policy() -> RetryPolicy:
+    """Общая для процесса политика: статистика задержек копится между генерациями."""
+    global _policy
+    if _policy is None:
+        with _policy_lock:
+            if _policy is None:
+                _policy = RetryPolicy.from_env()
+    return _policy
@@ -0,0 +1,94 @@
+"""Проверка холодного старта приложения::
+
+    python startup_check.py                  # бюджет из STARTUP_BUDGET_MS (по умолчанию 1000 мс)
+    python startup_check.py --budget-ms 800 --top 20
+
+В отдельном процессе выполняет `import app; app.create_app()` под
+`python -X importtime`, печатает самые тяжёлые импорты и завершается с кодом 1,
+если старт дольше бюджета или при импорте подтянулись модули, которые должны
+загружаться лениво (клиенты OpenAI и httpx нужны только при первом запросе).
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Пакеты, которые приложение импортирует только при первом использовании
+LAZY_MODULES = ('openai', 'httpx')
+
+STARTUP_CODE = (
+    'import time; started = time.perf_counter(); '
+    'import app; app.create_app(); '
+    'print(f"{(time.perf_counter() - started) * 1000:.1f}")'
+)
+
+
+def parse_importtime(stderr: str) -> list[tuple[str, int, int]]:
+    """Строки `import time: self | cumulative | name` → (модуль, self мкс, cumulative мкс)."""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3:
+            continue
+        try:
+            self_us, cumulative_us = int(parts[0]), int(parts[1])
+        except ValueError:
+            continue  # заголовок таблицы
+        entries.append((parts[2].strip(), self_us, cumulative_us))
+    return entries
+
+
+def measure(python: str = sys.executable) -> tuple[float, list[tuple[str, int, int]]]:
+    """(время старта в мс, импорты) для одного холодного запуска."""
+    result = subprocess.run(
+        [python, '-X', 'importtime', '-c', STARTUP_CODE],
+        cwd=BASE_DIR,
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f'Не удалось импортировать приложение:\n{result.stderr[-2000:]}')
+    return float(result.stdout.strip().splitlines()[-1]), parse_importtime(result.stderr)
+
+
+def heaviest_packages(entries: list[tuple[str, int, int]], top: int) -> list[tuple[str, int]]:
+    """Суммарное собственное время импорта по корневым пакетам, мкс."""
+    totals: dict[str, int] = {}
+    for name, self_us, _ in entries:
+        root = name.split('.')[0]
+        totals[root] = totals.get(root, 0) + self_us
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)[:top]
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Проверка времени холодного старта приложения')
+    parser.add_argument('--budget-ms', type=float, default=float(os.getenv('STARTUP_BUDGET_MS', '1000')))
+    parser.add_argument('--runs', type=int, default=3, help='запусков; берётся лучший (меньше шума)')
+    parser.add_argument('--top', type=int, default=10, help='сколько тяжёлых пакетов показать')
+    args = parser.parse_args(argv)
+
+    runs = [measure() for _ in range(max(1, args.runs))]
+    elapsed, entries = min(runs, key=lambda run: run[0])
+
+    print(f'Старт приложения: {elapsed:.0f} мс (бюджет {args.budget_ms:.0f} мс)')
+    for package, self_us in heaviest_packages(entries, args.top):
+        print(f'  {package:<28} {self_us / 1000:8.1f} мс')
+
+    failed = False
+    loaded = sorted({name.split('.')[0] for name, _, _ in entries} & set(LAZY_MODULES))
+    if loaded:
+        print(f'Модули должны загружаться лениво, но импортированы при старте: {", ".join(loaded)}')
+        failed = True
+    if elapsed > args.budget_ms:
+        print('Бюджет холодного старта превышен.')
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
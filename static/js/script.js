@@ -150,18 +150,23 @@ async function sendMessage() {
             headers: {
                 'Content-Type': 'application/json'
             },
-            body: JSON.stringify({ messages: chatHistory })
+            body: JSON.stringify({ messages: chatHistory, stream: true })
         });
 
-        const data = await response.json();
-
-        if (!response.ok || !data.reply) {
-            throw new Error(data.error || 'Ошибка сервера');
+        const contentType = response.headers.get('Content-Type') || '';
+        if (!response.ok || !contentType.includes('application/x-ndjson') || !response.body) {
+            const data = await response.json();
+            if (!response.ok || !data.reply) {
+                throw new Error(data.error || 'Ошибка сервера');
+            }
+            typingMessage.innerHTML = `<p>${data.reply}</p>`;
+            typingMessage.classList.remove('typing');
+            chatHistory.push({ role: 'assistant', content: data.reply });
+            return;
         }
 
-        typingMessage.innerHTML = `<p>${data.reply}</p>`;
-        typingMessage.classList.remove('typing');
-        chatHistory.push({ role: 'assistant', content: data.reply });
+        const reply = await readChatStream(response, typingMessage, chatMessages);
+        chatHistory.push({ role: 'assistant', content: reply });
     } catch (error) {
         typingMessage.innerHTML = `<p>Не удалось получить ответ. Попробуйте ещё раз.</p>`;
         typingMessage.classList.remove('typing');
@@ -172,12 +177,134 @@ async function sendMessage() {
     }
 }
 
+// построчное чтение NDJSON-потока ответа ассистента
+async function readChatStream(response, messageElement, chatMessages) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    const textElement = document.createElement('p');
+    let buffer = '';
+    let reply = '';
+
+    const handleLine = (line) => {
+        if (!line.trim()) return;
+        const data = JSON.parse(line);
+        if (data.error) {
+            throw new Error(data.error);
+        }
+        if (data.delta) {
+            if (reply === '') {
+                messageElement.replaceChildren(textElement);
+                messageElement.classList.remove('typing');
+            }
+            reply += data.delta;
+            textElement.textContent = reply;
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+        }
+    };
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        lines.forEach(handleLine);
+    }
+    handleLine(buffer + decoder.decode());
+
+    if (!reply) {
+        throw new Error('Пустой ответ ассистента');
+    }
+    return reply;
+}
+
 function handleChatKeyPress(event) {
     if (event.key === 'Enter') {
         sendMessage();
     }
 }
 
+// опрос статуса генерации
+async function pollJob(jobId, delay = 2000) {
+    const statusElement = document.getElementById('job-status');
+    const errorElement = document.getElementById('job-error');
+    const resultElement = document.getElementById('job-result');
+
+    try {
+        const response = await fetch(`/jobs/${jobId}`);
+        const data = await response.json();
+
+        if (!response.ok) {
+            throw new Error(data.error || 'Ошибка сервера');
+        }
+
+        if (data.status === 'done') {
+            resultElement.src = data.result_url;
+            resultElement.style.display = '';
+            statusElement.style.display = 'none';
+            return;
+        }
+
+        if (data.status === 'failed') {
+            errorElement.textContent = data.error || 'Ошибка генерации.';
+            errorElement.style.display = '';
+            statusElement.style.display = 'none';
+            return;
+        }
+
+        if (data.position > 0) {
+            statusElement.textContent = `Ваша задача в очереди, перед вами: ${data.position}`;
+        } else {
+            statusElement.textContent = 'Генерируем интерьер, это может занять до пары минут...';
+        }
+    } catch (error) {
+        console.error(error);
+    }
+
+    setTimeout(() => pollJob(jobId, Math.min(delay * 1.5, 10000)), delay);
+}
+
+// опрос статуса пакетной генерации по нескольким стилям
+async function pollBatch(batchId, delay = 2000) {
+    const statusElement = document.getElementById('batch-status');
+
+    try {
+        const response = await fetch(`/batches/${batchId}`);
+        const data = await response.json();
+
+        if (!response.ok) {
+            throw new Error(data.error || 'Ошибка сервера');
+        }
+
+        data.jobs.forEach(job => {
+            const card = document.getElementById(`batch-job-${job.id}`);
+            if (!card) return;
+            const resultElement = card.querySelector('[data-role="result"]');
+            const errorElement = card.querySelector('[data-role="error"]');
+            const pendingElement = card.querySelector('[data-role="pending"]');
+
+            if (job.status === 'done' && !resultElement.getAttribute('src')) {
+                resultElement.src = job.result_url;
+                resultElement.style.display = '';
+                pendingElement.style.display = 'none';
+            } else if (job.status === 'failed') {
+                errorElement.textContent = job.error || 'Ошибка генерации.';
+                errorElement.style.display = '';
+                pendingElement.style.display = 'none';
+            }
+        });
+
+        if (data.finished) {
+            statusElement.textContent = 'Готово! Сравните стили ниже.';
+            return;
+        }
+    } catch (error) {
+        console.error(error);
+    }
+
+    setTimeout(() => pollBatch(batchId, Math.min(delay * 1.5, 10000)), delay);
+}
+
 // FAQ аккордеон
 document.addEventListener('DOMContentLoaded', function() {
     const faqItems = document.querySelectorAll('.faq-item');
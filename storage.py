@@ -0,0 +1,165 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка между процессами недоступна
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Имена, которые создаёт приложение: blueprint_<uuid>.ext / result_<uuid>[_style].webp
+STORED_NAME_PATTERN = re.compile(r'^(blueprint|result)_[A-Za-z0-9_]+\.[A-Za-z0-9]+$')
+SHARD_PATTERN = re.compile(r'^[0-9a-f]{2}$')
+
+
+class ShardedStorage:
+    """Папка с файлами, разложенными по подпапкам по префиксу хэша имени.
+
+    blueprint_abc.jpg → uploads/3f/9c/blueprint_abc.jpg. Так в одной папке
+    не скапливаются миллионы файлов. Файлы, сохранённые до шардирования
+    прямо в корне, по-прежнему находятся через locate().
+    """
+
+    def __init__(self, root: str, depth: int = 2):
+        self.root = root
+        self.depth = depth
+
+    def _shards(self, filename: str) -> list[str]:
+        digest = hashlib.sha1(filename.encode('utf-8')).hexdigest()
+        return [digest[2 * level:2 * level + 2] for level in range(self.depth)]
+
+    def path(self, filename: str, create: bool = False) -> str:
+        directory = os.path.join(self.root, *self._shards(filename))
+        if create:
+            os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, filename)
+
+    def locate(self, filename: str) -> str | None:
+        """Путь к существующему файлу (шардированному или старому плоскому) или None."""
+        if not STORED_NAME_PATTERN.match(filename):
+            return None
+        for path in (self.path(filename), os.path.join(self.root, filename)):
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def delete(self, filename: str) -> int:
+        path = self.locate(filename)
+        if path is None:
+            return 0
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError as exc:
+            logger.warning('Не удалось удалить %s: %s', path, exc)
+            return 0
+        return size
+
+    def iter_files(self):
+        """Обходит файлы приложения: (имя, путь, размер, mtime)."""
+        stack = [(self.root, 0)]
+        while stack:
+            directory, level = stack.pop()
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if level < self.depth and SHARD_PATTERN.match(entry.name):
+                        stack.append((entry.path, level + 1))
+                elif STORED_NAME_PATTERN.match(entry.name):
+                    stat = entry.stat()
+                    yield entry.name, entry.path, stat.st_size, stat.st_mtime
+
+
+class ExclusiveRun:
+    """Запуск задачи одним процессом из нескольких и не чаще раза в interval секунд.
+
+    Воркеры gunicorn делят файл-блокировку (fcntl.flock): пока один выполняет
+    задачу, остальные пропускают ход. В том же файле — время последнего
+    запуска, чтобы следующий воркер не повторял только что сделанную работу.
+    """
+
+    def __init__(self, path: str, interval: float):
+        self.path = path
+        self.interval = interval
+
+    def __call__(self, func) -> bool:
+        """Вызывает func, если подошла очередь. True — задача выполнена этим процессом."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'a+', encoding='ascii') as f:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return False
+            try:
+                f.seek(0)
+                try:
+                    last_run = float(f.read().strip() or 0)
+                except ValueError:
+                    last_run = 0.0
+                if time.time() - last_run < self.interval:
+                    return False
+                func()
+                f.seek(0)
+                f.truncate()
+                f.write(f'{time.time():.3f}')
+                f.flush()
+                return True
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class PeriodicTask:
+    """Фоновый поток, вызывающий func раз в interval секунд.
+
+    Стартует лениво (ensure_started), чтобы поток создавался уже после fork().
+    wake() запускает очередной вызов, не дожидаясь конца интервала, stop()
+    останавливает поток, давая закончиться уже начатому вызову.
+    """
+
+    def __init__(self, func, interval: float, name: str):
+        self.func = func
+        self.interval = interval
+        self.name = name
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+
+    def ensure_started(self) -> None:
+        if self._thread is not None or self.interval <= 0:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def stop(self, timeout: float | None = 10.0) -> None:
+        self._stop.set()
+        self._wake.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            try:
+                self.func()
+            except Exception as exc:
+                logger.exception('Ошибка фоновой задачи %s: %s', self.name, exc)
@@ -0,0 +1,87 @@
+import hashlib
+import io
+import logging
+import os
+import threading
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+FORMAT_MIME = {'WEBP': 'image/webp', 'JPEG': 'image/jpeg', 'PNG': 'image/png'}
+FORMAT_EXT = {'WEBP': 'webp', 'JPEG': 'jpg', 'PNG': 'png'}
+
+
+class StyleAsset:
+    def __init__(self, style: str, filename: str, data: bytes, mime: str):
+        self.style = style
+        self.filename = filename
+        self.data = data
+        self.mime = mime
+
+
+class StyleAssetRegistry:
+    """Референсы стилей, подготовленные один раз на процесс.
+
+    Каждая картинка уменьшается до max_side по большей стороне и
+    пережимается в компактный формат. Одинаковые исходники (по хэшу)
+    кодируются один раз и делят общий буфер.
+    """
+
+    def __init__(self, sources: dict[str, str], max_side: int = 1024, image_format: str = 'WEBP', quality: int = 85):
+        self.sources = sources
+        self.max_side = max_side
+        self.image_format = image_format.upper()
+        self.quality = quality
+        self._assets: dict[str, StyleAsset] = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def _encode(self, raw: bytes) -> bytes:
+        with Image.open(io.BytesIO(raw)) as image:
+            image.load()
+            if self.image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            image.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+            out = io.BytesIO()
+            image.save(out, format=self.image_format, quality=self.quality, optimize=True)
+            return out.getvalue()
+
+    def load(self) -> None:
+        with self._lock:
+            if self._loaded:
+                return
+            encoded_by_digest: dict[str, tuple[bytes, str, str]] = {}
+            source_bytes = 0
+            for style, path in self.sources.items():
+                if not os.path.exists(path):
+                    continue
+                with open(path, 'rb') as f:
+                    raw = f.read()
+                digest = hashlib.sha256(raw).hexdigest()
+                encoded = encoded_by_digest.get(digest)
+                if encoded is None:
+                    try:
+                        encoded = (self._encode(raw), FORMAT_EXT[self.image_format], FORMAT_MIME[self.image_format])
+                    except OSError as exc:
+                        logger.warning('Не удалось подготовить референс %s: %s', path, exc)
+                        continue
+                    # Если пережатие не помогло, отправляем оригинал
+                    if len(encoded[0]) >= len(raw):
+                        encoded = (raw, os.path.splitext(path)[1].lstrip('.'), 'image/png')
+                    encoded_by_digest[digest] = encoded
+                    source_bytes += len(raw)
+                data, ext, mime = encoded
+                filename = f'{os.path.splitext(os.path.basename(path))[0]}.{ext}'
+                self._assets[style] = StyleAsset(style, filename, data, mime)
+            self._loaded = True
+            encoded_bytes = sum(len(encoded[0]) for encoded in encoded_by_digest.values())
+            logger.info(
+                'Референсы стилей: %d стилей, %d уникальных, %d → %d байт',
+                len(self._assets), len(encoded_by_digest), source_bytes, encoded_bytes,
+            )
+
+    def get(self, style: str) -> StyleAsset | None:
+        if not self._loaded:
+            self.load()
+        return self._assets.get(style)
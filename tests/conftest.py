@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# Модули приложения лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Тесты не трогают рабочую базу app.db и не запускают фоновые задачи
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='pizz-tests-'), 'test.db')}"
+os.environ['OUTBOX_INTERVAL'] = '0'
+os.environ['STORAGE_GC_INTERVAL'] = '0'
@@ -0,0 +1,306 @@
+import io
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+import app as app_module
+from jobs import JobQueue, TierPolicy
+
+
+class FakeOpenAI:
+    """Отдаёт заранее заданные фрагменты ответа, как stream=True у OpenAI."""
+
+    def __init__(self, deltas, fail_after=None):
+        self.deltas = deltas
+        self.fail_after = fail_after
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        self.requests.append(kwargs)
+        return self._stream()
+
+    def _stream(self):
+        for number, delta in enumerate(self.deltas):
+            if number == self.fail_after:
+                raise RuntimeError('обрыв соединения')
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=delta))])
+
+
+@pytest.fixture
+def application(tmp_path):
+    application = app_module.create_app({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'app.db'}",
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        'RESULT_FOLDER': str(tmp_path / 'results'),
+    })
+    with application.app_context():
+        app_module.init_db()
+    return application
+
+
+@pytest.fixture
+def client(application, monkeypatch):
+    monkeypatch.setattr(app_module, 'openai_api_key', 'test-key')
+    return application.test_client()
+
+
+def _lines(response) -> list[dict]:
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_reply_is_streamed_as_ndjson(client, monkeypatch):
+    openai = FakeOpenAI(['Здрав', None, 'ствуйте'])
+    monkeypatch.setattr(app_module, 'get_openai_client', lambda: openai)
+    response = client.post('/chat', json={'stream': True, 'messages': [{'role': 'user', 'content': 'Привет'}]})
+    assert response.mimetype == 'application/x-ndjson'
+    assert response.headers['X-Accel-Buffering'] == 'no'
+    assert _lines(response) == [{'delta': 'Здрав'}, {'delta': 'ствуйте'}, {'done': True}]
+    assert openai.requests[0]['stream'] is True
+
+
+def test_stream_failure_ends_with_error_line(client, monkeypatch):
+    monkeypatch.setattr(app_module, 'get_openai_client', lambda: FakeOpenAI(['Здрав', 'ствуйте'], fail_after=1))
+    lines = _lines(client.post('/chat', json={'stream': True, 'messages': [{'role': 'user', 'content': 'Сколько стоит?'}]}))
+    assert lines[0] == {'delta': 'Здрав'}
+    assert 'error' in lines[-1]
+
+
+def test_repeated_first_question_is_answered_from_cache(client, monkeypatch):
+    monkeypatch.setattr(app_module, 'get_openai_client', lambda: FakeOpenAI(['Да, ', 'японский есть.']))
+    first = client.post('/chat', json={'stream': True, 'messages': [{'role': 'user', 'content': 'Есть японский стиль?'}]})
+    assert _lines(first)[-1] == {'done': True}
+
+    monkeypatch.setattr(app_module, 'get_openai_client', lambda: None)
+    second = client.post('/chat', json={'messages': [{'role': 'user', 'content': 'есть  ЯПОНСКИЙ стиль'}]})
+    assert second.get_json() == {'reply': 'Да, японский есть.'}
+
+
+def _blueprint_png() -> bytes:
+    out = io.BytesIO()
+    Image.new('RGB', (64, 64), 'white').save(out, format='PNG')
+    return out.getvalue()
+
+
+def test_several_styles_fan_out_into_one_batch(application, client, monkeypatch):
+    calls = []
+
+    def fake_generate(prompt, image_path, output_path, style, base_dir, **kwargs):
+        calls.append((style, kwargs['image_bytes']))
+        kwargs['writer'].write(output_path, b'interior')
+        return output_path
+
+    async def fake_generate_async(*args, **kwargs):
+        return fake_generate(*args, **kwargs)
+
+    monkeypatch.setattr(app_module, 'generate_interior', fake_generate)
+    monkeypatch.setattr(app_module, 'generate_interior_async', fake_generate_async)
+    response = client.post('/generate', data={
+        'blueprint': (io.BytesIO(_blueprint_png()), 'plan.png'),
+        'styles': ['modern', 'japanese', 'modern'],
+    })
+    assert response.status_code == 302
+    batch_id = response.headers['Location'].split('/')[2]
+
+    deadline = time.monotonic() + 5
+    while not (batch := client.get(f'/batches/{batch_id}').get_json())['finished']:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert [job['style'] for job in batch['jobs']] == ['modern', 'japanese']
+    assert all(job['status'] == 'done' and job['result_url'] for job in batch['jobs'])
+    # Чертёж подготовлен и сохранён один раз на все стили
+    assert calls[0][1] is calls[1][1]
+    with application.app_context():
+        stored = app_module.StoredFile.query.all()
+    assert sorted(row.kind for row in stored) == ['result', 'result', 'upload']
+
+    # Другой воркер с пустой очередью отвечает по записям в БД
+    monkeypatch.setattr(app_module, 'generation_queue', JobQueue(workers=1))
+    # Запись «готово» уходит в БД чуть позже, чем задача завершается в своём процессе
+    while not (other := client.get(f'/batches/{batch_id}').get_json())['finished']:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert [job['style'] for job in other['jobs']] == ['modern', 'japanese']
+    job = client.get(f"/jobs/{other['jobs'][0]['id']}").get_json()
+    assert (job['status'], job['result_url']) == ('done', batch['jobs'][0]['result_url'])
+    result_filename = job['result_url'].rsplit('/', 1)[1]
+    assert os.path.exists(application.extensions['pizz_storage']['result'].path(result_filename))
+    assert client.get('/jobs/unknown').status_code == 404
+
+
+def test_metrics_endpoint_counts_requests_and_honours_token(client, monkeypatch):
+    assert client.get('/').status_code == 200
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'pizz_http_requests_total{endpoint="main.index",method="GET",status="200"}' in body
+
+    monkeypatch.setenv('METRICS_TOKEN', 'secret')
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code == 200
+
+
+def test_init_db_command_creates_schema(tmp_path):
+    application = app_module.create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'fresh.db'}"})
+    with application.app_context():
+        assert not app_module.db.inspect(app_module.db.engine).get_table_names()
+    result = application.test_cli_runner().invoke(args=['init-db'])
+    assert result.exit_code == 0
+    with application.app_context():
+        assert 'users' in app_module.db.inspect(app_module.db.engine).get_table_names()
+
+
+def test_public_pages_are_cached_for_anonymous_visitors(client):
+    assert client.get('/').headers['X-Page-Cache'] == 'MISS'
+    assert client.get('/').headers['X-Page-Cache'] == 'HIT'
+
+
+def test_generation_over_quota_answers_429(client, monkeypatch):
+    queue = JobQueue(workers=1, maxsize=4, tiers={'free': TierPolicy(rate_per_minute=1, burst=1)}, default_tier='free')
+    monkeypatch.setattr(app_module, 'generation_queue', queue)
+    monkeypatch.setattr(app_module, 'generate_interior', lambda *args, **kwargs: None)
+    monkeypatch.setattr(app_module, 'GENERATION_ASYNC', False)
+
+    def post():
+        return client.post('/generate', data={'blueprint': (io.BytesIO(_blueprint_png()), 'plan.png'), 'style': 'modern'})
+
+    assert post().status_code == 302
+    throttled = post()
+    assert throttled.status_code == 429
+    assert int(throttled.headers['Retry-After']) >= 1
+
+
+def test_generation_is_rejected_before_the_upload_is_stored(client, application, monkeypatch):
+    queue = JobQueue(workers=1, maxsize=4, tiers={'free': TierPolicy(rate_per_minute=1, burst=1, max_wait=1)}, default_tier='free')
+    queue._avg_run = 10.0
+    monkeypatch.setattr(app_module, 'generation_queue', queue)
+
+    def post(blueprint):
+        return client.post('/generate', data={'blueprint': (io.BytesIO(blueprint), 'plan.png'), 'style': 'modern'})
+
+    # Перегрузка: чертёж не разбирается и не пишется, квота клиента не тратится
+    overloaded = post(_blueprint_png())
+    assert overloaded.status_code == 503
+    assert int(overloaded.headers['Retry-After']) >= 1
+    with application.app_context():
+        assert app_module.StoredFile.query.count() == 0
+    assert not os.listdir(application.config['UPLOAD_FOLDER'])
+    assert queue._tier_state('free').limiter.consume('ip:127.0.0.1') == 0
+    # Квота исчерпана: отказ приходит раньше проверки самого файла
+    queue._avg_run = 0.0
+    assert post(b'not an image').status_code == 429
+
+
+def test_generation_tier_follows_latest_subscription(application):
+    with application.app_context():
+        user = app_module.User(first_name='Анна', email='tier@example.com', password_hash='x')
+        app_module.db.session.add(user)
+        app_module.db.session.commit()
+        assert app_module.generation_tier(user) == 'free'
+        app_module.db.session.add(app_module.Subscription(
+            user_id=user.id, plan_slug='pro', plan_name='Pro', card_holder='ANNA', card_number='4111',
+            expiry_month='01', expiry_year='2030', cvv='123',
+        ))
+        app_module.db.session.commit()
+        # Новая подписка сбрасывает закэшированный тариф
+        assert app_module.generation_tier(user) == 'pro'
+
+
+def test_storage_gc_prunes_old_job_records(application):
+    with application.app_context():
+        for job_id, age in (('old', 48 * 3600), ('fresh', 60)):
+            app_module.db.session.add(app_module.GenerationJob(
+                id=job_id, tier='free', status='done', created_at=time.time() - age,
+            ))
+        app_module.db.session.commit()
+        assert app_module.collect_storage_garbage()['jobs'] == 1
+        assert [row.id for row in app_module.GenerationJob.query.all()] == ['fresh']
+
+
+def _stored(application, kind: str, filename: str, size: int, owner_id=None, accessed_days_ago: float = 0) -> str:
+    path = application.extensions['pizz_storage'][kind].path(filename, create=True)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    accessed = datetime.utcnow() - timedelta(days=accessed_days_ago)
+    app_module.db.session.add(app_module.StoredFile(
+        kind=kind, filename=filename, size=size, owner_id=owner_id, created_at=accessed, last_access_at=accessed,
+    ))
+    app_module.db.session.commit()
+    return path
+
+
+def _user(email: str) -> int:
+    user = app_module.User(first_name='Анна', email=email, password_hash='x')
+    app_module.db.session.add(user)
+    app_module.db.session.commit()
+    return user.id
+
+
+def _remaining() -> list[str]:
+    return sorted(row.filename for row in app_module.StoredFile.query.all())
+
+
+def test_storage_gc_removes_files_not_opened_for_too_long(application):
+    with application.app_context():
+        old = _stored(application, 'result', 'result_old.webp', 10, accessed_days_ago=40)
+        fresh = _stored(application, 'upload', 'blueprint_fresh.png', 10, accessed_days_ago=1)
+        assert app_module.collect_storage_garbage()['expired'] == (1, 10)
+        assert _remaining() == ['blueprint_fresh.png']
+        assert not os.path.exists(old)
+        assert os.path.exists(fresh)
+
+
+def test_storage_gc_evicts_least_recently_opened_over_quota(application):
+    application.config.update(STORAGE_USER_QUOTA_BYTES=25, STORAGE_QUOTA_BYTES=30)
+    with application.app_context():
+        heavy, light = _user('heavy@example.com'), _user('light@example.com')
+        for name, days in (('result_h1.webp', 3), ('result_h2.webp', 2), ('result_h3.webp', 1)):
+            _stored(application, 'result', name, 10, heavy, accessed_days_ago=days)
+        _stored(application, 'result', 'result_l1.webp', 10, light, accessed_days_ago=5)
+        _stored(application, 'upload', 'blueprint_anon.png', 10, accessed_days_ago=4)
+
+        stats = app_module.collect_storage_garbage()
+        # У пользователя сверх 25 байт — уходит давнее открытие; затем по общему лимиту 30 байт — самый давний файл сервиса
+        assert stats['user_quota'] == (1, 10)
+        assert stats['total_quota'] == (1, 10)
+        assert _remaining() == ['blueprint_anon.png', 'result_h2.webp', 'result_h3.webp']
+
+
+def test_storage_gc_removes_only_orphans_inside_the_grace_window(application):
+    storage = application.extensions['pizz_storage']['upload']
+    with application.app_context():
+        _stored(application, 'upload', 'blueprint_known.png', 10, accessed_days_ago=0)
+        first_recorded = app_module.db.session.query(app_module.func.min(app_module.StoredFile.created_at)).scalar()
+        since = first_recorded.replace(tzinfo=app_module.timezone.utc).timestamp()
+        orphans = {}
+        for name, mtime in (
+            ('blueprint_lost.png', since + 60),           # после начала учёта, но ещё в грейс-периоде
+            ('blueprint_legacy.png', since - 3600),       # сохранён до учёта в БД
+        ):
+            orphans[name] = storage.path(name, create=True)
+            with open(orphans[name], 'wb') as f:
+                f.write(b'12345')
+            os.utime(orphans[name], (mtime, mtime))
+
+        assert app_module.collect_storage_garbage()['orphans'] == (0, 0)
+        application.config['STORAGE_ORPHAN_GRACE_HOURS'] = -1
+        assert app_module.collect_storage_garbage()['orphans'] == (1, 5)
+        assert not os.path.exists(orphans['blueprint_lost.png'])
+        assert os.path.exists(orphans['blueprint_legacy.png'])
+        assert _remaining() == ['blueprint_known.png']
+
+
+def test_storage_usage_is_internal_stats(client, application, monkeypatch):
+    with application.app_context():
+        owner = _user('usage@example.com')
+        _stored(application, 'result', 'result_u.webp', 7, owner)
+        _stored(application, 'upload', 'blueprint_u.png', 3)
+    assert client.get('/storage/usage').status_code == 404
+    monkeypatch.setenv('METRICS_TOKEN', 'secret')
+    assert client.get('/storage/usage').status_code == 401
+    data = client.get(f'/storage/usage?user_id={owner}', headers={'Authorization': 'Bearer secret'}).get_json()
+    assert data['user'] == {'files': 1, 'bytes': 7, 'by_kind': {'result': {'files': 1, 'bytes': 7}}}
+    assert data['total']['bytes'] == 10
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import threading
+from types import SimpleNamespace
+
+import app as app_module
+import asgi
+
+
+class FakeStream:
+    def __init__(self, deltas, pause: float):
+        self.deltas = deltas
+        self.pause = pause
+        self.sent = 0
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.sent == len(self.deltas):
+            raise StopAsyncIteration
+        await asyncio.sleep(self.pause)
+        self.sent += 1
+        return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=self.deltas[self.sent - 1]))])
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeAsyncOpenAI:
+    """Асинхронный двойник OpenAI: целый ответ или поток фрагментов."""
+
+    def __init__(self, deltas, pause: float = 0.0):
+        self.deltas = deltas
+        self.pause = pause
+        self.streams = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, stream=False, **kwargs):
+        if stream:
+            self.streams.append(FakeStream(self.deltas, self.pause))
+            return self.streams[-1]
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=''.join(self.deltas)))])
+
+
+async def _request(application, method: str, path: str, payload: dict | None = None, disconnect_after: float | None = None):
+    messages = []
+    received = []
+    body = json.dumps(payload).encode() if payload is not None else b''
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method, 'path': path,
+        'raw_path': path.encode(), 'query_string': b'', 'root_path': '', 'scheme': 'http',
+        'headers': [(b'host', b'testserver'), (b'content-type', b'application/json')],
+        'server': ('testserver', 80), 'client': ('127.0.0.1', 1234),
+    }
+
+    async def receive():
+        received.append(None)
+        if len(received) == 1:
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        # Дальше сервер сообщает только об обрыве соединения
+        if disconnect_after is None:
+            await asyncio.Event().wait()
+        await asyncio.sleep(disconnect_after)
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        messages.append(message)
+
+    await application(scope, receive, send)
+    start = messages[0]
+    return start['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+
+def _call(method: str, path: str, payload: dict | None = None, **kwargs):
+    return asyncio.run(_request(asgi.application, method, path, payload, **kwargs))
+
+
+def test_chat_is_served_in_event_loop(monkeypatch):
+    monkeypatch.setattr(app_module, 'openai_api_key', 'test-key')
+    monkeypatch.setattr(app_module, 'get_async_openai_client', lambda: FakeAsyncOpenAI(['Цена ', 'зависит от площади.']))
+    status, body = _call('POST', '/chat', {'messages': [{'role': 'user', 'content': 'Сколько стоит проект?'}]})
+    assert status == 200
+    assert json.loads(body) == {'reply': 'Цена зависит от площади.'}
+
+    status, body = _call('POST', '/chat', {'messages': []})
+    assert status == 400
+
+
+def test_chat_streams_ndjson(monkeypatch):
+    monkeypatch.setattr(app_module, 'openai_api_key', 'test-key')
+    monkeypatch.setattr(app_module, 'get_async_openai_client', lambda: FakeAsyncOpenAI(['Срок ', 'две недели.']))
+    status, body = _call('POST', '/chat', {'messages': [{'role': 'user', 'content': 'Какой срок?'}], 'stream': True})
+    assert status == 200
+    lines = [json.loads(line) for line in body.decode().splitlines()]
+    assert lines == [{'delta': 'Срок '}, {'delta': 'две недели.'}, {'done': True}]
+
+
+def test_stream_stops_when_client_disconnects(monkeypatch):
+    client = FakeAsyncOpenAI(['фрагмент '] * 50, pause=0.01)
+    monkeypatch.setattr(app_module, 'openai_api_key', 'test-key')
+    monkeypatch.setattr(app_module, 'get_async_openai_client', lambda: client)
+    status, body = _call('POST', '/chat', {'messages': [{'role': 'user', 'content': 'Расскажите подробно'}], 'stream': True},
+                         disconnect_after=0.05)
+    assert status == 200
+    assert b'"done"' not in body
+    # Поток модели закрыт задолго до конца ответа
+    stream, = client.streams
+    assert stream.closed
+    assert stream.sent < 50
+
+
+def test_flask_requests_run_in_parallel_threads():
+    threads = set()
+    started = threading.Barrier(2, timeout=2)
+
+    def handler(environ, start_response):
+        threads.add(threading.current_thread().name)
+        started.wait()
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'ok']
+
+    wsgi = asgi.PooledWsgiToAsgi(handler, 2)
+
+    async def both():
+        return await asyncio.gather(*(_request(wsgi, 'GET', '/') for _ in range(2)))
+
+    # Оба запроса ждут друг друга на барьере: по одному они бы не прошли
+    assert asyncio.run(both()) == [(200, b'ok')] * 2
+    assert len(threads) == 2
+
+
+def test_other_routes_go_to_flask():
+    status, body = _call('GET', '/')
+    assert status == 200
+    assert b'<html' in body.lower()
@@ -0,0 +1,65 @@
+import gzip
+import os
+
+from flask import Flask
+from PIL import Image
+
+from assets import IMMUTABLE_CACHE_CONTROL, AssetManifest, build_assets, init_assets
+
+
+def _static_dir(tmp_path):
+    static = tmp_path / 'static'
+    (static / 'css').mkdir(parents=True)
+    (static / 'images').mkdir()
+    (static / 'css' / 'style.css').write_text('body { color: red; }\n' * 50)
+    Image.new('RGB', (1000, 500), 'blue').save(static / 'images' / 'hero.png')
+    return static
+
+
+def test_build_hashes_compresses_and_resizes(tmp_path):
+    static = _static_dir(tmp_path)
+    manifest = build_assets(str(static))
+    dist = static / 'dist'
+
+    css = manifest['css/style.css']['path']
+    assert css.startswith('css/style.') and css.endswith('.css')
+    assert gzip.decompress((dist / f'{css}.gz').read_bytes()) == (static / 'css' / 'style.css').read_bytes()
+
+    hero = manifest['images/hero.png']
+    assert (hero['width'], hero['height']) == (1000, 500)
+    webp = hero['sources']['image/webp']
+    assert [width for _, width in webp] == [480, 960, 1000]
+    for path, width in webp:
+        with Image.open(dist / path) as image:
+            assert image.size[0] == width
+    # Повторная сборка тех же файлов даёт те же имена
+    assert build_assets(str(static)) == manifest
+
+
+def test_helpers_fall_back_to_static_without_build(tmp_path):
+    assets = AssetManifest(str(_static_dir(tmp_path)))
+    assert assets.url('css/style.css') == '/static/css/style.css'
+    assert str(assets.picture('images/hero.png', alt='План')) == (
+        '<img src="/static/images/hero.png" alt="План" decoding="async" loading="lazy">'
+    )
+
+
+def test_picture_and_immutable_serving(tmp_path):
+    static = _static_dir(tmp_path)
+    manifest = build_assets(str(static))
+    app = Flask(__name__)
+    assets = init_assets(app, str(static))
+
+    markup = str(assets.picture('images/hero.png', lazy=False))
+    assert markup.startswith('<picture><source type=')
+    assert 'width="1000" height="500"' in markup
+    assert 'loading=' not in markup
+
+    css_url = assets.url('css/style.css')
+    assert css_url == f"/assets/{manifest['css/style.css']['path']}"
+    response = app.test_client().get(css_url, headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Cache-Control'] == IMMUTABLE_CACHE_CONTROL
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert app.test_client().get('/assets/missing.css').status_code == 404
+    assert os.path.isfile(static / 'dist' / 'manifest.json')
@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+import app as app_module
+from auth_security import HasherBusyError, PasswordHasher, TokenBucketLimiter
+
+
+@pytest.fixture
+def hasher():
+    hasher = PasswordHasher('pbkdf2:sha256:1000', workers=1, max_pending=1)
+    yield hasher
+    hasher.shutdown()
+
+
+def test_hash_and_verify_in_pool(hasher):
+    password_hash = hasher.hash('secret123')
+    assert password_hash.startswith('pbkdf2:sha256:1000$')
+    assert hasher.verify(password_hash, 'secret123')
+    assert not hasher.verify(password_hash, 'wrong')
+    assert not hasher.verify('', 'secret123')
+
+
+def test_old_parameters_need_rehash(hasher):
+    assert not hasher.needs_rehash(hasher.hash('secret123'))
+    assert hasher.needs_rehash('pbkdf2:sha256:600000$salt$hash')
+
+
+def test_full_pool_rejects_at_once(hasher):
+    hasher._slots.acquire()
+    try:
+        with pytest.raises(HasherBusyError):
+            hasher.hash('secret123')
+    finally:
+        hasher._slots.release()
+
+
+def test_token_bucket_refills_per_key(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('auth_security.time.monotonic', lambda: now[0])
+    limiter = TokenBucketLimiter(rate=0.5, capacity=2)
+    assert limiter.consume('ip:1') == 0
+    assert limiter.consume('ip:1') == 0
+    assert limiter.consume('ip:1') == pytest.approx(2.0)
+    # Другой ключ считается отдельно
+    assert limiter.consume('ip:2') == 0
+    now[0] += 2
+    assert limiter.consume('ip:1') == 0
+    assert TokenBucketLimiter(rate=0, capacity=0).consume('ip:1') == 0
+
+
+def test_hasher_pool_does_not_fork_a_threaded_process():
+    # Фоновые потоки уже работают, как в воркере к первому входу
+    stop = threading.Event()
+    thread = threading.Thread(target=stop.wait, daemon=True)
+    thread.start()
+    hasher = PasswordHasher('pbkdf2:sha256:1000', workers=1)
+    try:
+        password_hash = hasher.hash('secret123')
+        assert hasher.verify(password_hash, 'secret123')
+        assert not hasher.verify(password_hash, 'wrong')
+        assert hasher._executor._mp_context.get_start_method() != 'fork'
+    finally:
+        hasher.shutdown()
+        stop.set()
+
+
+def test_proxy_fix_uses_forwarded_address(tmp_path):
+    addresses = []
+    for proxies in (0, 1):
+        application = app_module.create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+            'TRUSTED_PROXIES': proxies,
+        })
+
+        @application.route('/whoami')
+        def whoami():
+            return app_module.request.remote_addr
+
+        client = application.test_client()
+        addresses.append(client.get('/whoami', headers={'X-Forwarded-For': '203.0.113.7'}).text)
+    assert addresses == ['127.0.0.1', '203.0.113.7']
@@ -0,0 +1,41 @@
+import requests
+
+import benchmark
+import generator_utils
+
+
+def test_percentile_uses_nearest_rank():
+    values = [float(number) for number in range(1, 101)]
+    assert benchmark.percentile(values, 50) == 50.0
+    assert benchmark.percentile(values, 99) == 99.0
+    assert benchmark.percentile([], 95) == 0.0
+
+
+def test_compare_flags_only_regressions_past_the_threshold():
+    baseline = {'generate@8': {'p95_ms': 100.0, 'rps': 50.0}, 'chat@8': {'p95_ms': 100.0, 'rps': 50.0}}
+    results = {'generate@8': {'p95_ms': 130.0, 'rps': 35.0}, 'chat@8': {'p95_ms': 115.0, 'rps': 45.0}, 'new@1': {'p95_ms': 1.0, 'rps': 1.0}}
+    problems = benchmark.compare(results, baseline, max_regression=0.2)
+    assert len(problems) == 2
+    assert all(problem.startswith('generate@8') for problem in problems)
+
+
+def test_throttle_bursts_repeat_every_n_requests():
+    behavior = benchmark.StubBehavior(throttle_every=4, throttle_burst=2)
+    assert [behavior.next_status() for _ in range(8)] == [429, 200, 200, 429, 429, 200, 200, 429]
+
+
+def test_generation_goes_to_stubbed_stability(tmp_path, monkeypatch):
+    server = benchmark.start_stub(benchmark.StabilityStubHandler, benchmark.StubBehavior(throttle_every=2, throttle_burst=1))
+    try:
+        url = benchmark._server_url(server)
+        monkeypatch.setenv('STABILITY_API_BASE', url)
+        monkeypatch.setenv('STABILITY_API_KEYS', 'stub-key-a,stub-key-b')
+        monkeypatch.setenv('RESULT_CACHE_MAX_BYTES', '0')
+        assert requests.post(f'{url}/v1/unknown', data=b'x').status_code == 404
+
+        # Второй запрос получает 429, генерация уходит на другой ключ
+        output = tmp_path / 'result.webp'
+        assert generator_utils.generate_interior('prompt', 'plan.png', str(output), image_bytes=b'png') == str(output)
+        assert output.read_bytes() == benchmark.StabilityStubHandler.image
+    finally:
+        server.shutdown()
@@ -0,0 +1,82 @@
+import io
+
+import pytest
+from PIL import Image
+
+import blueprint_preprocess
+from blueprint_preprocess import InvalidBlueprintError, preprocess_blueprint
+from metrics import STAGE_SECONDS
+
+
+def _encode(image: Image.Image, image_format: str, **params) -> bytes:
+    out = io.BytesIO()
+    image.save(out, format=image_format, **params)
+    return out.getvalue()
+
+
+def _decode(data: bytes) -> Image.Image:
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+
+def _line_art(size=(400, 200)) -> Image.Image:
+    image = Image.new('RGB', size, 'white')
+    for x in range(0, size[0], 20):
+        for y in range(size[1]):
+            image.putpixel((x, y), (0, 0, 0))
+    return image
+
+
+def test_line_drawing_is_downsized_and_binarized():
+    result = preprocess_blueprint(_encode(_line_art((2000, 1000)), 'JPEG', quality=95), max_side=500)
+    image = _decode(result.data)
+    assert result.extension == 'png'
+    assert image.mode == '1'
+    assert image.size == (500, 250)
+    assert result.bytes_saved > 0
+
+
+def test_stage_timings_and_savings_are_exported_as_metrics():
+    saved = blueprint_preprocess.BYTES_SAVED._values.get((), 0)
+    result = preprocess_blueprint(_encode(_line_art((1200, 600)), 'JPEG', quality=95), max_side=300)
+    assert blueprint_preprocess.BYTES_SAVED._values[()] == saved + result.bytes_saved
+    rendered = '\n'.join(STAGE_SECONDS.render())
+    for stage in ('decode', 'resize', 'orient', 'classify', 'encode'):
+        assert f'stage="preprocess.{stage}"' in rendered
+
+
+def test_photo_stays_in_color_as_jpeg():
+    photo = Image.new('RGB', (300, 300))
+    for x in range(300):
+        for y in range(300):
+            photo.putpixel((x, y), (x % 256, y % 256, 120))
+    result = preprocess_blueprint(_encode(photo, 'PNG'))
+    image = _decode(result.data)
+    assert result.extension == 'jpg'
+    assert image.mode == 'RGB'
+
+
+def test_exif_orientation_is_applied():
+    exif = Image.Exif()
+    exif[0x0112] = 6  # повёрнут на 90°
+    raw = _encode(_line_art((400, 200)), 'JPEG', exif=exif.tobytes())
+    assert _decode(preprocess_blueprint(raw).data).size == (200, 400)
+
+
+@pytest.mark.parametrize('image', [
+    Image.new('CMYK', (64, 32), (0, 0, 0, 0)),
+    Image.new('I;16', (64, 32), 1000),
+    Image.new('RGBA', (64, 32), (0, 0, 0, 0)),
+])
+def test_unusual_modes_are_normalized(image):
+    image_format = 'JPEG' if image.mode == 'CMYK' else 'PNG'
+    result = preprocess_blueprint(_encode(image, image_format))
+    assert _decode(result.data).mode in ('1', 'L', 'RGB')
+    assert _decode(result.data).size == (64, 32)
+
+
+@pytest.mark.parametrize('raw', [b'not an image', _encode(_line_art(), 'PNG')[:200]])
+def test_broken_input_is_rejected(raw):
+    with pytest.raises(InvalidBlueprintError):
+        preprocess_blueprint(raw)
@@ -0,0 +1,127 @@
+import json
+
+import pytest
+from PIL import Image
+
+import benchmark
+import bulk_generate
+from bulk_generate import ITEM_DONE, ITEM_INVALID, load_items, previous_statuses
+
+
+def _plans(folder, *names):
+    folder.mkdir()
+    for name in names:
+        Image.new('RGB', (64, 64), 'white').save(folder / name)
+    return folder
+
+
+def test_folder_items_cover_every_style(tmp_path):
+    plans = _plans(tmp_path / 'plans', 'b.png', 'a.jpg')
+    (plans / 'notes.txt').write_text('не чертёж')
+    items = load_items(str(plans), ['modern', 'gothic'], 'светлее')
+    assert [item.id for item in items] == ['a__modern', 'a__gothic', 'b__modern', 'b__gothic']
+    assert all(item.prompt == 'светлее' for item in items)
+
+
+def test_manifest_paths_are_relative_to_manifest(tmp_path):
+    manifest = tmp_path / 'manifest.jsonl'
+    manifest.write_text(
+        json.dumps({'blueprint': 'plans/a.png', 'style': 'japanese', 'prompt': 'без ковров'}) + '\n'
+        + json.dumps({'blueprint': 'plans/b.png', 'id': 'room'}) + '\n',
+        encoding='utf-8',
+    )
+    first, second = load_items(str(manifest), ['modern'])
+    assert first.blueprint == str(tmp_path / 'plans' / 'a.png')
+    assert (first.style, first.prompt) == ('japanese', 'без ковров')
+    assert (second.id, second.style) == ('room', 'modern')
+
+
+def test_previous_statuses_ignore_lost_results_and_broken_lines(tmp_path):
+    (tmp_path / 'kept.webp').write_bytes(b'image')
+    log = tmp_path / 'results.jsonl'
+    log.write_text(
+        json.dumps({'id': 'kept', 'status': 'done', 'output': 'kept.webp'}) + '\n'
+        + json.dumps({'id': 'lost', 'status': 'done', 'output': 'lost.webp'}) + '\n'
+        + json.dumps({'id': 'bad', 'status': 'failed', 'output': 'bad.webp'}) + '\n'
+        + '{"id": "cut',
+        encoding='utf-8',
+    )
+    assert previous_statuses(str(log), str(tmp_path)) == {'kept': 'done', 'lost': None, 'bad': 'failed'}
+
+
+def test_run_against_stub_is_logged_and_resumable(tmp_path, monkeypatch, capsys):
+    server = benchmark.start_stub(benchmark.StabilityStubHandler, benchmark.StubBehavior(throttle_every=3, throttle_burst=1))
+    try:
+        monkeypatch.setenv('STABILITY_API_BASE', benchmark._server_url(server))
+        monkeypatch.setenv('STABILITY_API_KEYS', 'bulk-key-a,bulk-key-b')
+        monkeypatch.setenv('RESULT_CACHE_MAX_BYTES', '0')
+        plans = _plans(tmp_path / 'plans', 'a.png', 'b.png')
+        (plans / 'broken.png').write_bytes(b'not an image')
+        out = tmp_path / 'out'
+        argv = [str(plans), '--out', str(out), '--styles', 'modern,japanese', '--concurrency', '2']
+
+        assert bulk_generate.main(argv) == 1
+        entries = [json.loads(line) for line in (out / 'results.jsonl').read_text(encoding='utf-8').splitlines()]
+        statuses = {entry['id']: entry['status'] for entry in entries}
+        assert statuses == {
+            'a__modern': ITEM_DONE, 'a__japanese': ITEM_DONE, 'b__modern': ITEM_DONE, 'b__japanese': ITEM_DONE,
+            'broken__modern': ITEM_INVALID, 'broken__japanese': ITEM_INVALID,
+        }
+        assert (out / 'a__japanese.webp').read_bytes() == benchmark.StabilityStubHandler.image
+        assert all(entry['key'] for entry in entries if entry['status'] == ITEM_DONE)
+
+        # Повторный запуск берёт только незавершённые задачи
+        (out / 'b__modern.webp').unlink()
+        capsys.readouterr()
+        bulk_generate.main(argv + ['--no-retry-failed'])
+        assert 'уже готово: 5' in capsys.readouterr().out
+    finally:
+        server.shutdown()
+
+
+def test_interrupt_logs_finished_but_unrecorded_items(tmp_path, monkeypatch):
+    plans = _plans(tmp_path / 'plans', 'a.png', 'b.png', 'c.png')
+    out = tmp_path / 'out'
+    monkeypatch.setenv('STABILITY_API_KEYS', 'interrupt-key')
+    monkeypatch.setattr(bulk_generate, 'run_item', lambda item, out_dir, loader: {
+        'id': item.id, 'status': ITEM_DONE, 'latency': 0.0, 'key': None,
+    })
+    real_as_completed = bulk_generate.as_completed
+    calls = []
+
+    def interrupted(futures):
+        calls.append(futures)
+        if len(calls) > 1:
+            yield from real_as_completed(futures)
+            return
+        futures = list(futures)
+        for future in futures:
+            future.result()
+        # Ctrl+C приходит, когда записана одна задача из трёх, а остальные уже завершились
+        yield futures[0]
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(bulk_generate, 'as_completed', interrupted)
+    assert bulk_generate.main([str(plans), '--out', str(out), '--styles', 'modern', '--concurrency', '1']) == 130
+    entries = [json.loads(line) for line in (out / 'results.jsonl').read_text(encoding='utf-8').splitlines()]
+    assert sorted(entry['id'] for entry in entries) == ['a__modern', 'b__modern', 'c__modern']
+
+
+@pytest.mark.parametrize('manifest_id, expected', [
+    ('../../etc/evil', '.._.._etc_evil'),
+    ('plans/room 1', 'plans_room_1'),
+    ('kitchen-2', 'kitchen-2'),
+])
+def test_manifest_ids_stay_inside_out_dir(tmp_path, manifest_id, expected):
+    manifest = tmp_path / 'manifest.jsonl'
+    manifest.write_text(json.dumps({'blueprint': 'plan.png', 'style': 'modern', 'id': manifest_id}) + '\n', encoding='utf-8')
+    [item] = load_items(str(manifest), ['modern'])
+    assert item.id == expected
+    assert '/' not in item.id
+
+
+def test_manifest_ids_with_several_styles_get_style_suffix(tmp_path):
+    manifest = tmp_path / 'manifest.csv'
+    manifest.write_text('blueprint,id\nplan.png,a/b\n', encoding='utf-8')
+    items = load_items(str(manifest), ['modern', 'gothic'])
+    assert [item.id for item in items] == ['a_b__modern', 'a_b__gothic']
@@ -0,0 +1,54 @@
+import time
+
+import pytest
+from sqlalchemy import create_engine, text
+
+import app as app_module
+from db_utils import TTLCache, database_uri, engine_options
+
+
+def test_database_url_overrides_local_sqlite(monkeypatch):
+    monkeypatch.delenv('DATABASE_URL', raising=False)
+    assert database_uri('/srv/app') == 'sqlite:////srv/app/app.db'
+    monkeypatch.setenv('DATABASE_URL', 'postgres://user:secret@db/pizz')
+    assert database_uri('/srv/app') == 'postgresql://user:secret@db/pizz'
+
+
+def test_sqlite_connections_get_wal_pragmas(tmp_path):
+    uri = f"sqlite:///{tmp_path / 'test.db'}"
+    engine = create_engine(uri, **engine_options(uri))
+    with engine.connect() as connection:
+        assert connection.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+        assert connection.execute(text('PRAGMA synchronous')).scalar() == 1
+        assert connection.execute(text('PRAGMA foreign_keys')).scalar() == 1
+    engine.dispose()
+
+
+def test_ttl_cache_expires_and_invalidates():
+    cache = TTLCache(ttl=0.05)
+    cache.set(1, {'email': 'a@example.com'})
+    cache.set(2, {'email': 'b@example.com'})
+    assert cache.get(1) == {'email': 'a@example.com'}
+    cache.invalidate(1)
+    assert cache.get(1) is None
+    time.sleep(0.06)
+    assert cache.get(2) is None
+
+    disabled = TTLCache(ttl=0)
+    disabled.set(1, 'value')
+    assert disabled.get(1) is None
+
+
+@pytest.mark.parametrize('uri', ['sqlite://', 'sqlite:///:memory:'])
+def test_memory_sqlite_has_no_pool_sizing(uri):
+    assert 'pool_size' not in engine_options(uri)
+    application = app_module.create_app({'SQLALCHEMY_DATABASE_URI': uri})
+    with application.app_context():
+        app_module.db.create_all()
+        assert app_module.User.query.count() == 0
+
+
+def test_file_sqlite_keeps_pool_sizing(tmp_path):
+    options = engine_options(f"sqlite:///{tmp_path / 'app.db'}")
+    assert options['pool_size'] > 0
+    assert options['connect_args']['timeout'] == 30
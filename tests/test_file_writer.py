@@ -0,0 +1,42 @@
+import threading
+
+from file_writer import AsyncFileWriter
+
+
+def test_pending_file_is_readable_until_written(tmp_path, monkeypatch):
+    writer = AsyncFileWriter()
+    gate = threading.Event()
+    write_file = AsyncFileWriter._write_file
+
+    def slow_write(path, data):
+        gate.wait(5)
+        write_file(path, data)
+
+    monkeypatch.setattr(writer, '_write_file', slow_write)
+    path = tmp_path / 'result.webp'
+    writer.write(str(path), b'image')
+    assert writer.read(str(path)) == b'image'
+    assert not path.exists()
+
+    gate.set()
+    writer.flush()
+    assert path.read_bytes() == b'image'
+    assert writer.read(str(path)) is None
+
+
+def test_writes_past_the_cap_are_synchronous(tmp_path):
+    writer = AsyncFileWriter(max_pending_bytes=4)
+    path = tmp_path / 'big.webp'
+    writer.write(str(path), b'too big')
+    assert path.read_bytes() == b'too big'
+    assert writer.read(str(path)) is None
+
+
+def test_latest_version_wins(tmp_path):
+    writer = AsyncFileWriter()
+    path = tmp_path / 'result.webp'
+    for version in (b'first', b'second', b'third'):
+        writer.write(str(path), version)
+    writer.flush()
+    assert path.read_bytes() == b'third'
+    assert writer.read(str(path)) is None
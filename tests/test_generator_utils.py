@@ -0,0 +1,155 @@
+import asyncio
+import threading
+import time
+
+import requests
+
+import benchmark
+import generator_utils
+from file_writer import AsyncFileWriter
+from retry_policy import RetryPolicy
+
+
+def _response(status: int, content: bytes = b'') -> requests.Response:
+    response = requests.Response()
+    response.status_code = status
+    response._content = content
+    return response
+
+
+def test_key_fall_through_reuses_session_and_body(tmp_path, monkeypatch):
+    monkeypatch.setenv('STABILITY_API_KEYS', 'session-key-a,session-key-b')
+    monkeypatch.setenv('RESULT_CACHE_MAX_BYTES', '0')
+    calls = []
+
+    def fake_post(session, url, headers=None, data=None, **kwargs):
+        calls.append((session, headers['authorization'], data))
+        return _response(401) if len(calls) == 1 else _response(200, b'interior')
+
+    monkeypatch.setattr(requests.Session, 'post', fake_post)
+    blueprint = tmp_path / 'plan.png'
+    blueprint.write_bytes(b'blueprint-bytes')
+    output = tmp_path / 'result.webp'
+
+    assert generator_utils.generate_interior('prompt', str(blueprint), str(output)) == str(output)
+    assert output.read_bytes() == b'interior'
+    (first_session, first_key, first_body), (second_session, second_key, second_body) = calls
+    assert first_session is second_session
+    assert first_key != second_key
+    assert first_body is second_body
+    assert b'blueprint-bytes' in first_body
+
+
+def test_blueprint_from_memory_and_result_through_writer(tmp_path, monkeypatch):
+    monkeypatch.setenv('STABILITY_API_KEYS', 'memory-key')
+    monkeypatch.setenv('RESULT_CACHE_MAX_BYTES', '0')
+    bodies = []
+
+    def fake_post(session, url, headers=None, data=None, **kwargs):
+        bodies.append(data)
+        return _response(200, b'interior')
+
+    monkeypatch.setattr(requests.Session, 'post', fake_post)
+    writer = AsyncFileWriter()
+    output = tmp_path / 'result.webp'
+
+    # Файла чертежа на диске нет: байты переданы из памяти
+    assert generator_utils.generate_interior(
+        'prompt', str(tmp_path / 'missing.png'), str(output), image_bytes=b'in-memory', writer=writer,
+    ) == str(output)
+    assert b'in-memory' in bodies[0]
+    assert writer.read(str(output)) in (b'interior', None)
+    writer.flush()
+    assert output.read_bytes() == b'interior'
+
+
+def test_async_generation_falls_through_throttled_key(tmp_path, monkeypatch):
+    server = benchmark.start_stub(benchmark.StabilityStubHandler, benchmark.StubBehavior(throttle_every=2, throttle_burst=1))
+    try:
+        monkeypatch.setenv('STABILITY_API_BASE', benchmark._server_url(server))
+        monkeypatch.setenv('STABILITY_API_KEYS', 'async-key-a,async-key-b')
+        monkeypatch.setenv('RESULT_CACHE_MAX_BYTES', '0')
+        outputs = [tmp_path / 'first.webp', tmp_path / 'second.webp']
+
+        async def generate_both():
+            # Второй запрос к заглушке получает 429 и уходит на другой ключ
+            return [
+                await generator_utils.generate_interior_async('prompt', 'plan.png', str(output), image_bytes=b'png')
+                for output in outputs
+            ]
+
+        assert asyncio.run(generate_both()) == [str(output) for output in outputs]
+        assert all(output.read_bytes() == benchmark.StabilityStubHandler.image for output in outputs)
+    finally:
+        server.shutdown()
+
+
+def _fast_policy(monkeypatch, **params) -> RetryPolicy:
+    policy = RetryPolicy(backoff_base=0.01, backoff_cap=0.01, **params)
+    monkeypatch.setattr(generator_utils, 'get_retry_policy', lambda: policy)
+    return policy
+
+
+def test_transient_error_is_retried_and_fatal_one_is_not(tmp_path, monkeypatch):
+    monkeypatch.setenv('STABILITY_API_KEYS', 'retry-key-a,retry-key-b')
+    monkeypatch.setenv('RESULT_CACHE_MAX_BYTES', '0')
+    _fast_policy(monkeypatch)
+    statuses = [503, 200, 400, 200]
+
+    def fake_post(session, url, **kwargs):
+        return _response(statuses.pop(0), b'interior')
+
+    monkeypatch.setattr(requests.Session, 'post', fake_post)
+    output = tmp_path / 'result.webp'
+    assert generator_utils.generate_interior('prompt', 'plan.png', str(output), image_bytes=b'png') == str(output)
+    assert generator_utils.generate_interior('prompt', 'plan.png', str(output), image_bytes=b'png') is None
+    assert statuses == [200]
+
+
+def test_slow_attempt_is_hedged_on_second_key(tmp_path, monkeypatch):
+    monkeypatch.setenv('STABILITY_API_KEYS', 'hedge-key-slow,hedge-key-fast')
+    monkeypatch.setenv('RESULT_CACHE_MAX_BYTES', '0')
+    policy = _fast_policy(monkeypatch, hedge=True, hedge_min_samples=1, hedge_min_delay=0.05)
+    policy.observe(0.05)
+    pool = generator_utils.get_stability_key_pool()
+    # Первым берётся «медленный» ключ: у второго хуже средняя задержка
+    pool.release(pool.acquire(exclude={'hedge-key-slow'}), 200, 5.0)
+    release = threading.Event()
+
+    def fake_post(session, url, headers=None, **kwargs):
+        if headers['authorization'].endswith('slow'):
+            release.wait(2)
+            return _response(200, b'slow')
+        return _response(200, b'fast')
+
+    monkeypatch.setattr(requests.Session, 'post', fake_post)
+    output = tmp_path / 'result.webp'
+    won = generator_utils.HEDGES._values.get(('won',), 0)
+    try:
+        assert generator_utils.generate_interior('prompt', 'plan.png', str(output), image_bytes=b'png') == str(output)
+    finally:
+        release.set()
+    assert output.read_bytes() == b'fast'
+    assert generator_utils.HEDGES._values[('won',)] == won + 1
+    # Ключ проигравшего свободен, хотя его запрос ещё не вернулся
+    assert pool._states['hedge-key-slow'].in_flight == 0
+
+
+def test_hedge_counts_against_attempt_budget(tmp_path, monkeypatch):
+    monkeypatch.setenv('STABILITY_API_KEYS', 'budget-key-a,budget-key-b')
+    monkeypatch.setenv('RESULT_CACHE_MAX_BYTES', '0')
+    policy = _fast_policy(monkeypatch, hedge=True, hedge_min_samples=1, hedge_min_delay=0.05, max_attempts=1)
+    policy.observe(0.05)
+    keys = []
+
+    def fake_post(session, url, headers=None, **kwargs):
+        keys.append(headers['authorization'])
+        time.sleep(0.2)
+        return _response(503)
+
+    monkeypatch.setattr(requests.Session, 'post', fake_post)
+    fired = generator_utils.HEDGES._values.get(('fired',), 0)
+    assert generator_utils.generate_interior('prompt', 'plan.png', str(tmp_path / 'r.webp'), image_bytes=b'png') is None
+    # Единственная разрешённая попытка уже потрачена: дубля нет
+    assert len(keys) == 1
+    assert generator_utils.HEDGES._values.get(('fired',), 0) == fired
@@ -0,0 +1,23 @@
+import pytest
+
+import app as app_module
+
+
+@pytest.fixture
+def client():
+    application = app_module.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+    return application.test_client()
+
+
+@pytest.mark.parametrize('path', ['/chat/stats', '/jobs/stats'])
+def test_stats_closed_without_metrics_token(client, monkeypatch, path):
+    monkeypatch.delenv('METRICS_TOKEN', raising=False)
+    assert client.get(path).status_code == 404
+
+
+@pytest.mark.parametrize('path', ['/chat/stats', '/jobs/stats'])
+def test_stats_require_metrics_token(client, monkeypatch, path):
+    monkeypatch.setenv('METRICS_TOKEN', 'secret')
+    assert client.get(path).status_code == 401
+    assert client.get(path, headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    assert client.get(path, headers={'Authorization': 'Bearer secret'}).status_code == 200
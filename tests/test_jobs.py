@@ -0,0 +1,241 @@
+import threading
+import time
+
+import pytest
+
+from async_runtime import EventLoopThread
+from jobs import DEFAULT_TIER, JOB_DONE, JOB_FAILED, JOB_QUEUED, JOB_RUNNING, JobQueue, QueueFullError, QuotaExceededError, TierPolicy
+
+
+def _wait_finished(job, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not job.finished:
+        assert time.monotonic() < deadline, 'задача не завершилась'
+        time.sleep(0.01)
+
+
+def test_job_runs_in_background_and_keeps_meta():
+    queue = JobQueue(workers=1, maxsize=4)
+    job = queue.submit(lambda a, b: a + b, 2, 3, meta={'result_url': '/results/x.webp'})
+    _wait_finished(job)
+    assert job.status == JOB_DONE
+    assert job.result == 5
+    assert queue.get(job.id) is job
+    assert job.to_dict()['result_url'] == '/results/x.webp'
+
+
+def test_falsy_result_and_exception_fail_the_job():
+    queue = JobQueue(workers=1, maxsize=4)
+
+    def boom():
+        raise ValueError('нет ключа')
+
+    empty = queue.submit(lambda: None)
+    broken = queue.submit(boom)
+    for job in (empty, broken):
+        _wait_finished(job)
+        assert job.status == JOB_FAILED
+    assert empty.error
+    assert 'нет ключа' in broken.error
+
+
+def test_full_queue_rejects_at_once_and_reports_position():
+    release = threading.Event()
+    queue = JobQueue(workers=1, maxsize=2)
+    running = queue.submit(release.wait)
+    while running.status == JOB_QUEUED:
+        time.sleep(0.01)
+    first = queue.submit(release.wait)
+    second = queue.submit(release.wait)
+    try:
+        with pytest.raises(QueueFullError):
+            queue.submit(release.wait)
+        assert queue.position(running) == 0
+        assert queue.position(first) == 0
+        assert queue.position(second) == 1
+    finally:
+        release.set()
+    _wait_finished(second)
+
+
+def test_finished_jobs_are_pruned():
+    queue = JobQueue(workers=1, maxsize=8, keep_finished=1)
+    jobs = [queue.submit(lambda: True) for _ in range(3)]
+    for job in jobs:
+        _wait_finished(job)
+    queue.submit(lambda: True)
+    assert queue.get(jobs[0].id) is None
+    assert queue.get(jobs[1].id) is None
+
+
+def test_batch_is_admitted_all_or_nothing():
+    release = threading.Event()
+    queue = JobQueue(workers=1, maxsize=3)
+    blocker = queue.submit(release.wait)
+    while blocker.status == JOB_QUEUED:
+        time.sleep(0.01)
+    call = (release.wait, (), {}, {'style': 'modern'})
+    try:
+        with pytest.raises(QueueFullError):
+            queue.submit_batch([call] * 4)
+        assert queue.position(queue.submit(release.wait)) == 0
+        with pytest.raises(QueueFullError):
+            queue.submit_batch([call] * 3)
+        batch_id = queue.submit_batch([call] * 2)
+        jobs = queue.get_batch(batch_id)
+        assert [job.batch_id for job in jobs] == [batch_id, batch_id]
+        assert jobs[0].meta == {'style': 'modern'}
+    finally:
+        release.set()
+    for job in jobs:
+        _wait_finished(job)
+    assert queue.get_batch('unknown') is None
+
+
+def test_coroutine_jobs_run_in_event_loop():
+    queue = JobQueue(workers=1, maxsize=4, async_runner=EventLoopThread('test-loop'), async_concurrency=2)
+    threads = []
+
+    async def work(value):
+        threads.append(threading.current_thread().name)
+        return value
+
+    async def fail():
+        raise ValueError('нет ответа')
+
+    done = queue.submit(work, 'result.webp')
+    failed = queue.submit(fail)
+    for job in (done, failed):
+        _wait_finished(job)
+    assert done.status == JOB_DONE
+    assert done.result == 'result.webp'
+    assert threads == ['test-loop']
+    assert failed.status == JOB_FAILED
+    assert 'нет ответа' in failed.error
+
+
+def _tiered_queue(workers: int = 1, maxsize: int = 32, **policies) -> JobQueue:
+    tiers = {'free': TierPolicy(), **policies}
+    return JobQueue(workers=workers, maxsize=maxsize, tiers=tiers, default_tier='free')
+
+
+def _wait_running(job, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while job.status != JOB_RUNNING:
+        assert time.monotonic() < deadline, 'задача не запустилась'
+        time.sleep(0.01)
+
+
+def test_tiers_share_workers_by_weight():
+    queue = _tiered_queue(pro=TierPolicy(weight=3))
+    release = threading.Event()
+    order = []
+    blocker = queue.submit(release.wait, tier='free')
+    _wait_running(blocker)
+    jobs = [queue.submit(order.append, 'free', tier='free') for _ in range(4)]
+    jobs += [queue.submit(order.append, 'pro', tier='pro') for _ in range(4)]
+    release.set()
+    for job in jobs:
+        _wait_finished(job)
+    # Вес 3 против 1: на три задачи pro приходится одна бесплатная
+    assert order == ['pro', 'pro', 'pro', 'free', 'pro', 'free', 'free', 'free']
+    assert jobs[0].tier == 'free'
+    assert queue.submit(lambda: True, tier='unknown').tier == 'free'
+
+
+def test_tier_concurrency_leaves_workers_to_other_tiers():
+    queue = _tiered_queue(workers=3, free=TierPolicy(concurrency=1), pro=TierPolicy())
+    release = threading.Event()
+    first = queue.submit(release.wait, tier='free')
+    second = queue.submit(release.wait, tier='free')
+    paid = queue.submit(release.wait, tier='pro')
+    try:
+        _wait_running(first)
+        _wait_running(paid)
+        time.sleep(0.05)
+        assert second.status == JOB_QUEUED
+        assert queue.stats()['free']['running'] == 1
+    finally:
+        release.set()
+    _wait_finished(second)
+
+
+def test_client_quota_counts_submissions_not_jobs():
+    queue = _tiered_queue(free=TierPolicy(rate_per_minute=1, burst=1))
+    call = (lambda: True, (), {}, {})
+    queue.submit_batch([call] * 3, client='ip:1')
+    with pytest.raises(QuotaExceededError) as info:
+        queue.submit(lambda: True, client='ip:1')
+    assert 0 < info.value.retry_after <= 60
+    queue.submit(lambda: True, client='ip:2')
+    queue.submit(lambda: True)
+
+
+def test_overload_rejection_does_not_spend_quota():
+    queue = _tiered_queue(free=TierPolicy(rate_per_minute=1, burst=1, max_wait=1))
+    # По прошлым задачам ожидание оценивается в 10 с — больше допустимого
+    queue._avg_run = 10.0
+    for _ in range(3):
+        with pytest.raises(QueueFullError) as info:
+            queue.admit(client='ip:1')
+        assert not isinstance(info.value, QuotaExceededError)
+    with pytest.raises(QueueFullError):
+        queue.submit(lambda: True, client='ip:1')
+    assert queue._tier_state('free').limiter.consume('ip:1') == 0
+
+
+def test_admitted_quota_is_refunded():
+    queue = _tiered_queue(free=TierPolicy(rate_per_minute=1, burst=1))
+    queue.admit(2, client='ip:1')
+    with pytest.raises(QuotaExceededError):
+        queue.admit(client='ip:1')
+    queue.refund('free', 'ip:1')
+    queue.admit(client='ip:1')
+
+
+def test_tier_queue_limit_rejects_with_retry_after():
+    queue = _tiered_queue(free=TierPolicy(max_queued=1), pro=TierPolicy())
+    release = threading.Event()
+    blocker = queue.submit(release.wait, tier='pro')
+    try:
+        _wait_running(blocker)
+        queue.submit(lambda: True, tier='free')
+        with pytest.raises(QueueFullError) as info:
+            queue.submit(lambda: True, tier='free')
+        assert info.value.retry_after >= 1
+        queue.submit(lambda: True, tier='pro')
+    finally:
+        release.set()
+
+
+def test_wait_estimate_is_bounded_by_real_capacity():
+    # Слотов в очереди 64, но одновременно идут только 4 запроса (ключи × запросы на ключ)
+    limited = JobQueue(workers=64, capacity=lambda: 4)
+    unlimited = JobQueue(workers=64)
+    for queue in (limited, unlimited):
+        queue._avg_run = 10.0
+    assert limited.stats()[DEFAULT_TIER]['estimated_wait'] == 2.5
+    assert unlimited.stats()[DEFAULT_TIER]['estimated_wait'] == round(10.0 / 64, 2)
+
+
+def test_state_changes_are_reported_without_going_back():
+    queue = JobQueue(workers=1, maxsize=4)
+    seen = []
+
+    def on_change(job):
+        seen.append((job.id, job.status))
+        raise RuntimeError('БД недоступна')
+
+    job = queue.submit(lambda: True, on_change=on_change)
+    _wait_finished(job)
+    deadline = time.monotonic() + 5
+    while len(seen) < 3:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    # Ошибка обработчика не мешает задаче
+    assert job.status == JOB_DONE
+    # Обработчик видит текущее состояние, поэтому поздний вызов не откатывает статус назад
+    order = [JOB_QUEUED, JOB_RUNNING, JOB_DONE]
+    ranks = [order.index(status) for _, status in seen]
+    assert ranks == sorted(ranks)
+    assert seen[-1] == (job.id, JOB_DONE)
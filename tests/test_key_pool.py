@@ -0,0 +1,65 @@
+import asyncio
+import threading
+import time
+
+from key_pool import KeyPool, parse_retry_after
+
+
+def test_retry_after_accepts_seconds_and_http_date():
+    assert parse_retry_after('7', 30.0) == 7.0
+    assert parse_retry_after(None, 30.0) == 30.0
+    assert parse_retry_after('soon', 30.0) == 30.0
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT', 30.0) == 0.0
+
+
+def test_least_loaded_key_is_picked_and_in_flight_is_capped():
+    pool = KeyPool(['a', 'b'], max_in_flight=1)
+    first = pool.acquire()
+    second = pool.acquire()
+    assert {first, second} == {'a', 'b'}
+    assert pool.acquire(timeout=0.05) is None
+    pool.release(first, 200, 0.1)
+    assert pool.acquire(timeout=0.05) == first
+
+
+def test_waiting_caller_gets_released_key():
+    pool = KeyPool(['a'], max_in_flight=1)
+    key = pool.acquire()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.acquire(timeout=2)))
+    waiter.start()
+    time.sleep(0.05)
+    pool.release(key, 200, 0.1)
+    waiter.join(2)
+    assert got == ['a']
+
+
+def test_rate_limited_key_cools_down_and_faster_key_wins():
+    pool = KeyPool(['slow', 'fast'], cooldown=0.1)
+    pool.release(pool.acquire(exclude={'fast'}), 200, 2.0)
+    pool.release(pool.acquire(exclude={'slow'}), 200, 0.5)
+    assert pool.acquire() == 'fast'
+    pool.release('fast', 429, 0.1, retry_after='0.1')
+    assert pool.acquire() == 'slow'
+    time.sleep(0.15)
+    pool.release('slow', 200, 2.0)
+    assert pool.acquire() == 'fast'
+
+
+def test_rejected_key_is_quarantined():
+    pool = KeyPool(['bad', 'good'], quarantine=60)
+    pool.release(pool.acquire(exclude={'good'}), 401, 0.1)
+    assert pool.acquire() == 'good'
+    assert pool.acquire(exclude={'good'}) is None
+
+
+def test_async_waiter_is_woken_by_release_from_another_thread():
+    pool = KeyPool(['a'], max_in_flight=1)
+    key = pool.acquire()
+
+    async def wait_for_key():
+        threading.Timer(0.05, pool.release, args=(key, 200, 0.1)).start()
+        return await pool.acquire_async(timeout=2)
+
+    assert asyncio.run(wait_for_key()) == 'a'
+    assert asyncio.run(pool.acquire_async(exclude={'a'}, timeout=0.05)) is None
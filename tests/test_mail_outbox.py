@@ -0,0 +1,130 @@
+"""Очередь писем против локального SMTP-сервера aiosmtpd."""
+import smtplib
+import socket
+from email.message import EmailMessage
+
+import pytest
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult
+
+import app as app_module
+from mail_outbox import OUTBOX_FAILED, OUTBOX_PENDING, OUTBOX_SENT, SMTPSender, is_connection_error, is_permanent_error
+
+
+class RecordingHandler:
+    """Принимает письма и отвергает получателей reject*@… кодом 550."""
+
+    def __init__(self):
+        self.delivered = []
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address.startswith('reject'):
+            return '550 5.1.1 Mailbox unavailable'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        self.delivered.extend(envelope.rcpt_tos)
+        return '250 Message accepted'
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def smtp_server():
+    handler = RecordingHandler()
+    controller = Controller(
+        handler,
+        hostname='127.0.0.1',
+        port=_free_port(),
+        authenticator=lambda *args: AuthResult(success=True),
+        auth_require_tls=False,
+    )
+    controller.start()
+    yield controller, handler
+    controller.stop()
+
+
+@pytest.fixture
+def app(tmp_path):
+    application = app_module.create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'app.db'}"})
+    with application.app_context():
+        app_module.init_db()
+        yield application
+        app_module.db.session.remove()
+
+
+def _sender(port: int) -> SMTPSender:
+    return SMTPSender('127.0.0.1', port, 'user', 'secret', use_tls=False, timeout=5)
+
+
+def _enqueue(*recipients: str) -> list[int]:
+    rows = [app_module.OutboxMessage(recipient=recipient, subject='Тест', body='Привет') for recipient in recipients]
+    app_module.db.session.add_all(rows)
+    app_module.db.session.commit()
+    return [row.id for row in rows]
+
+
+def _statuses(ids: list[int]) -> list[str]:
+    return [app_module.db.session.get(app_module.OutboxMessage, message_id).status for message_id in ids]
+
+
+def test_rejected_recipient_is_permanent_error(smtp_server):
+    controller, _ = smtp_server
+    sender = _sender(controller.port)
+    message = EmailMessage()
+    message['From'] = 'user@example.com'
+    message['To'] = 'reject@example.com'
+    message.set_content('Привет')
+    with pytest.raises(smtplib.SMTPRecipientsRefused) as info:
+        sender.send(message)
+    assert not is_connection_error(info.value)
+    assert is_permanent_error(info.value)
+
+
+@pytest.mark.parametrize('exc, connection, permanent', [
+    (ConnectionRefusedError(), True, False),
+    (socket.timeout(), True, False),
+    (smtplib.SMTPServerDisconnected('closed'), True, False),
+    (smtplib.SMTPAuthenticationError(535, b'bad credentials'), True, False),
+    (smtplib.SMTPResponseException(421, b'closing'), True, False),
+    (smtplib.SMTPSenderRefused(553, b'sender rejected', 'user@example.com'), False, True),
+    (smtplib.SMTPDataError(554, b'spam'), False, True),
+    (smtplib.SMTPDataError(451, b'try later'), False, False),
+    (smtplib.SMTPRecipientsRefused({'a@example.com': (450, b'greylisted')}), False, False),
+])
+def test_error_classification(exc, connection, permanent):
+    assert is_connection_error(exc) is connection
+    assert is_permanent_error(exc) is permanent
+
+
+def test_drain_fails_rejected_message_and_sends_the_rest(app, smtp_server, monkeypatch):
+    controller, handler = smtp_server
+    monkeypatch.setattr(app_module, 'mail_sender', _sender(controller.port))
+    ids = _enqueue('first@example.com', 'reject@example.com', 'last@example.com')
+
+    stats = app_module.drain_outbox()
+
+    assert stats == {'sent': 2, 'retry': 0, 'failed': 1}
+    assert _statuses(ids) == [OUTBOX_SENT, OUTBOX_FAILED, OUTBOX_SENT]
+    assert handler.delivered == ['first@example.com', 'last@example.com']
+    rejected = app_module.db.session.get(app_module.OutboxMessage, ids[1])
+    assert rejected.attempts == 1
+    assert '550' in rejected.last_error
+
+
+def test_drain_stops_round_when_server_is_down(app, monkeypatch):
+    monkeypatch.setattr(app_module, 'mail_sender', _sender(_free_port()))
+    ids = _enqueue('first@example.com', 'second@example.com')
+
+    stats = app_module.drain_outbox()
+
+    assert stats == {'sent': 0, 'retry': 1, 'failed': 0}
+    assert _statuses(ids) == [OUTBOX_PENDING, OUTBOX_PENDING]
+    first = app_module.db.session.get(app_module.OutboxMessage, ids[0])
+    second = app_module.db.session.get(app_module.OutboxMessage, ids[1])
+    assert first.attempts == 1 and second.attempts == 0
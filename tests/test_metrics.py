@@ -0,0 +1,51 @@
+import logging
+
+from metrics import MetricsRegistry, STAGE_SECONDS, annotate, end_trace, log_if_slow, span, start_trace
+
+
+def test_counter_and_histogram_render_prometheus_text():
+    registry = MetricsRegistry()
+    requests_total = registry.counter('t_requests_total', 'Запросы', ('status',))
+    latency = registry.histogram('t_latency_seconds', 'Задержка', buckets=(0.1, 1.0))
+    requests_total.inc(status=200)
+    requests_total.inc(2, status=200)
+    requests_total.inc(status='a"b')
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5)
+
+    lines = registry.render().splitlines()
+    assert '# TYPE t_requests_total counter' in lines
+    assert 't_requests_total{status="200"} 3' in lines
+    assert 't_requests_total{status="a\\"b"} 1' in lines
+    assert 't_latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 't_latency_seconds_bucket{le="1"} 2' in lines
+    assert 't_latency_seconds_bucket{le="+Inf"} 3' in lines
+    assert 't_latency_seconds_sum 5.55' in lines
+    assert 't_latency_seconds_count 3' in lines
+    # Повторная регистрация возвращает ту же метрику
+    assert registry.counter('t_requests_total', 'Запросы', ('status',)) is requests_total
+
+
+def test_spans_feed_histogram_and_current_trace(caplog):
+    before = STAGE_SECONDS._values.get(('test.stage',), [None, 0.0, 0])[2]
+    trace = start_trace('POST /generate')
+    with span('test.stage'):
+        pass
+    annotate(attempts=2)
+    assert end_trace() is trace
+    assert [stage for stage, _ in trace.stages] == ['test.stage']
+    assert STAGE_SECONDS._values[('test.stage',)][2] == before + 1
+    assert 'attempts=2' in trace.summary()
+
+    # Вне трассировки span пишет только в гистограмму
+    with span('test.stage'):
+        pass
+    assert trace.stages == [trace.stages[0]]
+
+    logger = logging.getLogger('test.metrics')
+    with caplog.at_level(logging.WARNING, logger='test.metrics'):
+        log_if_slow(trace, 10.0, logger, elapsed=1.0)
+        log_if_slow(trace, 0.5, logger, elapsed=1.0)
+    assert len(caplog.records) == 1
+    assert 'test.stage=' in caplog.records[0].getMessage()
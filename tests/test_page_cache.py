@@ -0,0 +1,117 @@
+import time
+
+import pytest
+from flask import Flask, flash
+from flask_login import LoginManager
+
+from page_cache import CachedPage, MemoryPageBackend, PageCache, cached_page
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    LoginManager(app).user_loader(lambda user_id: None)
+    cache = PageCache(MemoryPageBackend(), ttl=60, locales=('ru', 'en'))
+    app.extensions['pizz_page_cache'] = cache
+    renders = []
+
+    @app.route('/')
+    @cached_page
+    def index():
+        renders.append('index')
+        return 'index'
+
+    @app.route('/plans')
+    @cached_page(query=('page',))
+    def plans():
+        renders.append('plans')
+        return 'plans'
+
+    @app.route('/missing')
+    @cached_page
+    def missing():
+        renders.append('missing')
+        return 'нет', 404
+
+    @app.route('/notify')
+    def notify():
+        flash('Готово')
+        return 'ok'
+
+    with app.test_client() as test_client:
+        yield test_client, cache, renders
+
+
+def test_page_is_rendered_once_and_revalidated_by_etag(client):
+    test_client, _, renders = client
+    first = test_client.get('/')
+    second = test_client.get('/')
+    assert renders == ['index']
+    assert (first.headers['X-Page-Cache'], second.headers['X-Page-Cache']) == ('MISS', 'HIT')
+    assert second.headers['Cache-Control'] == 'no-cache'
+    assert second.get_data() == b'index'
+
+    revalidated = test_client.get('/', headers={'If-None-Match': second.headers['ETag']})
+    assert revalidated.status_code == 304
+    assert revalidated.get_data() == b''
+
+
+def test_locale_is_part_of_the_key_and_errors_are_not_cached(client):
+    test_client, cache, renders = client
+    test_client.get('/', headers={'Accept-Language': 'en'})
+    test_client.get('/', headers={'Accept-Language': 'ru'})
+    test_client.get('/missing')
+    test_client.get('/missing')
+    assert renders == ['index', 'index', 'missing', 'missing']
+    assert cache.invalidate('index') == 2
+    test_client.get('/')
+    assert renders[-1] == 'index'
+
+
+def test_pending_flash_bypasses_cache(client):
+    test_client, _, renders = client
+    test_client.get('/notify')
+    response = test_client.get('/')
+    assert 'X-Page-Cache' not in response.headers
+    assert renders == ['index']
+
+
+def test_memory_backend_expires_and_evicts():
+    backend = MemoryPageBackend(maxsize=2)
+    backend.set('a', b'1', ttl=60)
+    backend.set('b', b'2', ttl=60)
+    backend.get('a')
+    backend.set('c', b'3', ttl=60)
+    assert backend.get('b') is None
+    assert backend.get('a') == b'1'
+    backend.set('short', b'4', ttl=0.01)
+    time.sleep(0.02)
+    assert backend.get('short') is None
+
+
+def test_cached_page_round_trip_and_config():
+    page = CachedPage(b'<p>\n</p>', 'text/html; charset=utf-8', 'abc')
+    restored = CachedPage.loads(page.dumps())
+    assert (restored.body, restored.content_type, restored.etag) == (page.body, page.content_type, page.etag)
+
+    assert PageCache.from_config({'PAGE_CACHE_BACKEND': 'none', 'PAGE_CACHE_TTL': 60}) is None
+    assert PageCache.from_config({'PAGE_CACHE_BACKEND': 'memory', 'PAGE_CACHE_TTL': 0}) is None
+    with pytest.raises(ValueError):
+        PageCache.from_config({'PAGE_CACHE_BACKEND': 'memcached', 'PAGE_CACHE_TTL': 60})
+
+
+def test_unknown_query_params_share_one_entry(client):
+    test_client, cache, renders = client
+    for query in ('', '?x=1', '?x=2', '?utm_source=mail'):
+        response = test_client.get(f'/{query}')
+    assert renders == ['index']
+    assert response.headers['X-Page-Cache'] == 'HIT'
+    assert len(cache.backend._entries) == 1
+
+
+def test_allowed_query_params_are_part_of_the_key(client):
+    test_client, _, renders = client
+    for query in ('?page=1', '?page=1&x=5', '?page=2'):
+        test_client.get(f'/plans{query}')
+    assert renders == ['plans', 'plans']
@@ -0,0 +1,86 @@
+import json
+import os
+
+from result_cache import INDEX_FILENAME, ResultCache
+
+
+def test_key_depends_on_every_input():
+    def key(image=b'png', prompt='prompt', reference=b'ref', strength=0.5, output_format='webp'):
+        return ResultCache.make_key(image, prompt, reference, strength, output_format)
+
+    assert key() == key()
+    assert len({key(), key(image=b'other'), key(prompt='other'), key(reference=None),
+                key(strength=0.6), key(output_format='png')}) == 6
+
+
+def test_hit_copies_file_and_counts(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), max_bytes=1000)
+    output = tmp_path / 'out.webp'
+    assert not cache.get('k', str(output))
+    cache.put('k', b'image', 'webp')
+    assert cache.get('k', str(output))
+    assert output.read_bytes() == b'image'
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries'], stats['bytes']) == (1, 1, 1, 5)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    directory = tmp_path / 'cache'
+    cache = ResultCache(str(directory), max_bytes=250)
+    cache.put('old', bytes(100), 'webp')
+    cache.put('used', bytes(100), 'webp')
+    assert cache.get('old', str(tmp_path / 'out.webp'))
+    cache.put('new', bytes(100), 'webp')
+    assert not cache.get('used', str(tmp_path / 'out.webp'))
+    assert cache.stats()['evictions'] == 1
+    assert not os.path.exists(directory / 'used.webp')
+
+
+def test_index_survives_restart_and_skips_missing_files(tmp_path):
+    directory = tmp_path / 'cache'
+    cache = ResultCache(str(directory), max_bytes=1000)
+    cache.put('kept', b'a', 'webp')
+    cache.put('lost', b'b', 'webp')
+    os.remove(directory / 'lost.webp')
+
+    restarted = ResultCache(str(directory), max_bytes=1000)
+    assert restarted.get('kept', str(tmp_path / 'out.webp'))
+    assert not restarted.get('lost', str(tmp_path / 'out.webp'))
+    assert restarted.stats()['entries'] == 1
+
+
+def test_oversized_result_is_not_cached(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), max_bytes=10)
+    cache.put('big', bytes(11), 'webp')
+    assert cache.stats()['entries'] == 0
+
+
+def _cached_files(directory) -> set[str]:
+    return {name for name in os.listdir(directory) if name.endswith('.webp')}
+
+
+def test_workers_share_index_and_byte_limit(tmp_path):
+    # Два воркера с общей папкой кэша
+    first = ResultCache(str(tmp_path), max_bytes=1000)
+    second = ResultCache(str(tmp_path), max_bytes=1000)
+    for number in range(20):
+        cache = first if number % 2 else second
+        cache.put(f'key{number}', bytes(100), 'webp')
+
+    with open(tmp_path / INDEX_FILENAME, encoding='utf-8') as f:
+        index = json.load(f)
+    assert sum(entry['size'] for entry in index.values()) <= 1000
+    assert {entry['file'] for entry in index.values()} == _cached_files(tmp_path)
+    assert set(index) == {f'key{number}' for number in range(10, 20)}
+
+
+def test_worker_sees_entries_added_by_another(tmp_path):
+    first = ResultCache(str(tmp_path), max_bytes=10000)
+    second = ResultCache(str(tmp_path), max_bytes=10000)
+    second.put('warmup', b'x', 'webp')
+    first.put('shared', b'image', 'webp')
+
+    output = tmp_path / 'out.webp'
+    assert second.get('shared', str(output))
+    assert output.read_bytes() == b'image'
+    assert second.stats()['hits'] == 1
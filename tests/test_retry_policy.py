@@ -0,0 +1,56 @@
+import time
+
+import pytest
+
+import retry_policy
+from retry_policy import RETRY_BACKOFF, RETRY_DONE, RETRY_FATAL, RETRY_NEXT_KEY, RetryPolicy
+
+
+@pytest.mark.parametrize('status, outcome', [
+    (200, RETRY_DONE),
+    (401, RETRY_NEXT_KEY),
+    (429, RETRY_NEXT_KEY),
+    (None, RETRY_BACKOFF),
+    (408, RETRY_BACKOFF),
+    (503, RETRY_BACKOFF),
+    (400, RETRY_FATAL),
+    (413, RETRY_FATAL),
+    (422, RETRY_FATAL),
+])
+def test_classify(status, outcome):
+    assert RetryPolicy.classify(status) == outcome
+
+
+def test_backoff_grows_with_full_jitter_and_respects_limits(monkeypatch):
+    monkeypatch.setattr(retry_policy.random, 'uniform', lambda low, high: high)
+    budget = RetryPolicy(deadline=60, backoff_base=0.5, backoff_cap=3).start()
+    assert [budget.backoff() for _ in range(4)] == [0.5, 1.0, 2.0, 3.0]
+    # Retry-After сервера не срезается разбросом, но пауза не выходит за дедлайн
+    assert budget.backoff('10') == 10
+    budget.deadline = time.monotonic() + 1
+    assert budget.backoff('10') <= 1
+
+
+def test_budget_is_exhausted_by_attempts_or_deadline():
+    budget = RetryPolicy(deadline=60, attempt_timeout=5, max_attempts=2).start()
+    assert budget.attempt_timeout() == 5
+    budget.attempts = 2
+    assert budget.exhausted()
+
+    budget = RetryPolicy(deadline=0.01).start()
+    time.sleep(0.02)
+    assert budget.exhausted()
+    assert budget.attempt_timeout() == 0.001
+
+
+def test_hedge_delay_follows_observed_p95():
+    assert RetryPolicy(hedge=False).hedge_delay() is None
+    policy = RetryPolicy(hedge=True, hedge_min_samples=20, hedge_min_delay=2, hedge_quantile=0.95)
+    for seconds in range(1, 20):
+        policy.observe(seconds)
+    assert policy.hedge_delay() is None
+    policy.observe(20)
+    assert policy.hedge_delay() == 19
+    fast = RetryPolicy(hedge=True, hedge_min_samples=1, hedge_min_delay=2)
+    fast.observe(0.1)
+    assert fast.hedge_delay() == 2
@@ -0,0 +1,21 @@
+import startup_check
+
+IMPORTTIME = """import time: self [us] | cumulative | imported package
+import time:       120 |        120 |   _io
+import time:      3000 |       5000 | flask
+import time:      2000 |       2000 |   flask.app
+import time:       400 |        400 | werkzeug
+garbage line
+"""
+
+
+def test_importtime_is_parsed_and_grouped_by_package():
+    entries = startup_check.parse_importtime(IMPORTTIME)
+    assert entries == [('_io', 120, 120), ('flask', 3000, 5000), ('flask.app', 2000, 2000), ('werkzeug', 400, 400)]
+    assert startup_check.heaviest_packages(entries, 2) == [('flask', 5000), ('werkzeug', 400)]
+
+
+def test_app_import_does_not_load_lazy_clients():
+    elapsed, entries = startup_check.measure()
+    assert elapsed > 0
+    assert not {name.split('.')[0] for name, _, _ in entries} & set(startup_check.LAZY_MODULES)
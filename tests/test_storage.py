@@ -0,0 +1,74 @@
+import os
+import threading
+import time
+
+from storage import PeriodicTask, ShardedStorage
+
+
+def test_files_are_sharded_and_legacy_files_still_found(tmp_path):
+    storage = ShardedStorage(str(tmp_path))
+    path = storage.path('result_abc.webp', create=True)
+    assert os.path.relpath(path, tmp_path).count(os.sep) == 2
+    with open(path, 'wb') as f:
+        f.write(b'new')
+    (tmp_path / 'blueprint_old.jpg').write_bytes(b'old')
+
+    assert storage.locate('result_abc.webp') == path
+    assert storage.locate('blueprint_old.jpg') == str(tmp_path / 'blueprint_old.jpg')
+    assert storage.locate('result_missing.webp') is None
+    # Чужие имена и попытки выйти из папки не ищутся вовсе
+    assert storage.locate('../app.db') is None
+
+
+def test_iter_files_and_delete(tmp_path):
+    storage = ShardedStorage(str(tmp_path))
+    for name in ('result_a.webp', 'result_b.webp'):
+        with open(storage.path(name, create=True), 'wb') as f:
+            f.write(b'12345')
+    (tmp_path / 'blueprint_flat.png').write_bytes(b'123')
+    (tmp_path / 'notes.txt').write_bytes(b'not ours')
+
+    assert sorted((name, size) for name, _, size, _ in storage.iter_files()) == [
+        ('blueprint_flat.png', 3), ('result_a.webp', 5), ('result_b.webp', 5),
+    ]
+    assert storage.delete('result_a.webp') == 5
+    assert storage.delete('result_a.webp') == 0
+    assert storage.locate('result_a.webp') is None
+
+
+def test_periodic_task_runs_until_stopped():
+    calls = threading.Semaphore(0)
+    task = PeriodicTask(calls.release, 0.01, 'test-task')
+    task.ensure_started()
+    assert calls.acquire(timeout=2)
+    assert calls.acquire(timeout=2)
+    task.stop()
+    disabled = PeriodicTask(calls.release, 0, 'disabled')
+    disabled.ensure_started()
+    assert disabled._thread is None
+
+
+def test_wake_runs_task_before_interval():
+    calls = threading.Semaphore(0)
+    task = PeriodicTask(calls.release, 3600, 'test-wake')
+    task.ensure_started()
+    task.wake()
+    assert calls.acquire(timeout=2)
+    task.stop()
+
+
+def test_stop_lets_the_running_call_finish():
+    started, finished = threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        time.sleep(0.1)
+        finished.set()
+
+    task = PeriodicTask(slow, 3600, 'test-stop')
+    task.ensure_started()
+    task.wake()
+    assert started.wait(2)
+    task.stop()
+    assert finished.is_set()
+    assert not task._thread.is_alive()
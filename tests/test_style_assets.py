@@ -0,0 +1,38 @@
+import io
+
+from PIL import Image
+
+from style_assets import StyleAssetRegistry
+
+
+def _png(path, size, color='red') -> bytes:
+    image = Image.new('RGB', size, color)
+    image.save(path, format='PNG')
+    return path.read_bytes()
+
+
+def test_references_are_downsized_and_reencoded_once(tmp_path):
+    raw = _png(tmp_path / 'modern.png', (1600, 800))
+    (tmp_path / 'copy.png').write_bytes(raw)
+    registry = StyleAssetRegistry(
+        {'modern': str(tmp_path / 'modern.png'), 'loft': str(tmp_path / 'copy.png'), 'gothic': str(tmp_path / 'missing.png')},
+        max_side=400,
+    )
+
+    modern = registry.get('modern')
+    assert modern.filename == 'modern.webp'
+    assert modern.mime == 'image/webp'
+    with Image.open(io.BytesIO(modern.data)) as image:
+        assert image.format == 'WEBP'
+        assert image.size == (400, 200)
+    # Одинаковые исходники делят один буфер
+    assert registry.get('loft').data is modern.data
+    assert registry.get('gothic') is None
+
+
+def test_original_is_kept_when_reencoding_does_not_help(tmp_path):
+    raw = _png(tmp_path / 'tiny.png', (1, 1))
+    registry = StyleAssetRegistry({'tiny': str(tmp_path / 'tiny.png')}, image_format='JPEG', quality=100)
+    asset = registry.get('tiny')
+    assert asset.data == raw
+    assert asset.mime == 'image/png'
@@ -0,0 +1,8 @@
+"""WSGI-точка входа::
+
+    flask --app app init-db
+    gunicorn wsgi:app --workers 2
+"""
+from app import create_app
+
+app = create_app()